@@ -0,0 +1,79 @@
+"""
+Per-tenant virtualenv cost: creation time and disk used per tenant.
+
+Creates the base env the way ensure_user_env does (venv with pip, host site-packages visible,
+deduplicated), clones it for TENANTS tenants with clone_env, and compares that with creating a
+plain venv per tenant. Also checks that a clone can import the bot's own requirements from the
+host. Runs in a temporary directory.
+
+    python bench_envs.py [tenants=20]
+"""
+import atexit
+import os
+import shutil
+import stat
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import venv
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+WORK_DIR = tempfile.mkdtemp(prefix="bench_envs_")
+atexit.register(shutil.rmtree, WORK_DIR, True)
+os.chdir(WORK_DIR) # main.py creates its files in the working directory
+
+import main
+
+def disk_bytes(*roots: str) -> int:
+    """Bytes of regular files under the roots, counting each inode (hard link) once."""
+    seen, total = set(), 0
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                st = os.lstat(os.path.join(dirpath, filename))
+                if stat.S_ISREG(st.st_mode) and st.st_ino not in seen:
+                    seen.add(st.st_ino)
+                    total += st.st_size
+    return total
+
+def main_bench():
+    tenants = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    builder = venv.EnvBuilder(with_pip=True, system_site_packages=True)
+
+    start = time.perf_counter()
+    builder.create(main.BASE_ENV_DIR)
+    main.dedupe_tree(main.BASE_ENV_DIR)
+    base_seconds = time.perf_counter() - start
+
+    clone_times = []
+    for tenant in range(tenants):
+        start = time.perf_counter()
+        main.clone_env(main.BASE_ENV_DIR, os.path.join("clones", str(tenant), ".venv"))
+        clone_times.append(time.perf_counter() - start)
+    unique = [main.get_env_unique_bytes(os.path.join("clones", str(tenant), ".venv")) for tenant in range(tenants)]
+
+    start = time.perf_counter()
+    builder.create("plain")
+    plain_seconds = time.perf_counter() - start
+    plain_bytes = disk_bytes("plain")
+
+    total_bytes = disk_bytes("envs", "clones")
+    print(f"base env: {base_seconds:.2f} s, {disk_bytes(main.BASE_ENV_DIR) / (1024 * 1024):.1f} MB")
+    print(f"clone:    p50 {statistics.median(clone_times) * 1000:.1f} ms | max {max(clone_times) * 1000:.1f} ms | "
+          f"{statistics.mean(unique) / 1024:.1f} KB unique per tenant | {tenants} tenants + base {total_bytes / (1024 * 1024):.1f} MB total")
+    print(f"plain venv per tenant: {plain_seconds * 1000:.0f} ms, {plain_bytes / (1024 * 1024):.1f} MB "
+          f"({tenants} tenants {tenants * plain_bytes / (1024 * 1024):.1f} MB)")
+
+    probe = subprocess.run(
+        [main.get_env_python(os.path.abspath(os.path.join("clones", "0", ".venv"))), "-c",
+         "import site, sys, aiohttp, telebot, requests; print(site.ENABLE_USER_SITE, sys.prefix != sys.base_prefix)"],
+        capture_output=True, text=True
+    )
+    print(f"clone imports host requirements: {'yes' if probe.returncode == 0 else 'NO: ' + probe.stderr.strip().splitlines()[-1]}"
+          f" | user site / in venv: {probe.stdout.strip()}")
+
+if __name__ == "__main__":
+    main_bench()
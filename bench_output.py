@@ -0,0 +1,79 @@
+"""
+Threads, RSS and CPU used by the bot to collect the output of many hosted scripts.
+
+Starts SCRIPTS small shell loops that print a line every second and collects their output either
+with the bot's OutputPump (one thread tailing the <UID>.log files) or, for comparison, the way it
+was done before: a pipe and a blocking reader thread per script. Runs in a temporary directory.
+
+    python bench_output.py [scripts=500] [seconds=10] [pump|threads]
+"""
+import atexit
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+WORK_DIR = tempfile.mkdtemp(prefix="bench_output_")
+atexit.register(shutil.rmtree, WORK_DIR, True)
+os.chdir(WORK_DIR) # main.py creates its files in the working directory
+
+import main
+
+SCRIPT = 'while :; do echo "tick $$"; sleep 1; done'
+
+def start_pump(index: int):
+    log_path = os.path.join(WORK_DIR, f"S{index:05d}.log")
+    with open(log_path, 'ab') as log_file:
+        process = subprocess.Popen(["sh", "-c", SCRIPT], start_new_session=True, stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT)
+    log_buffer = main.ScriptLogBuffer()
+    main.output_pump.watch(log_path, 0, process, log_buffer)
+    return process, log_buffer
+
+def read_pipe(process: subprocess.Popen, log_buffer):
+    for line in iter(process.stdout.readline, b''):
+        log_buffer.append(line.decode('utf-8', 'replace'))
+
+def start_thread(index: int):
+    process = subprocess.Popen(["sh", "-c", SCRIPT], start_new_session=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    log_buffer = main.ScriptLogBuffer()
+    threading.Thread(target=read_pipe, args=(process, log_buffer), daemon=True).start()
+    return process, log_buffer
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def main_bench():
+    scripts = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10.0
+    mode = sys.argv[3] if len(sys.argv) > 3 else "pump"
+    start = start_pump if mode == "pump" else start_thread
+
+    rss_before = main.get_rss_mb(os.getpid())
+    hosted = [start(index) for index in range(scripts)]
+    try:
+        time.sleep(2) # Let every script print its first lines
+        lines_before = sum(log_buffer.total_lines for _, log_buffer in hosted)
+        cpu_before, wall_before = cpu_seconds(), time.perf_counter()
+        time.sleep(seconds)
+        cpu = cpu_seconds() - cpu_before
+        wall = time.perf_counter() - wall_before
+        lines = sum(log_buffer.total_lines for _, log_buffer in hosted) - lines_before
+        print(f"{mode}: {scripts} scripts | {threading.active_count()} threads | "
+              f"RSS {main.get_rss_mb(os.getpid()):.1f} MB ({main.get_rss_mb(os.getpid()) - rss_before:+.1f} MB) | "
+              f"CPU {cpu / wall * 100:.2f}% of one core | {lines / wall:.0f} lines/s collected")
+    finally:
+        for process, _ in hosted:
+            os.killpg(process.pid, signal.SIGKILL)
+        for process, _ in hosted:
+            process.wait()
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,78 @@
+"""
+Write latency of the ScriptDB storage backends.
+
+Builds a script database of USERS users (SCRIPTS scripts each), then times WRITES single-script
+status changes as persisted by JSONStorageBackend (whole-file rewrite) and SQLiteStorageBackend
+(changed rows only). Runs in a temporary directory; nothing in the working tree is touched.
+
+    python bench_storage.py [users=10000] [scripts_per_user=2] [writes=100]
+"""
+import atexit
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+WORK_DIR = tempfile.mkdtemp(prefix="bench_storage_")
+atexit.register(shutil.rmtree, WORK_DIR, True)
+os.chdir(WORK_DIR) # main.py creates its files in the working directory
+
+import main
+
+def build_data(users: int, scripts_per_user: int) -> dict:
+    data = {}
+    for user in range(users):
+        user_id_str = str(1_000_000 + user)
+        data[user_id_str] = {"hosted_scripts": {
+            f"U{user:07d}{n}": {"display_name": f"bot_{user}_{n}.py", "file_name": f"U{user:07d}{n}.py", "status": "Running", "process_id": 0}
+            for n in range(scripts_per_user)
+        }}
+    return data
+
+def time_writes(backend, data: dict, writes: int) -> list:
+    """Seconds per persist() of one changed script."""
+    user_ids = list(data)
+    latencies = []
+    for i in range(writes):
+        user_id_str = user_ids[(i * 7919) % len(user_ids)]
+        uid = next(iter(data[user_id_str]["hosted_scripts"]))
+        script = data[user_id_str]["hosted_scripts"][uid]
+        script["status"] = "Paused" if script["status"] == "Running" else "Running"
+        start = time.perf_counter()
+        backend.persist(data, set(), {(user_id_str, uid)}, set())
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def report(name: str, latencies: list, size_bytes: int):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<7} p50 {statistics.median(latencies) * 1000:8.2f} ms | p95 {p95 * 1000:8.2f} ms | "
+          f"max {latencies[-1] * 1000:8.2f} ms | on disk {size_bytes / (1024 * 1024):.1f} MB")
+
+def main_bench():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    scripts_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    writes = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    data = build_data(users, scripts_per_user)
+    print(f"{users} users x {scripts_per_user} scripts, {writes} single-script writes each")
+
+    json_backend = main.JSONStorageBackend("bench.json", "bench_approved.json")
+    json_backend.persist(data, set(), set(), set())
+    report("json", time_writes(json_backend, data, writes), os.path.getsize("bench.json"))
+
+    sqlite_backend = main.SQLiteStorageBackend("bench.db")
+    sqlite_backend.persist(
+        data, set(data),
+        {(user_id_str, uid) for user_id_str, user_data in data.items() for uid in user_data["hosted_scripts"]},
+        set()
+    )
+    latencies = time_writes(sqlite_backend, data, writes)
+    size = sum(os.path.getsize(path) for path in ("bench.db", "bench.db-wal") if os.path.exists(path))
+    report("sqlite", latencies, size)
+
+if __name__ == "__main__":
+    main_bench()
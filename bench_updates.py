@@ -0,0 +1,190 @@
+"""
+Update-to-reply latency in polling and webhook mode, and upload download speed, against a local
+fake Bot API.
+
+The fake endpoint answers getMe/getUpdates/sendMessage/setWebhook/deleteWebhook like Telegram
+does (getUpdates fails with 409 while a webhook is set). The bot is pointed at it through
+TELEGRAM_API_URL. UPDATES /start messages (each from a new user) are fed in, one at a time, and the
+time until the bot's reply reaches the fake is measured. In upload mode the fake serves a document
+through getFile and /file/bot<token>/<path>, and download_document streams it to disk. Runs in a
+temporary directory.
+
+    python bench_updates.py [polling|webhook] [updates=20]
+    python bench_updates.py upload [megabytes=10]
+"""
+import asyncio
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Tuple
+from urllib.parse import parse_qsl
+
+from aiohttp import ClientSession, web
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+WORK_DIR = tempfile.mkdtemp(prefix="bench_updates_")
+atexit.register(shutil.rmtree, WORK_DIR, True)
+os.chdir(WORK_DIR) # main.py creates its files in the working directory
+
+import main
+
+API_PORT = 18081
+WEBHOOK_PORT = 18080
+WEBHOOK_SECRET = "bench-secret"
+
+
+class FakeBotAPI:
+    """Just enough of the Bot API for the bot to start, receive updates and reply."""
+    def __init__(self):
+        self.pending = []
+        self.waiters = []
+        self.webhook_url = ""
+        self.replies = 0
+        self.reply_event = asyncio.Event()
+        self.conflicts = 0
+        self.next_update_id = 0
+        self.files = {} # file_id -> content
+        self.file_downloads = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        # telebot sends parameters as a form body, also on GET
+        params = {**request.query, **dict(parse_qsl((await request.read()).decode()))}
+        if method == 'getMe':
+            return self.ok({'id': 42, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'})
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url', '')
+            return self.ok(True)
+        if method == 'deleteWebhook':
+            self.webhook_url = ""
+            return self.ok(True)
+        if method == 'getUpdates':
+            if self.webhook_url:
+                self.conflicts += 1
+                return web.json_response({'ok': False, 'error_code': 409, 'description': "Conflict: can't use getUpdates method while webhook is active"}, status=409)
+            if not self.pending:
+                waiter = asyncio.get_running_loop().create_future()
+                self.waiters.append(waiter)
+                try:
+                    await asyncio.wait_for(waiter, float(params.get('timeout', 20)))
+                except asyncio.TimeoutError:
+                    pass
+            updates, self.pending = self.pending, []
+            return self.ok(updates)
+        if method == 'getFile':
+            file_id = params['file_id']
+            return self.ok({'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.files[file_id]), 'file_path': f"documents/{file_id}"})
+        if method == 'sendMessage':
+            self.replies += 1
+            self.reply_event.set()
+            return self.ok({'message_id': self.replies, 'date': int(time.time()), 'chat': {'id': int(params['chat_id']), 'type': 'private'}, 'text': params.get('text', '')})
+        return self.ok(True)
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        self.file_downloads += 1
+        content = self.files.get(request.match_info['path'].rpartition('/')[2])
+        return web.Response(body=content) if content is not None else web.Response(status=404)
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({'ok': True, 'result': result})
+
+    def make_update(self, text: str = "/start") -> dict:
+        """A command from a new user each time, so per-chat outbox limits don't add to the latency."""
+        self.next_update_id += 1
+        user_id = 5_000_000 + self.next_update_id
+        return {'update_id': self.next_update_id, 'message': {
+            'message_id': self.next_update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        }}
+
+    def queue_update(self, update: dict):
+        self.pending.append(update)
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+
+
+async def start_fake() -> Tuple[FakeBotAPI, web.AppRunner]:
+    fake = FakeBotAPI()
+    app = web.Application()
+    app.router.add_route('*', '/bot{token}/{method}', fake.handle)
+    app.router.add_get('/file/bot{token}/{path:.+}', fake.handle_file)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', API_PORT).start()
+    main.asyncio_helper.API_URL = f"http://127.0.0.1:{API_PORT}/bot{{0}}/{{1}}" # What TELEGRAM_API_URL sets
+    return fake, runner
+
+async def close_bot_session():
+    if main.asyncio_helper.session_manager.session:
+        await main.asyncio_helper.session_manager.session.close()
+
+async def run_upload(megabytes: int):
+    fake, runner = await start_fake()
+    fake.files["bench-upload"] = os.urandom(megabytes * 1024 * 1024)
+    start = time.perf_counter()
+    size = await main.download_document("bench-upload", "upload.bin", max_bytes=(megabytes + 1) * 1024 * 1024)
+    seconds = time.perf_counter() - start
+    with open("upload.bin", 'rb') as f:
+        intact = f.read() == fake.files["bench-upload"]
+    print(f"upload: {size / (1024 * 1024):.0f} MB in {seconds * 1000:.0f} ms ({size / (1024 * 1024) / seconds:.0f} MB/s) | "
+          f"served by the fake: {fake.file_downloads} | content intact: {intact}")
+    await close_bot_session()
+    await runner.cleanup()
+
+async def run(mode: str, updates: int):
+    fake, runner = await start_fake()
+    main.UPDATE_MODE = mode
+    main.WEBHOOK_URL = f"http://127.0.0.1:{WEBHOOK_PORT}{main.WEBHOOK_PATH}"
+    main.WEBHOOK_LISTEN = '127.0.0.1'
+    main.WEBHOOK_PORT = WEBHOOK_PORT
+    main.WEBHOOK_SECRET = WEBHOOK_SECRET
+    fake.webhook_url = "https://left-over.example/telegram" # As after an earlier webhook-mode run
+
+    bot_task = asyncio.create_task(main.start_bot())
+    await asyncio.sleep(0.5)
+    latencies = []
+    async with ClientSession() as session:
+        for _ in range(updates):
+            fake.reply_event.clear()
+            update = fake.make_update()
+            start = time.perf_counter()
+            if mode == "polling":
+                fake.queue_update(update)
+            else:
+                headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+                async with session.post(main.WEBHOOK_URL, json=update, headers=headers) as response:
+                    assert response.status == 200, response.status
+            await asyncio.wait_for(fake.reply_event.wait(), 30)
+            latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(0.137) # Land at different points of the polling cycle
+        if mode == "webhook":
+            async with session.post(main.WEBHOOK_URL, json=fake.make_update(), headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'}) as response:
+                print(f"wrong secret -> HTTP {response.status}")
+
+    latencies.sort()
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    print(f"{mode}: {updates} updates | p50 {latencies[len(latencies) // 2] * 1000:.1f} ms | p95 {p95 * 1000:.1f} ms | "
+          f"getUpdates 409 conflicts {fake.conflicts}")
+    bot_task.cancel()
+    try:
+        await bot_task
+    except (asyncio.CancelledError, Exception):
+        pass
+    await close_bot_session()
+    await runner.cleanup()
+
+if __name__ == "__main__":
+    bench_mode = sys.argv[1] if len(sys.argv) > 1 else "polling"
+    if bench_mode == "upload":
+        asyncio.run(run_upload(int(sys.argv[2]) if len(sys.argv) > 2 else 10))
+    else:
+        asyncio.run(run(bench_mode, int(sys.argv[2]) if len(sys.argv) > 2 else 20))
@@ -1,16 +1,38 @@
 import asyncio
+import bisect
+import contextvars
+import fcntl
+import functools
 import logging
 import os
 import subprocess
+import glob
+import gzip
+import hashlib
+import heapq
 import json
-import uuid
+import re
+import resource
+import sqlite3
 import time
 import threading
-import queue
+import secrets
+import shutil
+import signal
+import stat
+import string
+import tarfile
+import venv
+import zipfile
+from array import array
+from collections import deque
+from itertools import islice
 from datetime import datetime, timedelta, timezone
+from aiohttp import ClientTimeout, web
 from telebot.async_telebot import AsyncTeleBot
 from telebot import types
 from telebot import asyncio_filters
+from telebot import asyncio_helper
 from typing import Dict, Tuple, Union
 
 # --- Configuration (UPDATE THESE) ---
@@ -19,15 +41,384 @@ OWNER_ID = 7900401296
 HOSTING_DIR = 'hosted_files'
 APPROVED_USERS_FILE = 'approved_users.json'
 DB_FILE = "user_scripts_db.json" 
+DB_BACKEND = "sqlite" # "sqlite" (transactional, per-row writes) or "json" (legacy single file)
+SQLITE_DB_FILE = "user_scripts.db"
+DB_FLUSH_WINDOW = 0.5 # Seconds to coalesce ScriptDB mutations into one write
+CONVERSATION_TTL = 15 * 60 # Idle seconds before a multi-step flow falls back to IDLE
+CONVERSATION_SNAPSHOT_FILE = None # e.g. 'conversation_state.json' to keep flows across restarts
+LOG_BUFFER_MAX_BYTES = 64 * 1024 # In-memory output kept per running script
+LOG_FILE_MAX_BYTES = 1024 * 1024 # Rotate hosted_files/<user_id>/<UID>.log (the script's stdout) beyond this size
+LOG_FILE_BACKUPS = 0 # Rotated log files kept (<UID>.log.1, ...); the log archive already keeps the history
+LOG_ARCHIVE_SEGMENT_BYTES = 1024 * 1024 # Archived output per segment before it is sealed (gzip) in hosted_files/<user_id>/logs/
+LOG_ARCHIVE_BLOCK_BYTES = 64 * 1024 # Output per independently decompressible gzip member (time-index granularity)
+LOG_ARCHIVE_MAX_BYTES = 20 * 1024 * 1024 # Compressed archive kept per UID; oldest segments are dropped beyond it
+LOG_ARCHIVE_MAX_AGE = 14 * 24 * 3600 # Seconds a sealed segment is kept after its last line
+LOG_SEARCH_MAX_RESULTS = 20 # Matching lines shown by /logsearch (the most recent ones)
+LOG_TAIL_LINES = 30 # Lines shown by the "📜 Logs" button
+LOG_FOLLOW_LINES = 25 # Lines kept in a "▶️ Follow" live log window
+LOG_FOLLOW_MAX_CHARS = 3500 # Character cap of that window (Telegram messages max out at 4096)
+LOG_FOLLOW_INTERVAL = 2.0 # Minimum seconds between edits of one live log message
+LOG_FOLLOW_TIMEOUT = 5 * 60 # Seconds after which following stops on its own
+LOG_FOLLOW_MAX_SESSIONS = 50 # Live log messages followed at once across all chats
+TERMINATE_GRACE_PERIOD = 5 # Seconds between SIGTERM and SIGKILL
+STARTUP_CAPTURE_WINDOW = 1.0 # Default seconds to collect a script's initial output
+STARTUP_CAPTURE_MAX_WINDOW = 30.0 # Upper bound for a per-script "# capture-window:" header
+RESTART_PARALLELISM = 8 # Scripts started concurrently during boot auto-restart
+RESTART_SPAWN_RATE = 10.0 # Max process spawns per second during boot auto-restart
+PIP_WORKERS = 2 # Concurrent pip install jobs
+PIP_TIMEOUT = 300 # Seconds per pip step before the job is canceled
+PIP_WHEEL_DIR = 'pip_wheels' # Local wheel cache; repeat installs are served from here offline
+PIP_CACHE_DIR = 'pip_cache' # pip's HTTP/build cache
+VENV_ISOLATION = True # Give every user their own virtualenv (hosted_files/<user_id>/.venv); it still sees the host's and --user packages
+BASE_ENV_DIR = os.path.join('envs', 'base') # Template env that per-user envs are hard-link cloned from
+SHARED_OBJECTS_DIR = os.path.join('envs', '.objects') # Content-addressed files shared across user envs
+# Per-script resource limits (0 = unlimited). Overridden per user by approved_users[...]['limits']
+# and per script by the script's 'limits' record; nothing is limited unless the owner sets it.
+DEFAULT_SCRIPT_LIMITS = {
+    'cpu_percent': 0, # cgroup cpu.max, 100 = one full core
+    'memory_mb': 0, # cgroup memory.max
+    'max_procs': 0, # cgroup pids.max
+    'cpu_seconds': 0, # RLIMIT_CPU: total CPU time before SIGXCPU
+    'nice': 0, # Added niceness (also runs the script in the best-effort/lowest I/O class)
+}
+CGROUP_ROOT = '/sys/fs/cgroup/hosting' # cgroup v2 parent for per-script groups, used when writable
+METRICS_INTERVAL = 10.0 # Seconds between /proc samples of hosted processes
+METRICS_HISTORY = 60 # Samples kept per UID (fixed-size ring)
+RESTART_POLICIES = ('never', 'on-failure', 'always')
+DEFAULT_RESTART_POLICY = 'on-failure' # Used when a script has no 'restart_policy'
+RESTART_BACKOFF_BASE = 2.0 # Delay before the n-th restart in a streak: base ** (n - 1) seconds
+RESTART_BACKOFF_MAX = 300.0
+CRASH_LOOP_THRESHOLD = 5 # Crashes within CRASH_LOOP_WINDOW that stop auto-restarting
+CRASH_LOOP_WINDOW = 600.0
+UPDATE_MODE = "polling" # "polling" (getUpdates) or "webhook" (aiohttp server, lower latency)
+WEBHOOK_URL = None # Public HTTPS URL Telegram posts to, e.g. 'https://bot.example.com/telegram' (TLS terminated by a reverse proxy)
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_SECRET = None # X-Telegram-Bot-Api-Secret-Token; a random one is generated per run when None
+WEBHOOK_MAX_CONCURRENCY = 32 # Updates handled at once; further webhook requests wait for a slot
+DISPATCH_WORKERS = 16 # Updates handled concurrently; each user's updates still run one at a time, in order
+DISPATCH_MAX_PENDING = 1000 # Queued updates beyond which update intake waits (backpressure)
+OUTBOX_GLOBAL_RATE = 25.0 # Outgoing messages per second across all chats (Telegram allows ~30)
+OUTBOX_CHAT_RATE = 1.0 # Sustained messages per second to one chat
+OUTBOX_CHAT_BURST = 3 # Messages a chat may receive back-to-back before OUTBOX_CHAT_RATE applies
+BLOB_STORE_DIR = os.path.join(HOSTING_DIR, '.blobs') # SHA-256 content store; script files are private copies of it
+UPLOAD_MAX_BYTES = 20 * 1024 * 1024 # Largest .py file or project archive accepted (enforced while downloading)
+UPLOAD_TIMEOUT = 120 # Seconds allowed for one upload download
+ARCHIVE_MAX_EXTRACTED_BYTES = 100 * 1024 * 1024 # Largest total size a project archive may extract to
+ARCHIVE_MAX_MEMBERS = 2000 # Most files/directories a project archive may contain
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+PROJECT_ENTRY_POINTS = ('main.py', 'bot.py', 'app.py', '__main__.py') # Searched in this order in an archive's root
+TELEGRAM_API_URL = None # Override the Bot API base, e.g. 'http://127.0.0.1:8081/bot{0}/{1}' (local Bot API server or a fake endpoint)
+LISTING_PAGE_SIZE = 15 # Rows per page of the "📃 Saved", "👥 Approved" and "📝 List User Scripts" listings
+LISTING_NAME_MAX_CHARS = 48 # Longer display names are shortened in listings (keeps a page under Telegram's 4096 chars)
 
-running_processes: Dict[str, Tuple[subprocess.Popen, queue.Queue]] = {}
+running_processes: Dict[str, Tuple[subprocess.Popen, "ScriptLogBuffer"]] = {}
 approved_users = {}
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.ERROR # Only ERROR will be shown in terminal
 )
 logger = logging.getLogger(__name__)
-bot = AsyncTeleBot(BOT_TOKEN)
+
+class HostingBot(AsyncTeleBot):
+    """AsyncTeleBot whose incoming updates (polling or webhook) go through update_dispatcher."""
+    async def process_new_updates(self, updates):
+        await update_dispatcher.submit(updates)
+
+    async def handle_updates(self, updates):
+        """Runs the registered handlers for updates right away (called by the dispatcher)."""
+        await super().process_new_updates(updates)
+
+    async def send_message(self, chat_id, text, priority: int | None = None, **kwargs):
+        """Queues the message on the outbox (rate limits, notification coalescing, retry_after) and returns the sent Message."""
+        if priority is None:
+            priority = PRIORITY_ADMIN if is_owner(int(chat_id)) else PRIORITY_REPLY
+        return await outbox.send(chat_id, text, priority, kwargs)
+
+    async def deliver_message(self, chat_id, text, **kwargs):
+        """Sends immediately, bypassing the outbox (called by the outbox)."""
+        return await super().send_message(chat_id, text, **kwargs)
+
+bot = HostingBot(BOT_TOKEN)
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = TELEGRAM_API_URL
+
+# Strong references for fire-and-forget tasks (the loop only keeps weak ones)
+background_tasks = set()
+
+def run_in_background(coro) -> asyncio.Task:
+    """Schedules a coroutine without awaiting it, keeping it alive until done."""
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# --- Update Dispatcher ---
+class UpdateDispatcher:
+    """
+    Runs updates in arrival order per user (the WAITING_FOR_* flows depend on it) and in parallel
+    across users, with at most max_workers handlers running and max_pending updates queued.
+    """
+    def __init__(self, max_workers: int = DISPATCH_WORKERS, max_pending: int = DISPATCH_MAX_PENDING):
+        self._queues: Dict[int, deque] = {}
+        self._workers = asyncio.Semaphore(max_workers)
+        self._capacity = asyncio.Semaphore(max_pending)
+        self.pending = 0
+        self.dispatched = 0
+        self.backpressure_waits = 0 # Submissions that had to wait for queue capacity
+        self.peak_depth: Dict[int, int] = {}
+        self.queue_waits = deque(maxlen=1000)
+
+    @staticmethod
+    def update_key(update: types.Update) -> int:
+        """User the update belongs to; updates without one only keep their own order."""
+        for event in (update.message, update.edited_message, update.callback_query):
+            if event is not None and event.from_user is not None:
+                return event.from_user.id
+        return -update.update_id
+
+    async def submit(self, updates) -> list:
+        """Queues updates; returns one future per update, resolved once its handler has finished."""
+        loop = asyncio.get_running_loop()
+        handled = []
+        for update in updates:
+            if self._capacity.locked():
+                self.backpressure_waits += 1
+            await self._capacity.acquire()
+            key = self.update_key(update)
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+                run_in_background(self._drain(key, queue))
+            done = loop.create_future()
+            queue.append((update, time.monotonic(), done))
+            handled.append(done)
+            self.pending += 1
+            if len(queue) > self.peak_depth.get(key, 0) and key > 0:
+                self.peak_depth[key] = len(queue)
+        return handled
+
+    async def _drain(self, key: int, queue: deque):
+        # One drain task per user; the worker slot is taken per update so busy users can't hog it
+        while queue:
+            async with self._workers:
+                update, queued_at, done = queue[0]
+                self.queue_waits.append(time.monotonic() - queued_at)
+                try:
+                    await bot.handle_updates([update])
+                except Exception as e:
+                    logger.error(f"Error handling update {update.update_id}: {e}")
+                finally:
+                    queue.popleft()
+                    if not done.done():
+                        done.set_result(None)
+                    self.pending -= 1
+                    self.dispatched += 1
+                    self._capacity.release()
+        del self._queues[key]
+
+    def depths(self) -> Dict[int, int]:
+        """Current queue depth per user with queued or running updates."""
+        return {key: len(queue) for key, queue in self._queues.items() if key > 0}
+
+update_dispatcher = UpdateDispatcher()
+
+# --- Outbound Message Scheduler ---
+PRIORITY_ADMIN, PRIORITY_REPLY, PRIORITY_NOTIFICATION = 0, 1, 2
+
+class TokenBucket:
+    """Allows `rate` events per second on average, with bursts of up to `burst`."""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self.delay(now)
+        self.tokens -= 1
+
+
+class _OutboundMessage:
+    __slots__ = ("priority", "text", "kwargs", "key", "futures")
+
+    def __init__(self, priority: int, text: str, kwargs: dict, future: asyncio.Future):
+        self.priority = priority
+        self.text = text
+        self.kwargs = kwargs
+        # Messages with equal options (parse mode, keyboard, ...) may be merged
+        self.key = {name: value.to_json() if hasattr(value, 'to_json') else value for name, value in kwargs.items()}
+        self.futures = [future]
+
+
+class _ChatOutbox:
+    __slots__ = ("queue", "bucket", "hold_until", "busy")
+
+    def __init__(self):
+        self.queue = deque()
+        self.bucket = TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+        self.hold_until = 0.0 # Set from a 429's retry_after
+        self.busy = False # Scheduled, waiting for its bucket, or has a message in flight
+
+
+class MessageScheduler:
+    """
+    Outgoing message queue: FIFO per chat, chats served by priority (admin > user replies >
+    notifications) under per-chat and global token buckets. Consecutive queued notifications to a
+    chat are coalesced (replies and admin messages are sent one by one, so one that fails to parse
+    fails alone), and a 429 holds the chat for retry_after and re-sends the message.
+    """
+    MAX_TEXT_LENGTH = 4096
+
+    def __init__(self, global_rate: float = OUTBOX_GLOBAL_RATE):
+        self._chats: Dict[int, _ChatOutbox] = {}
+        self._ready = [] # Heap of (priority, seq, chat_id) for chats allowed to send now
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._task = None
+        self.delivered = 0
+        self.deferred = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def pending(self) -> int:
+        return sum(len(chat.queue) for chat in self._chats.values())
+
+    async def reserve_slot(self):
+        """Waits for a global send slot for a request made outside the queue (message edits), after queued messages."""
+        while True:
+            delay = self._global.delay(time.monotonic())
+            if delay <= 0 and not self._ready:
+                self._global.take(time.monotonic())
+                return
+            await asyncio.sleep(max(delay, 0.05))
+
+    async def send(self, chat_id, text: str, priority: int, kwargs: dict):
+        if self._task is None:
+            self._task = run_in_background(self._run())
+        future = asyncio.get_running_loop().create_future()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatOutbox()
+
+        message = _OutboundMessage(priority, text, kwargs, future)
+        tail = chat.queue[-1] if chat.queue else None
+        if (priority == PRIORITY_NOTIFICATION and tail is not None and tail.priority == PRIORITY_NOTIFICATION
+                and tail.key == message.key and len(tail.text) + len(text) + 2 <= self.MAX_TEXT_LENGTH):
+            tail.text = f"{tail.text}\n\n{text}"
+            tail.futures.append(future)
+            self.coalesced += 1
+        else:
+            chat.queue.append(message)
+            if not chat.busy:
+                self._schedule(chat_id, chat)
+        return await future
+
+    def _schedule(self, chat_id, chat: _ChatOutbox):
+        chat.busy = True
+        now = time.monotonic()
+        delay = max(chat.bucket.delay(now), chat.hold_until - now)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._push, chat_id, chat)
+        else:
+            self._push(chat_id, chat)
+
+    def _push(self, chat_id, chat: _ChatOutbox):
+        self._seq += 1
+        heapq.heappush(self._ready, (chat.queue[0].priority, self._seq, chat_id))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            while not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            delay = self._global.delay(time.monotonic())
+            if delay > 0:
+                # Re-pick after the wait: a higher-priority chat may have become ready
+                await asyncio.sleep(delay)
+                continue
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            now = time.monotonic()
+            self._global.take(now)
+            chat.bucket.take(now)
+            run_in_background(self._deliver(chat_id, chat, chat.queue.popleft()))
+
+    async def _deliver(self, chat_id, chat: _ChatOutbox, message: _OutboundMessage):
+        try:
+            result = await bot.deliver_message(chat_id, message.text, **message.kwargs)
+        except asyncio_helper.ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                chat.hold_until = time.monotonic() + retry_after
+                chat.queue.appendleft(message)
+                self.deferred += 1
+                logger.warning(f"Flood limit for chat {chat_id}: retrying in {retry_after}s.")
+            else:
+                self._fail(message, e)
+        except Exception as e:
+            self._fail(message, e)
+        else:
+            self.delivered += 1
+            for future in message.futures:
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            if chat.queue:
+                self._schedule(chat_id, chat)
+            else:
+                chat.busy = False
+
+    def _fail(self, message: _OutboundMessage, error: Exception):
+        self.failed += 1
+        for future in message.futures:
+            if not future.done():
+                future.set_exception(error)
+
+outbox = MessageScheduler()
+
+# --- Handler Metrics ---
+handler_stats: Dict[str, dict] = {}
+_current_handler_stats = contextvars.ContextVar("current_handler_stats", default=None)
+
+def track_handler(func):
+    """Records call count, DB mutations/writes and latency for an async handler."""
+    stats = handler_stats.setdefault(func.__name__, {
+        "calls": 0,
+        "db_mutations": 0,
+        "db_writes": 0,
+        "latencies": deque(maxlen=1000)
+    })
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = _current_handler_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            stats["calls"] += 1
+            stats["latencies"].append(time.perf_counter() - start)
+            _current_handler_stats.reset(token)
+    return wrapper
+
+def percentile(samples, fraction: float) -> float:
+    """Returns the given percentile (0..1) of a sample collection, 0.0 when empty."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
 
 def get_file_path(user_id: int, filename: str) -> str:
     """Returns file path under user's directory."""
@@ -36,80 +427,561 @@ def get_file_path(user_id: int, filename: str) -> str:
         os.makedirs(user_dir)
     return os.path.join(user_dir, filename)
 
+class ScriptLogBuffer:
+    """Byte-capped ring buffer of a script's output lines (the full output is in its <UID>.log)."""
+    def __init__(self, max_bytes: int = LOG_BUFFER_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_lines = 0 # Sequence number of the next appended line
+        self._lines = deque()
+        self._sizes = deque()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.eof = False # Set once the script's output stream is closed
+
+    def add_listener(self, callback):
+        """Registers a no-argument callback run (in the writer's thread) after each append and at EOF."""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _notify(self):
+        for callback in list(self._listeners):
+            callback()
+
+    def mark_eof(self):
+        """Records that no more output will arrive."""
+        self.eof = True
+        self._notify()
+
+    def append(self, line: str):
+        """Adds a line, evicting the oldest ones past max_bytes."""
+        size = len(line.encode('utf-8', 'replace'))
+        if size > self.max_bytes:
+            line = line[-self.max_bytes:]
+            size = len(line.encode('utf-8', 'replace'))
+        with self._lock:
+            self._lines.append(line)
+            self._sizes.append(size)
+            self._size += size
+            self.total_lines += 1
+            while self._size > self.max_bytes:
+                self._lines.popleft()
+                self._size -= self._sizes.popleft()
+        self._notify()
+
+    def tail(self, count: int) -> list:
+        """Returns the last `count` buffered lines."""
+        with self._lock:
+            start = max(0, len(self._lines) - count)
+            return list(islice(self._lines, start, None))
+
+    def lines_since(self, seq: int) -> Tuple[list, int]:
+        """
+        Returns lines appended after sequence `seq` (those still buffered) and the new sequence.
+        Walks from the newest end, so a reader that keeps up pays only for its new lines.
+        """
+        with self._lock:
+            first_seq = self.total_lines - len(self._lines)
+            count = self.total_lines - max(seq, first_seq)
+            if count <= 0:
+                return [], self.total_lines
+            lines = list(islice(reversed(self._lines), count))
+            lines.reverse()
+            return lines, self.total_lines
+
+def read_log_file_tail(path: str, count: int, max_bytes: int = LOG_BUFFER_MAX_BYTES) -> list:
+    """Returns the last `count` lines of a log file, reading at most max_bytes from its end."""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - max_bytes))
+            data = f.read()
+    except OSError:
+        return []
+    lines = data.decode('utf-8', 'replace').splitlines(keepends=True)
+    return lines[-count:]
+
+def get_script_log_tail(user_id: int, uid: str, count: int = LOG_TAIL_LINES) -> list:
+    """Last output lines of a script: live buffer if running, otherwise its on-disk log."""
+    if uid in running_processes:
+        _, log_buffer = running_processes[uid]
+        return log_buffer.tail(count)
+    return read_log_file_tail(get_file_path(user_id, f"{uid}.log"), count)
+
+def signal_process_group(process, sig: int):
+    """
+    Signals a hosted script and everything it spawned: scripts start in their own session, so their
+    PID is also their process group ID (which stays reserved while any member is alive).
+    """
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass # Whole group already gone
+    except PermissionError as e:
+        logger.error(f"Could not signal process group {process.pid}: {e}")
+
 def safe_terminate_process(uid: str) -> bool:
-    """Safely terminates a running process (subprocess.Popen)."""
+    """Safely terminates a running process (subprocess.Popen). Blocking: only for use outside the event loop."""
     if uid in running_processes:
-        process, q = running_processes[uid]
+        process, _ = running_processes[uid]
         if process.poll() is None:
-            process.terminate()
+            signal_process_group(process, signal.SIGTERM)
             try:
-                process.wait(timeout=5)
+                process.wait(timeout=TERMINATE_GRACE_PERIOD)
             except subprocess.TimeoutExpired:
-                process.kill()
+                pass
+        signal_process_group(process, signal.SIGKILL) # The leader and anything it left behind
                 
+        release_script_cgroup(uid)
         del running_processes[uid]
         logger.warning(f"Process for UID {uid} terminated and removed from tracking.")
         return True
     return False
 
-def terminate_all_user_scripts(user_id: int, db_data: dict) -> int:
+async def wait_for_exit(process: subprocess.Popen, timeout: float) -> bool:
+    """Awaits process exit without blocking the loop (pidfd when available). Returns True if it exited."""
+    if process.poll() is not None:
+        return True
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+
+    if pidfd is None:
+        deadline = loop.time() + timeout
+        while process.poll() is None:
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    exited = loop.create_future()
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await asyncio.wait_for(exited, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    return process.poll() is not None
+
+async def wait_for_group_exit(process, timeout: float) -> bool:
+    """Awaits the exit of every process in the script's group (reaping the leader). True if none is left."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        process.poll() # A zombie leader still counts as a group member
+        try:
+            os.killpg(process.pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            return False
+        if loop.time() >= deadline:
+            return False
+        await asyncio.sleep(0.05)
+
+async def terminate_process_async(uid: str) -> bool:
+    """Non-blocking terminate: SIGTERM, await exit, escalate to SIGKILL after TERMINATE_GRACE_PERIOD."""
+    if uid not in running_processes:
+        return False
+    # Untrack first so concurrent callers don't signal the same process twice
+    process, _ = running_processes.pop(uid)
+    await stop_process(uid, process)
+    logger.warning(f"Process for UID {uid} terminated and removed from tracking.")
+    return True
+
+async def stop_process(uid: str, process):
+    """Stops a script's process group (tracked or not) and removes its cgroup."""
+    if process.poll() is None:
+        signal_process_group(process, signal.SIGTERM)
+        await wait_for_exit(process, TERMINATE_GRACE_PERIOD)
+    # Children got SIGTERM with the leader; whatever is left of the group once it is gone (or the
+    # grace period ran out) is killed, so nothing outlives the script and its cgroup can be removed
+    signal_process_group(process, signal.SIGKILL)
+    await wait_for_group_exit(process, TERMINATE_GRACE_PERIOD)
+    release_script_cgroup(uid)
+
+async def terminate_processes(uids) -> int:
+    """Terminates many UIDs concurrently; total time is bounded by one grace period, not one per UID."""
+    results = await asyncio.gather(*(terminate_process_async(uid) for uid in uids))
+    return sum(results)
+
+async def terminate_all_user_scripts(user_id: int, db_data: dict) -> int:
     """Terminates all running scripts and deletes files for a given user."""
     terminated_count = 0
     uids_to_delete = list(db_data.get("hosted_scripts", {}).keys())
     
+    # 1. Terminate running processes (concurrently)
+    await terminate_processes(uids_to_delete)
+
     for uid in uids_to_delete:
-        # 1. Terminate running process
-        safe_terminate_process(uid)
-        
         # 2. Delete DB record and file (using DB manager's method)
         if db_manager.delete_script(user_id, uid):
              terminated_count += 1
              
+    db_manager.flush()
     return terminated_count
 
+UID_ALPHABET = string.ascii_uppercase + string.digits
+
 def generate_custom_uid():
-    """Generates a unique ID in the format R###J###."""
+    """Generates a unique ID in the format R###J### (6 random base-36 chars, ~31 bits)."""
     while True:
-        new_uid = f"R{uuid.uuid4().hex[:3].upper()}J{uuid.uuid4().hex[3:6].upper()}"
-        is_unique = True
-        
-        if 'db_manager' in globals():
-            for user_data in db_manager.data.values():
-                if new_uid in user_data.get("hosted_scripts", {}):
-                    is_unique = False
-                    break
-        if is_unique:
+        body = ''.join(secrets.choice(UID_ALPHABET) for _ in range(6))
+        new_uid = f"R{body[:3]}J{body[3:]}"
+        if 'db_manager' not in globals() or not db_manager.uid_exists(new_uid):
             return new_uid
 
+def normalize_approved_record(value) -> dict:
+    """Approval record in the current dict format from any legacy approved_users.json format."""
+    if isinstance(value, dict):
+        # New format: {'expiry': timestamp, 'name': name, 'max_scripts': int}
+        return value
+    if isinstance(value, list):
+        # Old format: [timestamp, first_name]
+        return {'expiry': value[0], 'name': value[1], 'max_scripts': 1}
+    # Very old format: timestamp
+    return {'expiry': value, 'name': 'Unknown User', 'max_scripts': 1}
+
+def write_json_atomic(path: str, obj):
+    """Writes JSON via temp file, fsync and rename, so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class JSONStorageBackend:
+    """Legacy backend: stores the whole script database as one JSON document."""
+    def __init__(self, path: str = DB_FILE, approved_path: str = APPROVED_USERS_FILE):
+        self.path = path
+        self.approved_path = approved_path
+        if not os.path.exists(self.path):
+            with open(self.path, 'w') as f:
+                json.dump({}, f)
+
+    def load(self) -> dict:
+        """Loads data from the JSON file."""
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+             logger.error("DB file is corrupt. Resetting to empty dictionary.")
+             return {}
+        except FileNotFoundError:
+             return {}
+
+    def persist(self, data: dict, dirty_users: set, dirty_scripts: set, deleted_scripts: set):
+        """Atomically rewrites the whole file (temp file, fsync, rename); change sets are unused."""
+        write_json_atomic(self.path, data)
+
+    def load_approved(self) -> Dict[int, dict]:
+        try:
+            with open(self.approved_path, 'r') as f:
+                return {int(k): normalize_approved_record(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError, TypeError, IndexError, AttributeError) as e: # Malformed legacy records or file
+            if os.path.exists(self.approved_path):
+                logger.error(f"Error loading approved users: {e}")
+            return {}
+
+    def persist_approved(self, approved: Dict[int, dict], user_ids=None):
+        """Atomically rewrites the approved users file; user_ids is unused."""
+        write_json_atomic(self.approved_path, {str(k): v for k, v in approved.items()})
+
+
+class SQLiteStorageBackend:
+    """Stores users and scripts as indexed rows in SQLite (WAL mode), one transaction per save."""
+    SCRIPT_COLUMNS = ("display_name", "file_name", "status", "process_id")
+
+    def __init__(self, path: str = SQLITE_DB_FILE):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE TABLE IF NOT EXISTS scripts (
+                uid TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                display_name TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                process_id INTEGER NOT NULL DEFAULT 0,
+                extra TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE INDEX IF NOT EXISTS idx_scripts_user ON scripts(user_id);
+            CREATE INDEX IF NOT EXISTS idx_scripts_status ON scripts(status);
+            CREATE TABLE IF NOT EXISTS approved_users (
+                user_id INTEGER PRIMARY KEY,
+                expiry REAL NOT NULL,
+                name TEXT NOT NULL,
+                max_scripts INTEGER NOT NULL DEFAULT 1,
+                limits TEXT
+            );
+        """)
+
+    def load(self) -> dict:
+        """Rebuilds the in-memory user -> scripts mapping from the tables."""
+        data = {}
+        for user_id_str, state in self.conn.execute("SELECT user_id, state FROM users"):
+            user_data = json.loads(state)
+            user_data["hosted_scripts"] = {}
+            data[user_id_str] = user_data
+        rows = self.conn.execute(
+            "SELECT uid, user_id, display_name, file_name, status, process_id, extra FROM scripts"
+        )
+        for uid, user_id_str, display_name, file_name, status, process_id, extra in rows:
+            script = json.loads(extra)
+            script.update({
+                "display_name": display_name,
+                "file_name": file_name,
+                "status": status,
+                "process_id": process_id
+            })
+            data[user_id_str]["hosted_scripts"][uid] = script
+        return data
+
+    def _user_row(self, user_id_str: str, user_data: dict) -> tuple:
+        state = {k: v for k, v in user_data.items() if k != "hosted_scripts"}
+        return (user_id_str, json.dumps(state))
+
+    def _script_row(self, user_id_str: str, uid: str, script: dict) -> tuple:
+        extra = {k: v for k, v in script.items() if k not in self.SCRIPT_COLUMNS}
+        return (
+            uid, user_id_str, script["display_name"], script["file_name"],
+            script["status"], script.get("process_id", 0), json.dumps(extra)
+        )
+
+    def persist(self, data: dict, dirty_users: set, dirty_scripts: set, deleted_scripts: set):
+        """Writes only the changed rows, atomically."""
+        user_rows = [self._user_row(u, data[u]) for u in dirty_users if u in data]
+        script_rows = []
+        for user_id_str, uid in dirty_scripts:
+            script = data.get(user_id_str, {}).get("hosted_scripts", {}).get(uid)
+            if script is not None:
+                script_rows.append(self._script_row(user_id_str, uid, script))
+
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT INTO users (user_id, state) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET state = excluded.state",
+                user_rows
+            )
+            self.conn.executemany(
+                "INSERT INTO scripts (uid, user_id, display_name, file_name, status, process_id, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(uid) DO UPDATE SET "
+                "user_id = excluded.user_id, display_name = excluded.display_name, "
+                "file_name = excluded.file_name, status = excluded.status, "
+                "process_id = excluded.process_id, extra = excluded.extra",
+                script_rows
+            )
+            self.conn.executemany(
+                "DELETE FROM scripts WHERE uid = ?",
+                [(uid,) for _, uid in deleted_scripts]
+            )
+
+    def load_approved(self) -> Dict[int, dict]:
+        approved = {}
+        for user_id, expiry, name, max_scripts, limits in self.conn.execute(
+            "SELECT user_id, expiry, name, max_scripts, limits FROM approved_users"
+        ):
+            record = {'expiry': expiry, 'name': name, 'max_scripts': max_scripts}
+            if limits is not None:
+                record['limits'] = json.loads(limits)
+            approved[user_id] = record
+        return approved
+
+    def persist_approved(self, approved: Dict[int, dict], user_ids=None):
+        """Upserts the given users' rows (deleting those no longer approved) in one transaction; replaces all rows when user_ids is None."""
+        replace_all = user_ids is None
+        rows, deleted = [], []
+        for user_id in approved if replace_all else user_ids:
+            record = approved.get(user_id)
+            if record is None:
+                deleted.append((user_id,))
+                continue
+            limits = record.get('limits')
+            rows.append((
+                user_id, float(record['expiry']), record.get('name') or 'Unknown User',
+                int(record.get('max_scripts', 1)), json.dumps(limits) if limits is not None else None
+            ))
+        with self.conn:
+            self.conn.execute("BEGIN")
+            if replace_all:
+                self.conn.execute("DELETE FROM approved_users")
+            self.conn.executemany(
+                "INSERT INTO approved_users (user_id, expiry, name, max_scripts, limits) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET expiry = excluded.expiry, name = excluded.name, "
+                "max_scripts = excluded.max_scripts, limits = excluded.limits",
+                rows
+            )
+            self.conn.executemany("DELETE FROM approved_users WHERE user_id = ?", deleted)
+
+    def migrate_approved_from_json(self, json_path: str = APPROVED_USERS_FILE) -> int:
+        """One-shot import of approved_users.json (any legacy format) into an empty approved_users table."""
+        if not os.path.exists(json_path):
+            return 0
+        if self.conn.execute("SELECT 1 FROM approved_users LIMIT 1").fetchone():
+            return 0
+        try:
+            with open(json_path, 'r') as f:
+                legacy = {int(k): normalize_approved_record(v) for k, v in json.load(f).items()}
+        except (ValueError, TypeError, IndexError, AttributeError) as e:
+            logger.error(f"Approved users file {json_path} is corrupt ({e}). Skipping migration and leaving it in place.")
+            return 0
+        self.persist_approved(legacy)
+        os.replace(json_path, json_path + ".migrated")
+        logger.warning(f"Migrated {len(legacy)} approved users from {json_path} to SQLite.")
+        return len(legacy)
+
+    def migrate_from_json(self, json_path: str = DB_FILE) -> int:
+        """One-shot import of the legacy JSON file into an empty SQLite database."""
+        if not os.path.exists(json_path):
+            return 0
+        if self.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            return 0
+        try:
+            with open(json_path, 'r') as f:
+                legacy = json.load(f)
+        except json.JSONDecodeError:
+            logger.error(f"Legacy DB file {json_path} is corrupt. Skipping migration and leaving it in place.")
+            return 0
+
+        dirty_users = set(legacy.keys())
+        dirty_scripts = {
+            (user_id_str, uid)
+            for user_id_str, user_data in legacy.items()
+            for uid in user_data.get("hosted_scripts", {})
+        }
+        self.persist(legacy, dirty_users, dirty_scripts, set())
+        os.replace(json_path, json_path + ".migrated")
+        logger.warning(f"Migrated {len(dirty_users)} users and {len(dirty_scripts)} scripts from {json_path} to SQLite.")
+        return len(dirty_scripts)
+
+
+def create_storage_backend():
+    """Builds the storage backend selected by DB_BACKEND."""
+    if DB_BACKEND == "json":
+        return JSONStorageBackend(DB_FILE)
+    backend = SQLiteStorageBackend(SQLITE_DB_FILE)
+    backend.migrate_from_json(DB_FILE)
+    backend.migrate_approved_from_json(APPROVED_USERS_FILE)
+    return backend
+
+
 class ScriptDB:
-    """Manages script data persistence and user states using a JSON file."""
-    def __init__(self):
+    """Manages script data persistence and user states through a pluggable storage backend."""
+    def __init__(self, backend=None):
         self._ensure_db_exists()
+        self.backend = backend or create_storage_backend()
+        self._dirty_users = set()
+        self._dirty_scripts = set()
+        self._deleted_scripts = set()
+        self._flush_handle = None
+        self.mutation_count = 0
+        self.write_count = 0
+        self._versions: Dict[str, int] = {} # Per-user counter of script changes (listing cache keys)
         self._load_data()
 
     def _ensure_db_exists(self):
-        """Ensures the database file and hosting directory exist."""
-        if not os.path.exists(DB_FILE):
-            with open(DB_FILE, 'w') as f:
-                json.dump({}, f)
+        """Ensures the hosting directory exists (the backend creates its own storage)."""
         if not os.path.exists(HOSTING_DIR):
             os.makedirs(HOSTING_DIR)
 
     def _load_data(self):
-        """Loads data from the JSON file."""
-        try:
-            with open(DB_FILE, 'r') as f:
-                self.data = json.load(f)
-        except json.JSONDecodeError:
-             logger.error("DB file is corrupt. Resetting to empty dictionary.")
-             self.data = {}
-        except FileNotFoundError:
-             self.data = {}
-             
+        """Loads data from the storage backend, dropping legacy conversation-state keys."""
+        self.data = self.backend.load()
+        # Global uid -> (user_id_str, script) index for O(1) lookups without the owner's ID
+        self._uid_index: Dict[str, Tuple[str, dict]] = {}
+        for user_id_str, user_data in self.data.items():
+            for uid, script in user_data.get("hosted_scripts", {}).items():
+                self._uid_index[uid] = (user_id_str, script)
+            stale_keys = [k for k in user_data if k in ConversationState.__slots__]
+            for key in stale_keys:
+                del user_data[key]
+            if stale_keys:
+                self._mark_user(user_id_str)
+
     def _save_data(self):
-        """Saves current data back to the JSON file."""
-        with open(DB_FILE, 'w') as f:
-            json.dump(self.data, f, indent=4)
+        """Marks the store dirty; the write itself is coalesced by the flusher."""
+        self.mutation_count += 1
+        stats = _current_handler_stats.get()
+        if stats is not None:
+            stats["db_mutations"] += 1
+
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop yet (startup/shutdown): write through.
+            self.flush()
+            return
+        # Empty context so the deferred write is not counted against the handler that scheduled it
+        self._flush_handle = loop.call_later(DB_FLUSH_WINDOW, self.flush, context=contextvars.Context())
+
+    def flush(self):
+        """Writes all pending changes now. Barrier for critical paths."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not (self._dirty_users or self._dirty_scripts or self._deleted_scripts):
+            return
+
+        try:
+            self.backend.persist(self.data, self._dirty_users, self._dirty_scripts, self._deleted_scripts)
+        except Exception as e:
+            # Keep the change sets so the next flush retries them
+            logger.error(f"Error persisting script DB: {e}")
+            return
+        self._dirty_users.clear()
+        self._dirty_scripts.clear()
+        self._deleted_scripts.clear()
+
+        self.write_count += 1
+        stats = _current_handler_stats.get()
+        if stats is not None:
+            stats["db_writes"] += 1
+
+    def load_approved_users(self) -> Dict[int, dict]:
+        return self.backend.load_approved()
+
+    def save_approved_users(self, approved: Dict[int, dict], user_ids=None):
+        """Writes approval records through immediately, in one transaction (not batched with script writes)."""
+        try:
+            self.backend.persist_approved(approved, user_ids)
+        except Exception as e:
+            logger.error(f"Error saving approved users: {e}")
+
+    def _mark_user(self, user_id_str):
+        self._dirty_users.add(user_id_str)
+
+    def _mark_script(self, user_id_str, uid):
+        self._deleted_scripts.discard((user_id_str, uid))
+        self._dirty_scripts.add((user_id_str, uid))
+        self._versions[user_id_str] = self._versions.get(user_id_str, 0) + 1
+
+    def _mark_deleted(self, user_id_str, uid):
+        self._dirty_scripts.discard((user_id_str, uid))
+        self._deleted_scripts.add((user_id_str, uid))
+        self._versions[user_id_str] = self._versions.get(user_id_str, 0) + 1
+
+    def scripts_version(self, user_id) -> int:
+        """Changes whenever one of the user's scripts is added, updated or deleted."""
+        return self._versions.get(str(user_id), 0)
     
     def all_users_data(self):
         """Returns the entire data dictionary."""
@@ -124,37 +996,52 @@ class ScriptDB:
         user_id_str = str(user_id)
         if user_id_str not in self.data:
             self.data[user_id_str] = {
-                "current_process": "IDLE",
-                "pending_file_name": None, 
-                "pending_file_name_on_disk": None, 
-                "pending_update_uid": None,
                 "hosted_scripts": {}
             }
+            self._mark_user(user_id_str)
             self._save_data()
         return self.data[user_id_str]
 
+    def get_user_scripts(self, user_id) -> dict:
+        """Returns a user's hosted scripts without creating a record for unknown users."""
+        user_data = self.data.get(str(user_id))
+        return user_data["hosted_scripts"] if user_data else {}
+
     def update_user_state(self, user_id, key, value):
         """Updates a key in the user's state."""
         user_id_str = str(user_id)
         if user_id_str in self.data:
             self.data[user_id_str][key] = value
+            self._mark_user(user_id_str)
             self._save_data()
 
+    def uid_exists(self, uid) -> bool:
+        """Constant-time UID uniqueness check."""
+        return uid in self._uid_index
+
+    def find_script(self, uid):
+        """Returns (user_id_str, script) for a UID regardless of owner, or None."""
+        return self._uid_index.get(uid)
+
     def get_script_by_uid(self, user_id, uid):
-        """Fetches a script's data using its UID."""
-        user_data = self.get_user_data(user_id)
-        return user_data["hosted_scripts"].get(uid)
+        """Fetches a script's data using its UID (user_id=None skips the ownership check)."""
+        entry = self._uid_index.get(uid)
+        if entry is None or (user_id is not None and entry[0] != str(user_id)):
+            return None
+        return entry[1]
 
     def update_script_data(self, user_id, uid, key, value):
-        """Updates a specific property of a hosted script."""
-        user_data = self.get_user_data(user_id)
-        if uid in user_data["hosted_scripts"]:
-            user_data["hosted_scripts"][uid][key] = value
-            self._save_data()
-            return True
-        return False
+        """Updates a specific property of a hosted script (user_id=None skips the ownership check)."""
+        entry = self._uid_index.get(uid)
+        if entry is None or (user_id is not None and entry[0] != str(user_id)):
+            return False
+        user_id_str, script = entry
+        script[key] = value
+        self._mark_script(user_id_str, uid) # The owner from the index, also when user_id is None
+        self._save_data()
+        return True
         
-    def add_new_script(self, user_id, uid, display_name, file_name): 
+    def add_new_script(self, user_id, uid, display_name, file_name, content_hash=None): 
         """Adds a new hosted script entry."""
         user_data = self.get_user_data(user_id)
         user_data["hosted_scripts"][uid] = {
@@ -163,6 +1050,10 @@ class ScriptDB:
             "status": "Running",
             "process_id": 0 # Restore PID tracking for subprocess
         }
+        if content_hash:
+            user_data["hosted_scripts"][uid]["content_hash"] = content_hash # Blob in blob_store
+        self._uid_index[uid] = (str(user_id), user_data["hosted_scripts"][uid])
+        self._mark_script(str(user_id), uid)
         self._save_data()
 
     def delete_script(self, user_id, uid):
@@ -170,70 +1061,166 @@ class ScriptDB:
         user_data = self.get_user_data(user_id)
         if uid in user_data["hosted_scripts"]:
             script_data = user_data["hosted_scripts"].pop(uid)
+            self._uid_index.pop(uid, None)
+            self._mark_deleted(str(user_id), uid)
             self._save_data()
             
-            # Delete physical file
+            # Delete physical file (or the whole extracted project, stored as "<UID>/.../entry.py")
+            if '/' in script_data['file_name']:
+                project_dir = get_file_path(user_id, script_data['file_name'].split('/')[0])
+                shutil.rmtree(project_dir, ignore_errors=True)
+                logger.warning(f"Project {project_dir} deleted for UID {uid}.")
             file_path = get_file_path(user_id, script_data['file_name'])
             if os.path.exists(file_path):
                 os.remove(file_path)
                 logger.warning(f"File {file_path} deleted for UID {uid}.")
+            if script_data.get('content_hash'):
+                blob_store.release(script_data['content_hash'])
+            for log_path in glob.glob(get_file_path(user_id, f"{uid}.log*")):
+                os.remove(log_path)
+            log_archive.purge(user_id, uid)
             return True
         return False
 
 
+# --- Conversation State (in-memory, never written to ScriptDB) ---
+class ConversationState:
+    """Transient per-user state of the multi-step button flows."""
+    __slots__ = (
+        "current_process",
+        "pending_file_name",
+        "pending_file_name_on_disk",
+        "pending_update_uid",
+        "admin_target_id",
+        "admin_target_step",
+        "expires_at"
+    )
+
+    def __init__(self):
+        self.current_process = "IDLE"
+        self.pending_file_name = None
+        self.pending_file_name_on_disk = None
+        self.pending_update_uid = None
+        self.admin_target_id = None
+        self.admin_target_step = None
+        self.expires_at = 0.0
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+class ConversationStateManager:
+    """Holds ConversationState per user with TTL expiry and an optional disk snapshot."""
+    def __init__(self, ttl: float = CONVERSATION_TTL, snapshot_path: str | None = CONVERSATION_SNAPSHOT_FILE):
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self._states: Dict[int, ConversationState] = {}
+
+    def get(self, user_id: int) -> ConversationState:
+        """Returns the user's live state, or a fresh (untracked) IDLE one if absent or expired."""
+        state = self._states.get(user_id)
+        if state is None or state.expires_at <= time.monotonic():
+            self._states.pop(user_id, None)
+            return ConversationState()
+        return state
+
+    def update(self, user_id: int, **fields):
+        """Sets state fields and refreshes the TTL."""
+        state = self._states.get(user_id)
+        if state is None or state.expires_at <= time.monotonic():
+            state = ConversationState()
+            self._states[user_id] = state
+        for key, value in fields.items():
+            setattr(state, key, value)
+        state.expires_at = time.monotonic() + self.ttl
+
+    def reset(self, user_id: int):
+        """Drops the user's state; the next get() returns IDLE."""
+        self._states.pop(user_id, None)
+
+    def sweep(self) -> int:
+        """Removes expired states and returns how many were dropped."""
+        now = time.monotonic()
+        expired = [user_id for user_id, state in self._states.items() if state.expires_at <= now]
+        for user_id in expired:
+            del self._states[user_id]
+        return len(expired)
+
+    def save_snapshot(self):
+        """Writes live states to the snapshot file (remaining TTL, not monotonic time)."""
+        if not self.snapshot_path:
+            return
+        now = time.monotonic()
+        snapshot = {}
+        for user_id, state in self._states.items():
+            if state.expires_at > now:
+                record = state.to_dict()
+                record["expires_at"] = state.expires_at - now
+                snapshot[str(user_id)] = record
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def load_snapshot(self):
+        """Restores states saved by save_snapshot(), if the snapshot file exists."""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Error loading conversation snapshot: {e}")
+            return
+        now = time.monotonic()
+        for user_id_str, record in snapshot.items():
+            state = ConversationState()
+            for key in ConversationState.__slots__:
+                if key in record:
+                    setattr(state, key, record[key])
+            state.expires_at = now + record.get("expires_at", 0)
+            self._states[int(user_id_str)] = state
+
+    async def run_sweeper(self, interval: float = 60):
+        """Periodically drops expired states and refreshes the snapshot."""
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+            try:
+                self.save_snapshot()
+            except OSError as e:
+                logger.error(f"Error saving conversation snapshot: {e}")
+
+
 db_manager = ScriptDB()
+conversations = ConversationStateManager()
 
 def load_approved_users():
-    """Loads approved users from JSON file."""
+    """Loads approved users from the storage backend (legacy file formats are converted once, at migration)."""
     global approved_users
-    if os.path.exists(APPROVED_USERS_FILE):
-        try:
-            with open(APPROVED_USERS_FILE, 'r') as f:
-                data = json.load(f)
-                approved_users = {}
-                for k, v in data.items():
-                    user_id = int(k)
-                    # Handle different format loading for max_scripts compatibility
-                    if isinstance(v, dict):
-                         # New format: {'expiry': timestamp, 'name': name, 'max_scripts': int}
-                        approved_users[user_id] = v
-                    elif isinstance(v, list):
-                        # Old format: [timestamp, first_name]
-                        approved_users[user_id] = {
-                            'expiry': v[0], 
-                            'name': v[1], 
-                            'max_scripts': 1 # Default max_scripts for old users
-                        }
-                    else:
-                        # Very old format: timestamp
-                        approved_users[user_id] = {
-                            'expiry': v, 
-                            'name': 'Unknown User', 
-                            'max_scripts': 1 # Default max_scripts
-                        }
-
-                # Exclude owner from approved_users list
-                if OWNER_ID in approved_users:
-                    del approved_users[OWNER_ID]
-                    logger.warning("Owner ID removed from approved users list during load.")
-
-                logger.warning(f"Loaded {len(approved_users)} approved users.")
-        except Exception as e:
-            logger.error(f"Error loading approved users: {e}")
+    approved_users = db_manager.load_approved_users()
 
-def save_approved_users():
-    """Saves approved users to JSON file (NEW DICT FORMAT)."""
-    try:
-        # Save in the dictionary format: {user_id: {'expiry': timestamp, 'name': name, 'max_scripts': int}}
-        data_to_save = {
-            str(k): v 
-            for k, v in approved_users.items()
-        }
-        with open(APPROVED_USERS_FILE, 'w') as f:
-            json.dump(data_to_save, f)
-        logger.warning("Saved approved users to file.")
-    except Exception as e:
-            logger.error(f"Error saving approved users: {e}")
+    # Exclude owner from approved_users list
+    if OWNER_ID in approved_users:
+        del approved_users[OWNER_ID]
+        save_approved_users(OWNER_ID)
+        logger.warning("Owner ID removed from approved users list during load.")
+    # Approvals used to copy the defaults into 'limits'; drop those so DEFAULT_SCRIPT_LIMITS applies to them
+    copied = [user_id for user_id, record in approved_users.items() if record.get('limits') == COPIED_DEFAULT_LIMITS]
+    for user_id in copied:
+        del approved_users[user_id]['limits']
+    if copied:
+        save_approved_users(*copied)
+        logger.warning(f"Removed copied default limits from {len(copied)} approved users.")
+    authorization.rebuild()
+    listings.invalidate_approved()
+    logger.warning(f"Loaded {len(approved_users)} approved users.")
+
+def save_approved_users(*user_ids: int):
+    """Persists the given users' approval records (every record when none are given)."""
+    db_manager.save_approved_users(approved_users, set(user_ids) if user_ids else None)
+    listings.invalidate_approved()
+    logger.warning("Saved approved users.")
 
 def is_owner(user_id: int) -> bool:
     """Checks if user is bot owner."""
@@ -245,17 +1232,110 @@ def is_authorized(user_id: int) -> bool:
     if is_owner(user_id):
         return True
     
-    # Check approved users
-    if user_id in approved_users:
-        expiration_time = datetime.fromtimestamp(approved_users[user_id]['expiry'], tz=timezone.utc)
-        if expiration_time > datetime.now(timezone.utc):
-            return True
-        else:
-            logger.warning(f"Access expired for user ID: {user_id}. Removing...")
-            del approved_users[user_id]
-            save_approved_users() 
-            return False
-    return False
+    # Approved users: a cached monotonic deadline; revocation happens in AuthorizationCache.run
+    return authorization.is_active(user_id)
+
+class AuthorizationCache:
+    """
+    Monotonic access deadlines for approved users, so is_authorized is one dict lookup. A background
+    task pops a heap ordered by expiry, revokes users on time (stopping their scripts) and batches
+    the resulting approved_users writes. Call refresh(user_id) after changing approved_users.
+    """
+    def __init__(self):
+        self._deadlines: Dict[int, float] = {}
+        self._heap = [] # (monotonic deadline, user_id, expiry timestamp); stale entries are skipped
+        self._wakeup = asyncio.Event()
+        self._save_handle = None
+        self._pending_saves = set()
+        self.revoked = 0
+
+    def refresh(self, user_id: int):
+        data = approved_users.get(user_id)
+        if data is None:
+            self._deadlines.pop(user_id, None)
+            return
+        deadline = time.monotonic() + (data['expiry'] - time.time())
+        self._deadlines[user_id] = deadline
+        heapq.heappush(self._heap, (deadline, user_id, data['expiry']))
+        self._wakeup.set()
+
+    def rebuild(self):
+        self._deadlines.clear()
+        self._heap.clear()
+        for user_id in approved_users:
+            self.refresh(user_id)
+
+    def is_active(self, user_id: int) -> bool:
+        deadline = self._deadlines.get(user_id)
+        return deadline is not None and time.monotonic() < deadline
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._heap[0][0] - time.monotonic() if self._heap else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, user_id, expiry = heapq.heappop(self._heap)
+            data = approved_users.get(user_id)
+            if data is None or data['expiry'] != expiry:
+                continue # Renewed or unapproved since this entry was pushed
+            try:
+                await self._revoke(user_id, data)
+            except Exception as e:
+                logger.error(f"Error revoking expired access for {user_id}: {e}")
+
+    async def _revoke(self, user_id: int, data: dict):
+        logger.warning(f"Access expired for user ID: {user_id}. Removing...")
+        del approved_users[user_id]
+        self._deadlines.pop(user_id, None)
+        self.revoked += 1
+        self._pending_saves.add(user_id)
+        listings.invalidate_approved()
+        self.schedule_save()
+
+        user_scripts = db_manager.get_user_scripts(user_id)
+        active = [uid for uid, script in user_scripts.items() if uid in running_processes or script['status'] in ('Running', 'Restarting')]
+        # Processes that survived a bot restart are not reattached for expired users (see main()):
+        # adopt them by PID + start time so they are stopped instead of losing their PID below
+        untracked = [(uid, adopt_process(user_scripts[uid])) for uid in active if uid not in running_processes]
+        await asyncio.gather(
+            terminate_processes(active),
+            *(stop_process(uid, process) for uid, process in untracked if process is not None)
+        )
+        for uid in active:
+            db_manager.update_script_data(user_id, uid, "status", "Paused")
+            db_manager.update_script_data(user_id, uid, "process_id", 0)
+        try:
+            await bot.send_message(
+                user_id,
+                f"⌛ **Access Expired.**\n\nYour hosting access has ended" + (f" and **{len(active)}** running script(s) were **paused**." if active else ".") + " Contact the owner to renew it.",
+                parse_mode="Markdown", priority=PRIORITY_NOTIFICATION
+            )
+        except Exception as e:
+            logger.error(f"Could not send expiry notice to {user_id}: {e}")
+
+    def schedule_save(self):
+        """Coalesces approved_users writes from a burst of expiries into one save."""
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_running_loop().call_later(DB_FLUSH_WINDOW, self._save)
+
+    def _save(self):
+        self._save_handle = None
+        if self._pending_saves:
+            pending, self._pending_saves = self._pending_saves, set()
+            save_approved_users(*pending)
+
+    def flush(self):
+        """Writes any revocations still waiting on the coalescing window (used at shutdown)."""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+        self._save()
+
+authorization = AuthorizationCache()
 
 def parse_time_duration(duration_str: str) -> timedelta | None:
     """Parses duration string like '1h', '3d', '2w', '5m'."""
@@ -289,6 +1369,66 @@ class AuthFilter(asyncio_filters.AdvancedCustomFilter):
         return is_authorized(message.from_user.id)
 
 bot.add_custom_filter(AuthFilter())
+def read_startup_options(local_path: str) -> Tuple[str | None, float]:
+    """Reads optional '# ready-marker: <text>' and '# capture-window: <seconds>' headers from a script."""
+    ready_marker = None
+    capture_window = STARTUP_CAPTURE_WINDOW
+    try:
+        with open(local_path, 'r', encoding='utf-8', errors='replace') as f:
+            header = list(islice(f, 20))
+    except OSError:
+        return ready_marker, capture_window
+
+    for line in header:
+        key, _, value = line.strip().lstrip('#').partition(':')
+        key, value = key.strip().lower(), value.strip()
+        if not line.lstrip().startswith('#') or not value:
+            continue
+        if key == 'ready-marker':
+            ready_marker = value
+        elif key == 'capture-window':
+            try:
+                capture_window = min(max(float(value), 0.0), STARTUP_CAPTURE_MAX_WINDOW)
+            except ValueError:
+                pass
+    return ready_marker, capture_window
+
+async def capture_startup_output(process: subprocess.Popen, log_buffer: ScriptLogBuffer, window: float, ready_marker: str | None = None) -> list:
+    """Collects output until the process exits, a line contains ready_marker, or `window` seconds pass."""
+    loop = asyncio.get_running_loop()
+    output_event = asyncio.Event()
+    notify = lambda: loop.call_soon_threadsafe(output_event.set)
+    log_buffer.add_listener(notify)
+    exit_task = asyncio.ensure_future(wait_for_exit(process, window))
+    deadline = loop.time() + window
+    exited = False
+    lines, seq = [], 0
+    try:
+        while True:
+            output_event.clear()
+            new_lines, seq = log_buffer.lines_since(seq)
+            lines.extend(new_lines)
+            if log_buffer.eof or (ready_marker and any(ready_marker in line for line in new_lines)):
+                break
+            if not exited and exit_task.done() and exit_task.result():
+                # Exited: give the pump a moment to deliver the final output
+                exited = True
+                deadline = min(deadline, loop.time() + 0.2)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            output_wait = asyncio.ensure_future(output_event.wait())
+            waiters = {output_wait} if exit_task.done() else {output_wait, exit_task}
+            await asyncio.wait(waiters, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            output_wait.cancel()
+        if log_buffer.eof:
+            # Output closed: the process is exiting, let it be reaped so poll() reports it
+            await wait_for_exit(process, 0.5)
+    finally:
+        log_buffer.remove_listener(notify)
+        exit_task.cancel()
+    return lines
+
 async def start_script(user_id: int, uid: str, script_data: dict, chat_id: int, silent_start: bool = False):
     """
     Starts a paused or new script using subprocess (Non-Docker).
@@ -297,8 +1437,8 @@ async def start_script(user_id: int, uid: str, script_data: dict, chat_id: int,
     
     file_name_on_disk = script_data['file_name']
     display_name = script_data['display_name']
-    user_dir = os.path.join(HOSTING_DIR, str(user_id))
     local_path = get_file_path(user_id, file_name_on_disk)
+    script_dir = os.path.dirname(local_path) # The user's directory, or the project's for archives
 
     # --- FILE EXISTENCE CHECK ---
     if not os.path.exists(local_path):
@@ -318,45 +1458,49 @@ async def start_script(user_id: int, uid: str, script_data: dict, chat_id: int,
         return
 
     try:
-        command = ['python', file_name_on_disk] 
+        command = [await get_script_interpreter(user_id), os.path.basename(file_name_on_disk)] 
+        limits = get_script_limits(user_id, script_data)
+        cgroup_dir = create_script_cgroup(uid, limits)
         
-        process = subprocess.Popen(
-            command,
-            cwd=user_dir,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-            universal_newlines=True
-        )
+        # Output goes to a file in the script's own session, so it outlives a bot restart (see reattach_scripts)
+        log_path = get_file_path(user_id, f"{uid}.log")
+        with open(log_path, 'ab') as log_file:
+            log_offset = os.fstat(log_file.fileno()).st_size
+            process = subprocess.Popen(
+                limited_command(command, limits),
+                cwd=script_dir,
+                preexec_fn=build_limits_preexec(limits, cgroup_dir),
+                start_new_session=True,
+                stdin=subprocess.DEVNULL,
+                stdout=log_file, 
+                stderr=subprocess.STDOUT,
+                env={**os.environ, "PYTHONUNBUFFERED": "1"} # Output reaches the log file as it is printed
+            )
         
-        q = queue.Queue()
-        reader_thread = threading.Thread(target=read_script_output, args=(process, q), daemon=True)
-        reader_thread.start()
+        log_buffer = ScriptLogBuffer(LOG_BUFFER_MAX_BYTES)
+        output_pump.watch(log_path, log_offset, process, log_buffer)
         
         # Update Tracking and DB
-        running_processes[uid] = (process, q)
+        running_processes[uid] = (process, log_buffer)
         db_manager.update_script_data(user_id, uid, "status", "Running")
         db_manager.update_script_data(user_id, uid, "process_id", process.pid)
+        db_manager.update_script_data(user_id, uid, "process_start", read_proc_start_time(process.pid))
         
-        # Capture Initial Output (Original 1-second capture logic)
-        initial_lines = []
-        start = time.time()
-        
-        while time.time() - start < 1: 
-            try:
-                line = q.get_nowait()
-                initial_lines.append(line)
-            except queue.Empty:
-                await asyncio.sleep(0.05) 
+        # Capture Initial Output (until exit, readiness marker or deadline)
+        ready_marker, capture_window = read_startup_options(local_path)
+        initial_lines = await capture_startup_output(process, log_buffer, capture_window, ready_marker)
         
         script_output = "".join(initial_lines).strip()
         
         # Check if it terminated immediately
-        if process.poll() is not None:
-            safe_terminate_process(uid)
-            db_manager.update_script_data(user_id, uid, "status", "Stopped")
+        if process.poll() is not None and silent_start:
+            # Unattended starts (boot, auto-restart) follow the script's restart policy
+            await supervisor.handle_exit(uid, process)
+
+        elif process.poll() is not None:
+            exit_status = describe_exit(uid, process, initial_lines)
+            await terminate_process_async(uid)
+            db_manager.update_script_data(user_id, uid, "status", exit_status)
             
             if not silent_start:
                 final_output = script_output or "No output."
@@ -364,7 +1508,9 @@ async def start_script(user_id: int, uid: str, script_data: dict, chat_id: int,
                 if "error" in script_output.lower() or "exception" in script_output.lower() or process.returncode != 0:
                     await bot.send_message(
                         chat_id,
-                        f"❌ **Execution Failed!**\n\nProject **{display_name}** (`{uid}`) failed immediately upon start.\n\n**Error Output:**\n``{final_output}``",
+                        f"❌ **Execution Failed!**\n\nProject **{display_name}** (`{uid}`) failed immediately upon start.\n\n"
+                        + (f"**Reason:** {exit_status}\n\n" if exit_status.startswith('Killed') else "")
+                        + f"**Error Output:**\n``{final_output}``",
                         parse_mode="Markdown", reply_markup=build_main_keyboard()
                     )
                 else:
@@ -375,6 +1521,7 @@ async def start_script(user_id: int, uid: str, script_data: dict, chat_id: int,
                     )
 
         else:
+            supervisor.watch(uid, process)
             if not silent_start:
                 output_msg = (
                     f"🚀 **Started Successfully!**\n\nProject **{display_name}** (`{uid}`) is now **Running**.\n\n"
@@ -384,80 +1531,1712 @@ async def start_script(user_id: int, uid: str, script_data: dict, chat_id: int,
                 else:
                      output_msg += "✅ Your bot is now online"
 
-                await bot.send_message(chat_id, output_msg, parse_mode="Markdown", reply_markup=build_main_keyboard())
+                await bot.send_message(chat_id, output_msg, parse_mode="Markdown", reply_markup=build_main_keyboard())
+
+    except Exception as e:
+        logger.error(f"Error running script {file_name_on_disk} for user {user_id}: {e}")
+        db_manager.update_script_data(user_id, uid, "status", "Error")
+        if not silent_start:
+            await bot.send_message(chat_id, f"❌ An unexpected error occurred while running the script: ``{e}``", parse_mode="Markdown")
+        
+
+
+# --- File Management Utilities (RESTORED) ---
+# --- Log Archive ---
+def format_log_timestamp(ts: float) -> bytes:
+    """Sortable UTC prefix of archived lines, e.g. b'2025-01-31T12:00:00.000Z' (24 bytes)."""
+    return (datetime.fromtimestamp(ts, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S') + f".{int(ts * 1000) % 1000:03d}Z").encode()
+
+def parse_log_timestamp(line: bytes) -> float | None:
+    try:
+        return datetime.strptime(line[:24].decode('ascii'), '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc).timestamp()
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+class _ArchiveWriter:
+    __slots__ = ("log_dir", "uid", "file", "size")
+
+    def __init__(self, log_dir: str, uid: str, file):
+        self.log_dir = log_dir
+        self.uid = uid
+        self.file = file
+        self.size = 0
+
+
+class LogArchive:
+    """
+    Compressed, searchable output history of every script under hosted_files/<user_id>/logs/.
+    The output pump appends timestamped lines to <UID>.open.log; past LOG_ARCHIVE_SEGMENT_BYTES, or when
+    the script exits, that segment is sealed into <UID>.<first line ms>.log.gz, a run of independent gzip
+    members of about LOG_ARCHIVE_BLOCK_BYTES each. <UID>.index.json lists the sealed segments with their
+    time span and the (first timestamp, compressed offset) of every block, so a search starts
+    decompressing at the block that covers its start time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock() # Index changes: sealing (pump thread) vs retention and purge
+        self._purged = set() # (log_dir, uid) deleted while the pump may still hold a writer for it
+        self.sealed = 0
+        self.searches = 0
+
+    @staticmethod
+    def log_dir(user_id) -> str:
+        return os.path.join(HOSTING_DIR, str(user_id), 'logs')
+
+    @staticmethod
+    def _open_path(log_dir: str, uid: str) -> str:
+        return os.path.join(log_dir, f"{uid}.open.log")
+
+    @staticmethod
+    def _index_path(log_dir: str, uid: str) -> str:
+        return os.path.join(log_dir, f"{uid}.index.json")
+
+    def open_writer(self, output_path: str) -> _ArchiveWriter | None:
+        """Writer for the script whose stdout file is output_path (hosted_files/<user_id>/<UID>.log)."""
+        log_dir = os.path.join(os.path.dirname(output_path), 'logs')
+        uid = os.path.basename(output_path)[:-len('.log')]
+        open_path = self._open_path(log_dir, uid)
+        with self._lock:
+            self._purged.discard((log_dir, uid))
+        try:
+            os.makedirs(log_dir, exist_ok=True)
+            if os.path.exists(open_path):
+                self.seal(log_dir, uid) # Left over from the previous run (or a crash)
+            return _ArchiveWriter(log_dir, uid, open(open_path, 'ab'))
+        except OSError as e:
+            logger.error(f"Log archive for {uid} unavailable: {e}")
+            return None
+
+    def write(self, writer: _ArchiveWriter, lines: list, ts: float):
+        """Appends raw output lines (bytes, without newline) stamped with ts; seals a full segment."""
+        prefix = format_log_timestamp(ts) + b" "
+        data = b"".join(prefix + line + b"\n" for line in lines)
+        try:
+            writer.file.write(data)
+        except OSError as e:
+            logger.error(f"Error archiving output of {writer.uid}: {e}")
+            return
+        writer.size += len(data)
+        if writer.size >= LOG_ARCHIVE_SEGMENT_BYTES and (writer.log_dir, writer.uid) not in self._purged:
+            self.close(writer)
+            try:
+                writer.file = open(self._open_path(writer.log_dir, writer.uid), 'ab')
+            except OSError as e:
+                logger.error(f"Error opening a new log segment for {writer.uid}: {e}")
+            writer.size = 0
+
+    def flush(self, writer: _ArchiveWriter):
+        try:
+            writer.file.flush()
+        except (OSError, ValueError) as e:
+            logger.error(f"Error archiving output of {writer.uid}: {e}")
+
+    def close(self, writer: _ArchiveWriter):
+        """Closes and seals the writer's open segment."""
+        try:
+            writer.file.close()
+        except OSError as e:
+            logger.error(f"Error archiving output of {writer.uid}: {e}")
+        self.seal(writer.log_dir, writer.uid)
+
+    def seal(self, log_dir: str, uid: str):
+        """Compresses <UID>.open.log into a sealed segment and records it in the index; a purged UID is skipped."""
+        if (log_dir, uid) in self._purged:
+            return
+        open_path = self._open_path(log_dir, uid)
+        tmp_path = os.path.join(log_dir, f"{uid}.sealing.tmp")
+        blocks, block, block_size = [], [], 0
+        first_ts = last_ts = None
+        line_count = raw_bytes = 0
+        last_line = b""
+        try:
+            with open(open_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                for line in src:
+                    if not block:
+                        block_ts = parse_log_timestamp(line)
+                        if block_ts is None:
+                            block_ts = last_ts if last_ts is not None else time.time()
+                        first_ts = block_ts if first_ts is None else first_ts
+                        last_ts = block_ts
+                    block.append(line)
+                    block_size += len(line)
+                    line_count += 1
+                    last_line = line
+                    if block_size >= LOG_ARCHIVE_BLOCK_BYTES:
+                        blocks.append([block_ts, dst.tell()])
+                        dst.write(gzip.compress(b"".join(block)))
+                        raw_bytes += block_size
+                        block, block_size = [], 0
+                if block:
+                    blocks.append([block_ts, dst.tell()])
+                    dst.write(gzip.compress(b"".join(block)))
+                    raw_bytes += block_size
+                dst.flush()
+                os.fsync(dst.fileno())
+                compressed_bytes = dst.tell()
+        except OSError as e:
+            if (log_dir, uid) not in self._purged: # Deleted while being sealed
+                logger.error(f"Error sealing log segment of {uid}: {e}")
+            return
+        try:
+            if not line_count:
+                os.remove(tmp_path)
+                os.remove(open_path)
+                return
+            last_ts = parse_log_timestamp(last_line) or last_ts
+            # Named after its first line, so sealing the same open file again after a crash replaces it
+            segment = f"{uid}.{int(first_ts * 1000)}.log.gz"
+            with self._lock:
+                if (log_dir, uid) in self._purged:
+                    os.remove(tmp_path)
+                    return
+                os.replace(tmp_path, os.path.join(log_dir, segment))
+                index = [entry for entry in self.load_index(log_dir, uid) if entry['file'] != segment]
+                index.append({
+                    'file': segment, 'start': first_ts, 'end': last_ts, 'lines': line_count,
+                    'raw_bytes': raw_bytes, 'bytes': compressed_bytes, 'blocks': blocks
+                })
+                self._save_index(log_dir, uid, self._enforce_retention(log_dir, index))
+            os.remove(open_path)
+        except OSError as e:
+            logger.error(f"Error sealing log segment of {uid}: {e}")
+            return
+        self.sealed += 1
+
+    def load_index(self, log_dir: str, uid: str) -> list:
+        """Sealed segments oldest first; segments missing from the index (crash while sealing) are re-added unindexed."""
+        try:
+            with open(self._index_path(log_dir, uid), 'r') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = []
+        except (OSError, ValueError) as e:
+            logger.error(f"Log index of {uid} is unreadable ({e}); searching its segments without it.")
+            index = []
+        known = {entry['file'] for entry in index}
+        for path in glob.glob(os.path.join(log_dir, f"{uid}.*.log.gz")):
+            segment = os.path.basename(path)
+            if segment in known:
+                continue
+            try:
+                start = int(segment.split('.')[1]) / 1000
+                st = os.stat(path)
+            except (ValueError, OSError):
+                continue
+            index.append({'file': segment, 'start': start, 'end': st.st_mtime, 'bytes': st.st_size, 'blocks': [[start, 0]]})
+        index.sort(key=lambda entry: entry['start'])
+        return index
+
+    def _save_index(self, log_dir: str, uid: str, index: list):
+        write_json_atomic(self._index_path(log_dir, uid), index)
+
+    def _enforce_retention(self, log_dir: str, index: list) -> list:
+        """Drops the oldest segments past LOG_ARCHIVE_MAX_BYTES and any that ended before LOG_ARCHIVE_MAX_AGE."""
+        cutoff = time.time() - LOG_ARCHIVE_MAX_AGE
+        total = sum(entry['bytes'] for entry in index)
+        while index and (total > LOG_ARCHIVE_MAX_BYTES or index[0]['end'] < cutoff):
+            entry = index.pop(0)
+            total -= entry['bytes']
+            try:
+                os.remove(os.path.join(log_dir, entry['file']))
+            except FileNotFoundError:
+                pass
+        return index
+
+    def enforce_retention_all(self):
+        """Applies retention to every archive, including those of scripts that no longer produce output (startup)."""
+        for index_path in glob.glob(os.path.join(HOSTING_DIR, '*', 'logs', '*.index.json')):
+            log_dir, uid = os.path.dirname(index_path), os.path.basename(index_path)[:-len('.index.json')]
+            with self._lock:
+                index = self.load_index(log_dir, uid)
+                kept = self._enforce_retention(log_dir, list(index))
+                if len(kept) != len(index):
+                    self._save_index(log_dir, uid, kept)
+
+    def purge(self, user_id, uid: str):
+        """Deletes a UID's whole archive (script deleted); the pump's writer for it, if any, then stops sealing."""
+        log_dir = self.log_dir(user_id)
+        with self._lock:
+            self._purged.add((log_dir, uid))
+            for path in glob.glob(os.path.join(log_dir, f"{uid}.*")):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass # Sealing removed it meanwhile
+
+    def _archived_lines(self, log_dir: str, uid: str, since: float | None):
+        """Yields raw archived lines oldest first, decompressing sealed segments as a stream."""
+        with self._lock:
+            index = self.load_index(log_dir, uid)
+        for entry in index:
+            if since is not None and entry['end'] < since:
+                continue
+            offset = 0
+            if since is not None:
+                # Last block starting at or before `since`; the members after it follow in the file
+                position = bisect.bisect_right([block[0] for block in entry['blocks']], since) - 1
+                offset = entry['blocks'][max(position, 0)][1]
+            try:
+                with open(os.path.join(log_dir, entry['file']), 'rb') as f:
+                    f.seek(offset)
+                    with gzip.GzipFile(fileobj=f) as stream:
+                        yield from stream
+            except FileNotFoundError:
+                continue # Dropped by retention meanwhile
+            except (OSError, EOFError) as e:
+                logger.error(f"Skipping damaged log segment {entry['file']}: {e}")
+        try:
+            with open(self._open_path(log_dir, uid), 'rb') as f:
+                for line in f:
+                    if line.endswith(b"\n"): # The pump may be mid-write on the last one
+                        yield line
+        except FileNotFoundError:
+            pass
+
+    def search(self, user_id, uid: str, pattern: str, regex: bool = False, since: float | None = None, limit: int = LOG_SEARCH_MAX_RESULTS) -> Tuple[list, int, int]:
+        """
+        Streams a UID's archive for lines containing `pattern` (a regular expression when regex is set),
+        optionally from timestamp `since`. Returns (last `limit` matches, match count, lines scanned).
+        Blocking: run it in a thread.
+        """
+        self.searches += 1
+        if regex:
+            matcher = re.compile(pattern).search
+        else:
+            needle = pattern.encode('utf-8')
+        since_prefix = format_log_timestamp(since) if since is not None else None
+        matches = deque(maxlen=limit)
+        total = scanned = 0
+        for line in self._archived_lines(self.log_dir(user_id), uid, since):
+            if since_prefix is not None and line[:24] < since_prefix:
+                continue
+            scanned += 1
+            # Match the output only: the timestamp prefix (24 bytes + space) is kept for display
+            if regex:
+                if not matcher(line[25:].decode('utf-8', 'replace')):
+                    continue
+            elif needle not in line[25:]:
+                continue
+            total += 1
+            matches.append(line.decode('utf-8', 'replace').rstrip("\n"))
+        return list(matches), total, scanned
+
+    def usage(self) -> Tuple[int, int, int]:
+        """(sealed segments, compressed bytes, original bytes) across all archives."""
+        segments = stored = raw = 0
+        for index_path in glob.glob(os.path.join(HOSTING_DIR, '*', 'logs', '*.index.json')):
+            try:
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                continue
+            segments += len(index)
+            stored += sum(entry['bytes'] for entry in index)
+            raw += sum(entry.get('raw_bytes', entry['bytes']) for entry in index)
+        return segments, stored, raw
+
+log_archive = LogArchive()
+
+
+class _PumpTarget:
+    __slots__ = ("fd", "path", "offset", "process", "log_buffer", "partial", "idle_ticks", "archive")
+
+    def __init__(self, fd: int, path: str, offset: int, process, log_buffer: ScriptLogBuffer):
+        self.fd = fd
+        self.path = path
+        self.offset = offset
+        self.process = process
+        self.log_buffer = log_buffer
+        self.partial = b""
+        self.idle_ticks = 0
+        self.archive = None # _ArchiveWriter, opened by the pump thread
+
+
+class OutputPump:
+    """
+    One thread that tails the <UID>.log output files of all hosted scripts into their log buffers
+    and the log archive.
+    Scripts write to the file directly (not a pipe) so they survive a bot restart. Files with recent
+    output are polled every POLL_INTERVAL, idle ones every IDLE_EVERY ticks.
+    """
+    READ_SIZE = 64 * 1024
+    MAX_READS_PER_TICK = 16 # Keeps one chatty script from starving the others
+    POLL_INTERVAL = 0.05
+    IDLE_AFTER_TICKS = 40
+    IDLE_EVERY = 10
+
+    def __init__(self):
+        self._targets = []
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def watch(self, path: str, offset: int, process, log_buffer: ScriptLogBuffer):
+        """Tails `path` from `offset` into log_buffer until the process has been reaped."""
+        fd = os.open(path, os.O_RDONLY)
+        with self._lock:
+            self._pending.append(_PumpTarget(fd, path, offset, process, log_buffer))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="output-pump", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        tick = 0
+        while True:
+            self._wake.clear()
+            with self._lock:
+                new_targets = list(self._pending)
+                self._pending.clear()
+            for target in new_targets:
+                target.archive = log_archive.open_writer(target.path)
+            self._targets.extend(new_targets)
+            if not self._targets:
+                self._wake.wait()
+                continue
+            tick += 1
+            for target in list(self._targets):
+                if target.idle_ticks < self.IDLE_AFTER_TICKS or tick % self.IDLE_EVERY == 0:
+                    self._poll(target)
+            self._wake.wait(self.POLL_INTERVAL)
+
+    def _poll(self, target: _PumpTarget):
+        # returncode is only read, never polled here: reaping belongs to the event loop
+        exited = target.process.returncode is not None
+        got_output = False
+        for _ in range(self.MAX_READS_PER_TICK if not exited else 1 << 30):
+            try:
+                chunk = os.pread(target.fd, self.READ_SIZE, target.offset)
+            except OSError as e:
+                logger.debug(f"Reading {target.path} failed: {e}")
+                chunk = b""
+            if not chunk:
+                break
+            got_output = True
+            target.offset += len(chunk)
+            self._feed(target, chunk)
+        target.idle_ticks = 0 if got_output else target.idle_ticks + 1
+        if got_output and target.archive is not None:
+            log_archive.flush(target.archive)
+
+        if exited:
+            if target.partial:
+                target.log_buffer.append(target.partial.decode('utf-8', 'replace'))
+                if target.archive is not None:
+                    log_archive.write(target.archive, [target.partial], time.time())
+            if target.archive is not None:
+                log_archive.close(target.archive)
+            os.close(target.fd)
+            self._targets.remove(target)
+            target.log_buffer.mark_eof()
+        elif target.offset >= LOG_FILE_MAX_BYTES:
+            self._rotate(target)
+
+    def _feed(self, target: _PumpTarget, chunk: bytes):
+        lines = (target.partial + chunk).split(b"\n")
+        target.partial = lines.pop()
+        if len(target.partial) > target.log_buffer.max_bytes:
+            lines.append(target.partial)
+            target.partial = b""
+        for line in lines:
+            target.log_buffer.append(line.decode('utf-8', 'replace') + "\n")
+        if target.archive is not None and lines:
+            log_archive.write(target.archive, lines, time.time())
+
+    def _rotate(self, target: _PumpTarget):
+        """copytruncate rotation: the script keeps its O_APPEND descriptor, so the file is copied, then emptied."""
+        path = target.path
+        try:
+            for index in range(LOG_FILE_BACKUPS - 1, 0, -1):
+                older = f"{path}.{index}"
+                if os.path.exists(older):
+                    os.replace(older, f"{path}.{index + 1}")
+            if LOG_FILE_BACKUPS > 0:
+                shutil.copyfile(path, f"{path}.1")
+            os.truncate(path, 0)
+        except OSError as e:
+            logger.error(f"Error rotating log file {path}: {e}")
+        target.offset = 0
+
+output_pump = OutputPump()
+
+
+# --- Per-User Virtual Environments ---
+env_stats = {"created": 0, "last_create_seconds": 0.0, "deduped_bytes": 0}
+_env_locks: Dict[str, asyncio.Lock] = {}
+
+def get_user_env_dir(user_id: int) -> str:
+    return os.path.abspath(os.path.join(HOSTING_DIR, str(user_id), '.venv'))
+
+def get_env_python(env_dir: str) -> str:
+    return os.path.join(env_dir, 'bin', 'python')
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def clone_env(base_dir: str, dest_dir: str):
+    """Clones a virtualenv by hard-linking its files, then rewrites bin/ text files that embed the base path."""
+    base_dir, dest_dir = os.path.abspath(base_dir), os.path.abspath(dest_dir)
+    tmp_dir = f"{dest_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.copytree(base_dir, tmp_dir, symlinks=True, copy_function=_link_or_copy)
+
+    base_bytes, dest_bytes = base_dir.encode(), dest_dir.encode()
+    for name in ['pyvenv.cfg'] + [os.path.join('bin', n) for n in os.listdir(os.path.join(tmp_dir, 'bin'))]:
+        path = os.path.join(tmp_dir, name)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            content = f.read()
+        if base_bytes in content:
+            mode = os.stat(path).st_mode
+            os.remove(path) # Break the hard link before writing
+            with open(path, 'wb') as f:
+                f.write(content.replace(base_bytes, dest_bytes))
+            os.chmod(path, mode)
+    os.replace(tmp_dir, dest_dir)
+
+def dedupe_tree(root: str, objects_dir: str = SHARED_OBJECTS_DIR) -> int:
+    """Hard-links identical files under root to one shared object per SHA-256. Returns bytes saved."""
+    os.makedirs(objects_dir, exist_ok=True)
+    saved = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            # Only unshared regular files; .pyc files are rewritten by the interpreter
+            if not stat.S_ISREG(st.st_mode) or st.st_nlink > 1 or filename.endswith('.pyc'):
+                continue
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            object_path = os.path.join(objects_dir, digest.hexdigest())
+            if os.path.exists(object_path):
+                tmp_path = f"{path}.dedupe"
+                os.link(object_path, tmp_path)
+                os.replace(tmp_path, path)
+                saved += st.st_size
+            else:
+                # Shared inodes must not be edited in place by one tenant
+                os.chmod(path, st.st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+                os.link(path, object_path)
+    return saved
+
+def enable_system_site_packages(env_dir: str) -> bool:
+    """Switches an existing env to include-system-site-packages = true. Returns True if it was changed."""
+    cfg_path = os.path.join(env_dir, 'pyvenv.cfg')
+    try:
+        with open(cfg_path, 'r') as f:
+            lines = f.readlines()
+    except OSError:
+        return False
+    changed = False
+    for i, line in enumerate(lines):
+        key, sep, value = line.partition('=')
+        if sep and key.strip() == 'include-system-site-packages' and value.strip().lower() != 'true':
+            lines[i] = "include-system-site-packages = true\n"
+            changed = True
+    if changed:
+        mode = os.stat(cfg_path).st_mode
+        os.remove(cfg_path) # May be a deduplicated (shared, read-only) inode
+        with open(cfg_path, 'w') as f:
+            f.writelines(lines)
+        os.chmod(cfg_path, mode | stat.S_IWUSR)
+    return changed
+
+def upgrade_existing_envs():
+    """
+    One-time fix for envs created isolated from the host's site-packages, in which scripts that ran
+    on the host interpreter before failed with ModuleNotFoundError (startup only).
+    """
+    upgraded = sum(
+        enable_system_site_packages(env_dir)
+        for env_dir in [BASE_ENV_DIR] + glob.glob(os.path.join(HOSTING_DIR, '*', '.venv'))
+    )
+    if upgraded:
+        logger.warning(f"Enabled system site-packages in {upgraded} existing virtualenv(s).")
+
+def get_env_unique_bytes(env_dir: str) -> int:
+    """Disk usage of an env excluding hard-linked (shared) files."""
+    total = 0
+    for dirpath, _, filenames in os.walk(env_dir):
+        for filename in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+                total += st.st_size
+    return total
+
+async def ensure_user_env(user_id: int) -> str:
+    """Returns the user's interpreter, creating the base env and the user's clone on first use."""
+    env_dir = get_user_env_dir(user_id)
+    if os.path.exists(get_env_python(env_dir)):
+        return get_env_python(env_dir)
+
+    async with _env_locks.setdefault(BASE_ENV_DIR, asyncio.Lock()):
+        if not os.path.exists(get_env_python(BASE_ENV_DIR)):
+            logger.warning(f"Creating base virtualenv at {BASE_ENV_DIR}...")
+            # System site-packages stay visible: scripts keep importing what the host (and pip --user) installed
+            await asyncio.to_thread(venv.EnvBuilder(with_pip=True, system_site_packages=True).create, BASE_ENV_DIR)
+            await asyncio.to_thread(dedupe_tree, BASE_ENV_DIR)
+
+    async with _env_locks.setdefault(env_dir, asyncio.Lock()):
+        if not os.path.exists(get_env_python(env_dir)):
+            start = time.perf_counter()
+            await asyncio.to_thread(clone_env, BASE_ENV_DIR, env_dir)
+            env_stats["created"] += 1
+            env_stats["last_create_seconds"] = time.perf_counter() - start
+            logger.warning(f"Created virtualenv for user {user_id} in {env_stats['last_create_seconds']:.3f}s.")
+    return get_env_python(env_dir)
+
+async def get_script_interpreter(user_id: int) -> str:
+    """Interpreter for a user's scripts: their own virtualenv, or the host python."""
+    if not VENV_ISOLATION:
+        return 'python'
+    try:
+        return await ensure_user_env(user_id)
+    except Exception as e:
+        logger.error(f"Error preparing virtualenv for user {user_id}: {e}")
+        return 'python'
+
+
+# --- Resource Limits ---
+LIMIT_ALIASES = {
+    'cpu': 'cpu_percent', 'mem': 'memory_mb', 'memory': 'memory_mb', 'procs': 'max_procs',
+    'cputime': 'cpu_seconds', 'nice': 'nice'
+}
+# What approvals stored before only explicit overrides were kept (a copy of the defaults of the time)
+COPIED_DEFAULT_LIMITS = {'cpu_percent': 100, 'memory_mb': 1024, 'max_procs': 64, 'cpu_seconds': 0, 'nice': 10}
+_cgroup_state = {"checked": False, "available": False}
+
+def get_script_limits(user_id: int, script: dict) -> dict:
+    """Effective limits: defaults, then the user's approved_users limits, then the script's own."""
+    limits = dict(DEFAULT_SCRIPT_LIMITS)
+    if user_id in approved_users:
+        limits.update(approved_users[user_id].get('limits') or {})
+    limits.update(script.get('limits') or {})
+    return limits
+
+def parse_limits(text: str) -> dict | None:
+    """Parses 'cpu=50 mem=512 procs=32 cputime=0 nice=10' into a limits dict (None if invalid)."""
+    limits = {}
+    for part in text.replace(',', ' ').split():
+        key, sep, value = part.partition('=')
+        key = LIMIT_ALIASES.get(key.strip().lower(), key.strip().lower())
+        if not sep or key not in DEFAULT_SCRIPT_LIMITS:
+            return None
+        try:
+            limits[key] = max(0, int(value))
+        except ValueError:
+            return None
+    return limits or None
+
+def format_limits(limits: dict) -> str:
+    return (
+        f"CPU {limits['cpu_percent'] or '∞'}% | Mem {limits['memory_mb'] or '∞'} MB | "
+        f"Procs {limits['max_procs'] or '∞'} | CPU time {limits['cpu_seconds'] or '∞'}s | Nice +{limits['nice']}"
+    )
+
+def cgroups_available() -> bool:
+    """True if a writable cgroup v2 hierarchy with cpu/memory/pids delegated to CGROUP_ROOT exists."""
+    if _cgroup_state["checked"]:
+        return _cgroup_state["available"]
+    _cgroup_state["checked"] = True
+    try:
+        parent = os.path.dirname(CGROUP_ROOT)
+        if not os.path.exists(os.path.join(parent, 'cgroup.controllers')):
+            return False
+        os.makedirs(CGROUP_ROOT, exist_ok=True)
+        for cgroup_dir in (parent, CGROUP_ROOT):
+            with open(os.path.join(cgroup_dir, 'cgroup.subtree_control'), 'w') as f:
+                f.write("+cpu +memory +pids")
+        _cgroup_state["available"] = True
+    except OSError as e:
+        logger.error(f"cgroup v2 limits unavailable ({e}); falling back to rlimits only.")
+    return _cgroup_state["available"]
+
+def create_script_cgroup(uid: str, limits: dict) -> str | None:
+    """Creates CGROUP_ROOT/<uid> with cpu.max, memory.max and pids.max set. None without cgroups."""
+    if not cgroups_available():
+        # No rlimit stands in for these: RLIMIT_AS/RLIMIT_DATA count thread stacks and reserved address
+        # space, so they break threaded scripts long before memory is actually used
+        if limits['cpu_percent'] or limits['memory_mb'] or limits['max_procs']:
+            logger.warning(f"UID {uid}: CPU, memory and process limits need cgroup v2; not enforced.")
+        return None
+    cgroup_dir = os.path.join(CGROUP_ROOT, uid)
+    try:
+        os.makedirs(cgroup_dir, exist_ok=True)
+        settings = {
+            'cpu.max': f"{limits['cpu_percent'] * 1000} 100000" if limits['cpu_percent'] else "max 100000",
+            'memory.max': str(limits['memory_mb'] * 1024 * 1024) if limits['memory_mb'] else "max",
+            'pids.max': str(limits['max_procs']) if limits['max_procs'] else "max",
+        }
+        for name, value in settings.items():
+            with open(os.path.join(cgroup_dir, name), 'w') as f:
+                f.write(value)
+        return cgroup_dir
+    except OSError as e:
+        logger.error(f"Error creating cgroup for UID {uid}: {e}")
+        return None
+
+def release_script_cgroup(uid: str):
+    """Removes a script's (now empty) cgroup."""
+    cgroup_dir = os.path.join(CGROUP_ROOT, uid)
+    if os.path.isdir(cgroup_dir):
+        try:
+            os.rmdir(cgroup_dir)
+        except OSError as e:
+            logger.debug(f"Could not remove cgroup {cgroup_dir}: {e}")
+
+def build_limits_preexec(limits: dict, cgroup_dir: str | None):
+    """preexec_fn for Popen: joins the script's cgroup, then applies rlimits and niceness in the child."""
+    def preexec():
+        if cgroup_dir:
+            with open(os.path.join(cgroup_dir, 'cgroup.procs'), 'w') as f:
+                f.write("0")
+        # RLIMIT_NPROC is not used: it counts every process of the bot's uid, not just this script's.
+        if limits['cpu_seconds']:
+            resource.setrlimit(resource.RLIMIT_CPU, (limits['cpu_seconds'], limits['cpu_seconds'] + 5))
+        if limits['nice']:
+            os.nice(limits['nice'])
+    return preexec
+
+def limited_command(command: list, limits: dict) -> list:
+    """Prefixes the command with ionice (best-effort class, lowest priority) when niceness is requested."""
+    ionice = shutil.which('ionice')
+    if limits['nice'] and ionice:
+        return [ionice, '-c', '2', '-n', '7'] + command
+    return command
+
+def describe_exit(uid: str, process: subprocess.Popen, output_lines: list) -> str:
+    """ScriptDB status for an exited script, naming the limit if one killed it."""
+    memory_events = os.path.join(CGROUP_ROOT, uid, 'memory.events')
+    try:
+        with open(memory_events, 'r') as f:
+            if any(line.startswith('oom_kill ') and int(line.split()[1]) > 0 for line in f):
+                return "Killed: Memory Limit"
+    except (OSError, ValueError):
+        pass
+    if process.returncode == -signal.SIGXCPU:
+        return "Killed: CPU Limit"
+    if process.returncode and any('MemoryError' in line for line in output_lines[-5:]):
+        return "Killed: Memory Limit"
+    return "Stopped"
+
+
+# --- Process Metrics ---
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+
+class ProcessMetrics:
+    """Fixed-size ring of CPU %, RSS and I/O samples for one UID, stored in typed arrays."""
+    __slots__ = ("cpu_percent", "rss_kb", "io_kb", "next_index", "count", "pid", "last_ticks", "last_time", "last_io_kb")
+
+    def __init__(self, size: int = METRICS_HISTORY):
+        self.cpu_percent = array('f', bytes(4 * size))
+        self.rss_kb = array('Q', bytes(8 * size))
+        self.io_kb = array('Q', bytes(8 * size)) # I/O per interval
+        self.next_index = 0
+        self.count = 0
+        self.pid = 0 # Process the last_* counters belong to
+        self.last_ticks = -1
+        self.last_time = 0.0
+        self.last_io_kb = 0
+
+    def record(self, pid: int, ticks: int, rss_kb: int, io_kb: int, now: float):
+        if pid != self.pid:
+            # Restarted since the last sample: the new process's counters start from zero
+            self.pid, self.last_ticks = pid, -1
+        if self.last_ticks >= 0 and now > self.last_time:
+            cpu = (ticks - self.last_ticks) / CLOCK_TICKS / (now - self.last_time) * 100
+            io_delta = max(0, io_kb - self.last_io_kb)
+        else:
+            cpu, io_delta = 0.0, 0
+        self.last_ticks, self.last_time, self.last_io_kb = ticks, now, io_kb
+        size = len(self.cpu_percent)
+        self.cpu_percent[self.next_index] = cpu
+        self.rss_kb[self.next_index] = rss_kb
+        self.io_kb[self.next_index] = io_delta
+        self.next_index = (self.next_index + 1) % size
+        self.count = min(self.count + 1, size)
+
+    def latest(self) -> Tuple[float, int]:
+        """Most recent (cpu_percent, rss_kb)."""
+        index = (self.next_index - 1) % len(self.cpu_percent)
+        return self.cpu_percent[index], self.rss_kb[index]
+
+    def peak_rss_kb(self) -> int:
+        return max(self.rss_kb) if self.count else 0
+
+
+def read_proc_sample(pid: int) -> Tuple[int, int, int] | None:
+    """(utime+stime ticks, RSS kB, read+write kB) for a PID from /proc, or None if it is gone."""
+    try:
+        with open(f"/proc/{pid}/stat", 'rb') as f:
+            fields = f.read().rsplit(b')', 1)[1].split()
+        ticks = int(fields[11]) + int(fields[12]) # utime, stime (fields 14/15 of stat)
+        with open(f"/proc/{pid}/statm", 'rb') as f:
+            rss_kb = int(f.read().split()[1]) * PAGE_SIZE_KB
+    except (OSError, IndexError, ValueError):
+        return None
+    io_kb = 0
+    try:
+        with open(f"/proc/{pid}/io", 'rb') as f:
+            for line in f:
+                if line.startswith((b'read_bytes:', b'write_bytes:')):
+                    io_kb += int(line.split()[1]) // 1024
+    except (OSError, ValueError):
+        pass
+    return ticks, rss_kb, io_kb
+
+
+def read_proc_start_time(pid: int) -> int | None:
+    """Start time (clock ticks since boot) of a live, non-zombie PID; together with the PID it identifies the process."""
+    try:
+        with open(f"/proc/{pid}/stat", 'rb') as f:
+            fields = f.read().rsplit(b')', 1)[1].split()
+        if fields[0] == b'Z':
+            return None
+        return int(fields[19]) # starttime (field 22 of stat)
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class MetricsSampler:
+    """Samples every process in running_processes on an interval and keeps per-UID ProcessMetrics."""
+    def __init__(self, interval: float = METRICS_INTERVAL):
+        self.interval = interval
+        self.metrics: Dict[str, ProcessMetrics] = {}
+        self.last_sweep_seconds = 0.0
+
+    def overhead_percent(self) -> float:
+        """Wall time of the last sweep as a share of the interval."""
+        return self.last_sweep_seconds / self.interval * 100
+
+    def sample_once(self):
+        start = time.perf_counter()
+        targets = [(uid, process.pid) for uid, (process, _) in list(running_processes.items())]
+        now = time.monotonic()
+        for uid, pid in targets:
+            sample = read_proc_sample(pid)
+            if sample is None:
+                continue
+            metrics = self.metrics.get(uid)
+            if metrics is None:
+                metrics = self.metrics[uid] = ProcessMetrics()
+            metrics.record(pid, *sample, now)
+        # Drop series of scripts that are no longer tracked
+        for uid in [uid for uid in self.metrics if uid not in running_processes]:
+            del self.metrics[uid]
+        self.last_sweep_seconds = time.perf_counter() - start
+
+    async def run(self):
+        while True:
+            try:
+                self.sample_once()
+            except Exception as e:
+                logger.error(f"Metrics sampling failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def describe(self, uid: str) -> str:
+        """Short 'CPU x% · y MB' label for listings, empty if no samples yet."""
+        metrics = self.metrics.get(uid)
+        if metrics is None or not metrics.count:
+            return ""
+        cpu, rss_kb = metrics.latest()
+        return f" | CPU {cpu:.0f}% · {rss_kb / 1024:.0f} MB"
+
+metrics_sampler = MetricsSampler()
+
+
+# --- Crash Supervisor ---
+class ProcessSupervisor:
+    """Reaps hosted processes as they exit (pidfd) and restarts them per their restart policy with backoff."""
+    def __init__(self):
+        self._crashes: Dict[str, deque] = {}
+        self._notified = set()
+        self.restarts = 0
+        self.crash_loops = 0
+
+    def watch(self, uid: str, process: subprocess.Popen):
+        """Calls handle_exit when the process exits, unless it was untracked (intentional stop) first."""
+        loop = asyncio.get_running_loop()
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            run_in_background(self._poll_exit(uid, process))
+            return
+
+        def on_exit():
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+            process.poll()
+            self._on_exit(uid, process)
+        loop.add_reader(pidfd, on_exit)
+
+    async def _poll_exit(self, uid: str, process: subprocess.Popen):
+        while process.poll() is None:
+            await asyncio.sleep(1)
+        self._on_exit(uid, process)
+
+    def _on_exit(self, uid: str, process: subprocess.Popen):
+        entry = running_processes.get(uid)
+        if entry is not None and entry[0] is process:
+            run_in_background(self.handle_exit(uid, process))
+
+    async def handle_exit(self, uid: str, process: subprocess.Popen):
+        """Records an unexpected exit and schedules a restart according to the script's policy."""
+        found = db_manager.find_script(uid)
+        exit_status = describe_exit(uid, process, get_script_log_tail(int(found[0]), uid, 5) if found else [])
+        await terminate_process_async(uid)
+        if found is None:
+            return
+        user_id, script = int(found[0]), found[1]
+
+        policy = script.get('restart_policy', DEFAULT_RESTART_POLICY)
+        failed = process.returncode != 0
+        if policy == 'never' or (policy == 'on-failure' and not failed):
+            db_manager.update_script_data(user_id, uid, "status", exit_status)
+            return
+
+        now = time.monotonic()
+        history = self._crashes.setdefault(uid, deque())
+        while history and now - history[0] > CRASH_LOOP_WINDOW:
+            history.popleft()
+        if not history:
+            self._notified.discard(uid) # New crash streak
+        history.append(now)
+
+        if len(history) >= CRASH_LOOP_THRESHOLD:
+            self.crash_loops += 1
+            del self._crashes[uid]
+            db_manager.update_script_data(user_id, uid, "status", "Error: Crash Loop")
+            await self._notify(user_id, f"🛑 **Crash Loop Detected!**\n\nProject **{script['display_name']}** (`{uid}`) crashed {CRASH_LOOP_THRESHOLD} times within {CRASH_LOOP_WINDOW / 60:.0f} minutes. Auto-restart is **stopped**; fix the script and use **Restart**.")
+            return
+
+        delay = min(RESTART_BACKOFF_BASE ** (len(history) - 1), RESTART_BACKOFF_MAX)
+        db_manager.update_script_data(user_id, uid, "status", "Restarting")
+        if uid not in self._notified:
+            self._notified.add(uid)
+            await self._notify(user_id, f"⚠️ **Script Crashed!**\n\nProject **{script['display_name']}** (`{uid}`) exited ({exit_status}, code ``{process.returncode}``). It will be **restarted automatically** with backoff; you won't be notified of further crashes in this streak.")
+
+        run_in_background(self._restart_later(user_id, uid, script, delay))
+
+    async def _restart_later(self, user_id: int, uid: str, script: dict, delay: float):
+        await asyncio.sleep(delay)
+        # Abort if the script was paused, restarted, or deleted meanwhile
+        if script.get('status') != 'Restarting' or uid in running_processes or not db_manager.uid_exists(uid):
+            return
+        self.restarts += 1
+        await start_script(user_id, uid, script, user_id, silent_start=True)
+
+    async def _notify(self, user_id: int, text: str):
+        try:
+            await bot.send_message(user_id, text, parse_mode="Markdown", priority=PRIORITY_NOTIFICATION)
+        except Exception as e:
+            logger.error(f"Could not send crash notice to {user_id}: {e}")
+
+supervisor = ProcessSupervisor()
+
+
+# --- Pip Install Job Queue ---
+class PipInstallQueue:
+    """Background pip installs: bounded concurrency, deduplicated package sets, local wheel cache."""
+    def __init__(self, workers: int = PIP_WORKERS):
+        self.workers = workers
+        self._queue = None
+        self._jobs: Dict[tuple, asyncio.Future] = {}
+        self.completed = 0
+        self.served_from_cache = 0
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            for _ in range(self.workers):
+                run_in_background(self._worker())
+
+    def pending(self) -> int:
+        """Jobs queued or running."""
+        return len(self._jobs)
+
+    def submit(self, packages: list, env_dir: str | None = None) -> Tuple[asyncio.Future, bool]:
+        """Queues an install into env_dir (or the user site); returns (future, is_new). Identical jobs are shared."""
+        self._ensure_workers()
+        key = (env_dir, tuple(sorted({p.strip().lower() for p in packages})))
+        if key in self._jobs:
+            return self._jobs[key], False
+        future = asyncio.get_running_loop().create_future()
+        self._jobs[key] = future
+        self._queue.put_nowait(key)
+        return future, True
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            future = self._jobs[key]
+            try:
+                future.set_result(await self._install(*key))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                del self._jobs[key]
+                self.completed += 1
+                self._queue.task_done()
+
+    async def _run(self, args: list) -> Tuple[int, str]:
+        process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(), PIP_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+        return process.returncode, output.decode('utf-8', 'replace')
+
+    async def _install(self, env_dir: str | None, packages: tuple) -> Tuple[bool, str]:
+        """Installs offline from the wheel cache, filling the cache from the index on a miss."""
+        pip = [get_env_python(env_dir), '-m', 'pip'] if env_dir else ['pip']
+        target = [] if env_dir else ['--user']
+        install_command = pip + ['install'] + target + ['--cache-dir', PIP_CACHE_DIR, '--no-index', '--find-links', os.path.abspath(PIP_WHEEL_DIR)] + list(packages)
+        os.makedirs(PIP_WHEEL_DIR, exist_ok=True)
+
+        returncode, output = await self._run(install_command)
+        if returncode == 0:
+            self.served_from_cache += 1
+        else:
+            returncode, output = await self._run(
+                pip + ['wheel', '--wheel-dir', PIP_WHEEL_DIR, '--find-links', PIP_WHEEL_DIR, '--cache-dir', PIP_CACHE_DIR] + list(packages)
+            )
+            if returncode != 0:
+                return False, output
+            returncode, output = await self._run(install_command)
+
+        if returncode == 0 and env_dir:
+            # Share identical package files with other tenants' envs
+            env_stats["deduped_bytes"] += await asyncio.to_thread(dedupe_tree, env_dir)
+        return returncode == 0, output
+
+pip_installer = PipInstallQueue()
+
+async def notify_pip_result(chat_id: int, packages_str: str, packages_list: list, job: asyncio.Future):
+    """Waits for a pip job and reports the outcome to the requesting chat."""
+    try:
+        success, output = await job
+    except asyncio.TimeoutError:
+        await bot.send_message(chat_id, f"❌ **Installation Timeout.** A pip step took longer than {PIP_TIMEOUT // 60} minutes and was canceled.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        return
+    except Exception as e:
+        logger.error(f"Unexpected error during pip install: {e}")
+        await bot.send_message(chat_id, f"❌ An unexpected error occurred: ``{e}``", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        return
+
+    if success:
+        response_msg = (
+            f"✅ **Success!** The following packages are now available to all your scripts:\n"
+            f"``{packages_str}``\n\n"
+            f"You can now host your script."
+        )
+        logger.debug(f"Packages installed successfully: {packages_str}")
+    else:
+        response_msg = (
+            f"❌ **Installation Failed!**\n\n"
+            f"Could not install packages: ``{packages_list}``.\n"
+            f"**Error Details:**\n"
+            f"``{output[-500:]}``"
+        )
+        logger.error(f"Package installation failed: {output}")
+    await bot.send_message(chat_id, response_msg, parse_mode="Markdown", reply_markup=build_main_keyboard())
+
+
+# --- Button Helpers (MODIFIED: Added Admin Keyboard) ---
+def build_main_keyboard() -> types.ReplyKeyboardMarkup:
+    """Main menu Reply Keyboard with 10 buttons."""
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
+    keyboard.row("⚙️ Host", "🔪 Terminate")
+    keyboard.row("⏸️ Pause", "🔄 Restart")
+    keyboard.row("📃 Saved", "✏️ Update Name", "🛡️ Auto-Restart")
+    keyboard.row("🪝 Pip", "📜 Logs", "❌ Cancel")
+    return keyboard
+
+def build_admin_keyboard() -> types.ReplyKeyboardMarkup:
+    """Admin Panel Reply Keyboard."""
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
+    keyboard.row("✅ Approve", "🚫 Unapprove")
+    keyboard.row("👥 Approved", "♻️ Renew")
+    keyboard.row("📝 List User Scripts", "🔙 Back to Main")
+    return keyboard
+
+def build_renew_keyboard() -> types.ReplyKeyboardMarkup:
+    """Renew nested keyboard."""
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
+    keyboard.row("⏱️ Renew Time Access", "💻 Renew Script Access")
+    keyboard.row("🧮 Renew Resource Limits", "🔙 Back to Admin")
+    return keyboard
+
+# --- Paginated Listings ---
+SCRIPT_LIST_FILTERS = ('all', 'running', 'paused', 'stopped')
+APPROVED_LIST_FILTERS = ('all', 'active', 'expired')
+
+def script_status_icon(status: str) -> str:
+    if status == 'Running':
+        return "🟢"
+    if status == 'Paused':
+        return "⏸️"
+    if status == 'Restarting':
+        return "🔁"
+    if status.startswith('Killed'):
+        return "🛑"
+    return "⚪"
+
+def script_list_filter(status: str) -> str:
+    """Filter bucket of a script status: 'running', 'paused' or 'stopped'."""
+    if status in ('Running', 'Restarting'):
+        return 'running'
+    if status == 'Paused':
+        return 'paused'
+    return 'stopped'
+
+def shorten_name(name: str) -> str:
+    return name if len(name) <= LISTING_NAME_MAX_CHARS else name[:LISTING_NAME_MAX_CHARS - 1] + "…"
+
+
+class ListingCache:
+    """
+    Row order of the paginated listings, rebuilt only after the data behind a view changes: script
+    views are keyed on db_manager.scripts_version(), the approved view is dropped by invalidate_approved().
+    Rendering a page then formats only that page's rows.
+    """
+    def __init__(self):
+        self._scripts: Dict[str, Tuple[int, Dict[str, list]]] = {} # user_id_str -> (version, filter -> [uid])
+        self._approved = None # [(expiry, user_id)] sorted by expiry, so expired users are a prefix
+        self._approved_expiries = []
+        self.names: Dict[int, str] = {} # Display names of users listed by the owner
+        self.hits = 0
+        self.rebuilds = 0
+
+    def script_uids(self, user_id, status_filter: str) -> list:
+        user_id_str = str(user_id)
+        version = db_manager.scripts_version(user_id_str)
+        cached = self._scripts.get(user_id_str)
+        if cached is None or cached[0] != version:
+            buckets = {name: [] for name in SCRIPT_LIST_FILTERS}
+            for uid, script in db_manager.get_user_scripts(user_id_str).items():
+                buckets['all'].append(uid)
+                buckets[script_list_filter(script['status'])].append(uid)
+            cached = (version, buckets)
+            self._scripts[user_id_str] = cached
+            self.rebuilds += 1
+        else:
+            self.hits += 1
+        return cached[1][status_filter]
+
+    def approved_range(self, status_filter: str) -> Tuple[list, int, int]:
+        """Returns (sorted rows, start, end): the filter's rows are sorted_rows[start:end]."""
+        if self._approved is None:
+            self._approved = sorted((data['expiry'], user_id) for user_id, data in approved_users.items())
+            self._approved_expiries = [expiry for expiry, _ in self._approved]
+            self.rebuilds += 1
+        else:
+            self.hits += 1
+        split = bisect.bisect_right(self._approved_expiries, time.time())
+        if status_filter == 'expired':
+            return self._approved, 0, split
+        if status_filter == 'active':
+            return self._approved, split, len(self._approved)
+        return self._approved, 0, len(self._approved)
+
+    def invalidate_approved(self):
+        self._approved = None
+
+listings = ListingCache()
+
+def listing_page_bounds(count: int, page: int) -> Tuple[int, int]:
+    """Clamps page to the available pages and returns (page, page count)."""
+    pages = max(1, -(-count // LISTING_PAGE_SIZE))
+    return min(max(page, 0), pages - 1), pages
+
+def build_listing_markup(view: str, subject: int, filters: tuple, status_filter: str, page: int, pages: int) -> types.InlineKeyboardMarkup:
+    """Filter row plus Prev/Next row; callback data is 'ls:<view>:<subject>:<filter>:<page>'."""
+    markup = types.InlineKeyboardMarkup()
+    markup.row(*[
+        types.InlineKeyboardButton(("• " if name == status_filter else "") + name.title(), callback_data=f"ls:{view}:{subject}:{name}:0")
+        for name in filters
+    ])
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(types.InlineKeyboardButton("◀️ Prev", callback_data=f"ls:{view}:{subject}:{status_filter}:{page - 1}"))
+        nav.append(types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"ls:{view}:{subject}:{status_filter}:{page}"))
+        if page < pages - 1:
+            nav.append(types.InlineKeyboardButton("Next ▶️", callback_data=f"ls:{view}:{subject}:{status_filter}:{page + 1}"))
+        markup.row(*nav)
+    return markup
+
+async def render_script_listing(view: str, target_id: int, status_filter: str = 'all', page: int = 0):
+    """
+    One page of a user's scripts as (text, inline markup); markup is None when the user has no scripts.
+    view 'saved' is the user's own list (exited processes are reaped as their rows are shown),
+    view 'user' is the owner's view of target_id.
+    """
+    if view == 'saved':
+        title = "📑 **Your Saved Scripts**:\n\n"
+    else:
+        title = f"📑 **{listings.names.get(target_id) or f'User ID `{target_id}`'}'s Saved Scripts**:\n\n"
+    if not db_manager.get_user_scripts(target_id):
+        return title + "No files are currently saved or hosted.", None
+
+    uids = listings.script_uids(target_id, status_filter)
+    page, pages = listing_page_bounds(len(uids), page)
+    lines = []
+    for uid in uids[page * LISTING_PAGE_SIZE:(page + 1) * LISTING_PAGE_SIZE]:
+        script = db_manager.get_script_by_uid(target_id, uid)
+        if script is None:
+            continue
+        status = script['status']
+        if uid in running_processes:
+            process, _ = running_processes[uid]
+            if view == 'saved' and process.poll() is not None:
+                status = describe_exit(uid, process, get_script_log_tail(target_id, uid, 5))
+                await terminate_process_async(uid)
+                db_manager.update_script_data(target_id, uid, "status", status)
+            else:
+                status = 'Running'
+        lines.append(f"{script_status_icon(status)} `{uid}` | **{shorten_name(script['display_name'])}**{metrics_sampler.describe(uid)}")
+    if not lines:
+        lines.append(f"No **{status_filter}** scripts.")
+    markup = build_listing_markup(view, 0 if view == 'saved' else target_id, SCRIPT_LIST_FILTERS, status_filter, page, pages)
+    return title + "\n".join(lines), markup
+
+def render_approved_listing(status_filter: str = 'all', page: int = 0):
+    """One page of approved users by expiry as (text, inline markup); markup is None when nobody is approved."""
+    if not approved_users:
+        return "ℹ️ **No users** are currently approved.", None
+
+    rows, start, end = listings.approved_range(status_filter)
+    page, pages = listing_page_bounds(end - start, page)
+    first = start + page * LISTING_PAGE_SIZE
+    now = time.time()
+    lines = []
+    for i, (expiry, user_id_item) in enumerate(rows[first:min(end, first + LISTING_PAGE_SIZE)], page * LISTING_PAGE_SIZE + 1):
+        data = approved_users.get(user_id_item)
+        if data is None:
+            continue
+        if expiry <= now:
+            status = "🔴 Expired"
+        else:
+            expiry_dt = datetime.fromtimestamp(expiry, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+            status = f"✅ Expires: **{expiry_dt}**"
+        # FIXED: Use single backtick for User ID for copyability
+        lines.append(f"{i}. **{shorten_name(data.get('name', 'Unknown User'))}** (`{user_id_item}`)\n   *Scripts Limit: {data.get('max_scripts', 1)} | {status}*")
+    if not lines:
+        lines.append(f"No **{status_filter}** users.")
+    markup = build_listing_markup('approved', 0, APPROVED_LIST_FILTERS, status_filter, page, pages)
+    return "📑 **Approved Users:**\n\n" + "\n".join(lines), markup
+
+async def handle_listing_callback(call: types.CallbackQuery):
+    """Prev/Next/filter presses on a listing: re-renders the page in place."""
+    user_id = call.from_user.id
+    try:
+        _, view, subject, status_filter, page = call.data.split(':')
+        subject, page = int(subject), int(page)
+    except ValueError:
+        await bot.answer_callback_query(call.id)
+        return
+
+    if view == 'saved' and status_filter in SCRIPT_LIST_FILTERS:
+        text, markup = await render_script_listing('saved', user_id, status_filter, page)
+    elif view == 'user' and status_filter in SCRIPT_LIST_FILTERS and is_owner(user_id):
+        text, markup = await render_script_listing('user', subject, status_filter, page)
+    elif view == 'approved' and status_filter in APPROVED_LIST_FILTERS and is_owner(user_id):
+        text, markup = render_approved_listing(status_filter, page)
+    else:
+        await bot.answer_callback_query(call.id, "This listing is no longer available.")
+        return
+
+    await bot.answer_callback_query(call.id)
+    try:
+        await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode="Markdown", reply_markup=markup)
+    except asyncio_helper.ApiTelegramException as e:
+        if "message is not modified" not in str(e):
+            logger.error(f"Error updating listing page: {e}")
+
+
+# --- Live Log Follow ---
+def build_follow_markup(uid: str, following: bool) -> types.InlineKeyboardMarkup:
+    markup = types.InlineKeyboardMarkup()
+    if following:
+        markup.row(types.InlineKeyboardButton("⏹️ Stop", callback_data=f"lf:stop:{uid}"))
+    else:
+        markup.row(types.InlineKeyboardButton("▶️ Follow", callback_data=f"lf:start:{uid}"))
+    return markup
+
+def format_log_window(lines) -> str:
+    """Joins log lines for a Markdown code block, keeping the newest LOG_FOLLOW_MAX_CHARS characters."""
+    return "".join(lines).strip()[-LOG_FOLLOW_MAX_CHARS:].replace("`", "'") or "No output captured yet."
+
+
+class LogFollowSession:
+    __slots__ = ("chat_id", "message_id", "user_id", "uid", "display_name", "window", "last_text", "last_edit", "wakeup", "stopped", "task")
+
+    def __init__(self, chat_id: int, message_id: int, user_id: int, uid: str, display_name: str):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.user_id = user_id
+        self.uid = uid
+        self.display_name = display_name
+        self.window = deque(maxlen=LOG_FOLLOW_LINES)
+        self.last_text = None
+        self.last_edit = 0.0
+        self.wakeup = asyncio.Event()
+        self.stopped = False
+        self.task = None
+
+
+class LogFollower:
+    """
+    Streams a script's output into one message by editing it: reads only the lines appended since
+    its cursor (ScriptLogBuffer.lines_since), keeps a bounded window, edits at most every
+    LOG_FOLLOW_INTERVAL seconds and only when the text changed, and stops after LOG_FOLLOW_TIMEOUT.
+    """
+    def __init__(self):
+        self._sessions: Dict[int, LogFollowSession] = {} # chat_id -> session (one live message per chat)
+        self.edits = 0
+        self.skipped = 0 # Refreshes that produced the text already shown
+
+    def active(self) -> int:
+        return len(self._sessions)
+
+    def start(self, chat_id: int, message_id: int, user_id: int, uid: str, display_name: str) -> bool:
+        """Turns message_id into a live view of uid, replacing the chat's previous one. False when at capacity."""
+        previous = self._sessions.pop(chat_id, None)
+        if previous is not None:
+            previous.stopped = True
+            previous.wakeup.set()
+        if len(self._sessions) >= LOG_FOLLOW_MAX_SESSIONS:
+            return False
+        session = LogFollowSession(chat_id, message_id, user_id, uid, display_name)
+        self._sessions[chat_id] = session
+        session.task = run_in_background(self._run(session))
+        return True
+
+    def stop(self, chat_id: int, message_id: int) -> bool:
+        session = self._sessions.get(chat_id)
+        if session is None or session.message_id != message_id:
+            return False
+        session.stopped = True
+        session.wakeup.set()
+        return True
 
-    except Exception as e:
-        logger.error(f"Error running script {file_name_on_disk} for user {user_id}: {e}")
-        db_manager.update_script_data(user_id, uid, "status", "Error")
-        if not silent_start:
-            await bot.send_message(chat_id, f"❌ An unexpected error occurred while running the script: ``{e}``", parse_mode="Markdown")
-        
+    async def _run(self, session: LogFollowSession):
+        loop = asyncio.get_running_loop()
+        notify = lambda: loop.call_soon_threadsafe(session.wakeup.set)
+        deadline = loop.time() + LOG_FOLLOW_TIMEOUT
+        entry = running_processes.get(session.uid)
+        log_buffer = entry[1] if entry else None
+        if log_buffer is not None:
+            log_buffer.add_listener(notify)
+            seq = max(0, log_buffer.total_lines - LOG_FOLLOW_LINES)
+        else:
+            session.window.extend(get_script_log_tail(session.user_id, session.uid, LOG_FOLLOW_LINES))
+        final_status = "⌛ Stopped following (timeout)"
+        try:
+            while True:
+                session.wakeup.clear()
+                ended = log_buffer is None or log_buffer.eof # Read before draining: EOF follows the last line
+                if log_buffer is not None:
+                    new_lines, seq = log_buffer.lines_since(seq)
+                    session.window.extend(new_lines)
 
+                if session.stopped:
+                    final_status = "⏹️ Stopped following"
+                    break
+                if ended or running_processes.get(session.uid) is not entry:
+                    final_status = "⚪ Script is not running"
+                    break
+                if loop.time() >= deadline:
+                    break
+                await self._edit(session, "🔴 Following", following=True)
 
-# --- File Management Utilities (RESTORED) ---
-def read_script_output(process: subprocess.Popen, q: queue.Queue):
-    """Reads output from script's stdout."""
-    try:
-        while process.poll() is None:
-             line = process.stdout.readline()
-             if line:
-                 q.put(line)
-             else:
-                 break
-    except Exception as e:
-        logger.debug(f"Reader thread finished for PID {process.pid}: {e}")
+                try:
+                    await asyncio.wait_for(session.wakeup.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    continue
+                # Throttle: batch whatever arrives until the next edit slot
+                delay = session.last_edit + LOG_FOLLOW_INTERVAL - loop.time()
+                if delay > 0 and not session.stopped:
+                    await asyncio.sleep(delay)
+            current = self._sessions.get(session.chat_id)
+            if current is session or current is None or current.message_id != session.message_id:
+                await self._edit(session, final_status, following=False) # Unless a new session took over this message
+        except Exception as e:
+            logger.error(f"Error following logs of {session.uid}: {e}")
+        finally:
+            if log_buffer is not None:
+                log_buffer.remove_listener(notify)
+            if self._sessions.get(session.chat_id) is session:
+                del self._sessions[session.chat_id]
 
+    async def _edit(self, session: LogFollowSession, status: str, following: bool):
+        text = f"📜 **Logs for {session.display_name}** (`{session.uid}`) | {status}\n```\n{format_log_window(session.window)}\n```"
+        if text == session.last_text:
+            self.skipped += 1
+            return
+        try:
+            await outbox.reserve_slot() # Edits count toward the same global limit as sent messages
+            await bot.edit_message_text(text, session.chat_id, session.message_id, parse_mode="Markdown", reply_markup=build_follow_markup(session.uid, following))
+        except asyncio_helper.ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                session.last_edit = asyncio.get_running_loop().time() + retry_after
+                logger.warning(f"Flood limit while following logs in chat {session.chat_id}: next edit in {retry_after}s.")
+                return
+            if "message is not modified" not in str(e):
+                raise
+        session.last_text = text
+        session.last_edit = asyncio.get_running_loop().time()
+        self.edits += 1
 
-# --- Button Helpers (MODIFIED: Added Admin Keyboard) ---
-def build_main_keyboard() -> types.ReplyKeyboardMarkup:
-    """Main menu Reply Keyboard with 8 buttons."""
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
-    keyboard.row("⚙️ Host", "🔪 Terminate")
-    keyboard.row("⏸️ Pause", "🔄 Restart")
-    keyboard.row("📃 Saved", "✏️ Update Name")
-    keyboard.row("🪝 Pip", "❌ Cancel")
-    return keyboard
+log_follower = LogFollower()
 
-def build_admin_keyboard() -> types.ReplyKeyboardMarkup:
-    """Admin Panel Reply Keyboard."""
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
-    keyboard.row("✅ Approve", "🚫 Unapprove")
-    keyboard.row("👥 Approved", "♻️ Renew")
-    keyboard.row("📝 List User Scripts", "🔙 Back to Main")
-    return keyboard
+async def handle_follow_callback(call: types.CallbackQuery):
+    """▶️ Follow / ⏹️ Stop presses under a logs message."""
+    try:
+        _, action, uid = call.data.split(':')
+    except ValueError:
+        await bot.answer_callback_query(call.id)
+        return
+    chat_id = call.message.chat.id
+    if action == 'stop':
+        await bot.answer_callback_query(call.id)
+        if not log_follower.stop(chat_id, call.message.message_id):
+            # Left over from an earlier run: just offer following again
+            try:
+                await bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=build_follow_markup(uid, following=False))
+            except Exception:
+                pass
+        return
+
+    script = db_manager.get_script_by_uid(call.from_user.id, uid)
+    if script is None:
+        await bot.answer_callback_query(call.id, "This script no longer exists.")
+        return
+    if not log_follower.start(chat_id, call.message.message_id, call.from_user.id, uid, script['display_name']):
+        await bot.answer_callback_query(call.id, "Too many live logs are open right now. Try again later.")
+        return
+    await bot.answer_callback_query(call.id, f"Following for up to {LOG_FOLLOW_TIMEOUT // 60} minutes.")
 
-def build_renew_keyboard() -> types.ReplyKeyboardMarkup:
-    """Renew nested keyboard."""
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
-    keyboard.row("⏱️ Renew Time Access", "💻 Renew Script Access")
-    keyboard.row("🔙 Back to Admin")
-    return keyboard
 
 # --- State Reset (Unchanged) ---
 def reset_user_state(user_id: int):
-    """Resets user's state to IDLE."""
-    db_manager.update_user_state(user_id, "current_process", "IDLE")
-    db_manager.update_user_state(user_id, "pending_file_name", None)
-    db_manager.update_user_state(user_id, "pending_file_name_on_disk", None) 
-    db_manager.update_user_state(user_id, "pending_update_uid", None)
-    db_manager.update_user_state(user_id, "admin_target_id", None) # New Admin Target ID
-    db_manager.update_user_state(user_id, "admin_target_step", None) # New Admin Step
+    """Resets user's state to IDLE (in memory only, no persistence I/O)."""
+    conversations.reset(user_id)
     # Changed logger level from WARNING to DEBUG for state reset, as ERROR is now the base level
     logger.debug(f"User {user_id} state reset to IDLE.") 
 
-# --- File/Document Handler (Unchanged) ---
+# --- Content-Addressed Script Storage ---
+FICLONE = 0x40049409 # ioctl that makes a file share another's extents copy-on-write (btrfs, XFS)
+
+def clone_file(src_path: str, dest_path: str):
+    """Replaces dest_path (may equal src_path) with a private copy of src_path: a reflink where the filesystem supports it."""
+    tmp_path = f"{dest_path}.clone"
+    with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp_path, dest_path)
+
+class BlobStore:
+    """
+    One read-only blob per SHA-256 under BLOB_STORE_DIR. Hosted script files are private copies of
+    their blob (reflinks where the filesystem supports them), never hard links: scripts can write to
+    their own file, and a shared inode would carry that edit into every other tenant's script.
+    Telegram file_unique_ids are remembered (as symlinks to blobs) so re-sending known content skips
+    the download. A blob is dropped when the last script with its content_hash is deleted.
+    """
+    def __init__(self, root: str = BLOB_STORE_DIR):
+        self.root = root
+        self.dedup_hits = 0
+        self._refs = {} # digest -> scripts using it, counted from ScriptDB at startup
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _id_path(self, unique_id: str) -> str:
+        return os.path.join(self.root, 'ids', unique_id)
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def count_references(self, digests):
+        """Sets the reference counts from the content_hash of every hosted script (startup)."""
+        self._refs = {}
+        for digest in digests:
+            self._refs[digest] = self._refs.get(digest, 0) + 1
+
+    def lookup(self, unique_id: str) -> str | None:
+        """Digest stored for a Telegram file_unique_id, if that blob still exists."""
+        id_path = self._id_path(unique_id)
+        if not os.path.exists(id_path): # Follows the symlink: False once the blob is collected
+            return None
+        return os.path.basename(os.readlink(id_path))
+
+    def remember(self, unique_id: str, digest: str):
+        id_path = self._id_path(unique_id)
+        os.makedirs(os.path.dirname(id_path), exist_ok=True)
+        if os.path.lexists(id_path):
+            os.remove(id_path)
+        os.symlink(os.path.join('..', digest[:2], digest), id_path)
+
+    def copy_out(self, digest: str, dest_path: str):
+        """Makes dest_path a private copy of an existing blob, replacing whatever is there."""
+        clone_file(self.blob_path(digest), dest_path)
+        self._refs[digest] = self._refs.get(digest, 0) + 1
+
+    def store(self, src_path: str, dest_path: str, digest: str | None = None) -> str:
+        """Stores src_path's content (once) and moves src_path to dest_path (may be the same). Returns the digest."""
+        digest = digest or self.hash_file(src_path)
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            self.dedup_hits += 1
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            clone_file(src_path, blob)
+            os.chmod(blob, 0o444)
+        if src_path != dest_path:
+            os.replace(src_path, dest_path)
+        self._refs[digest] = self._refs.get(digest, 0) + 1
+        return digest
+
+    def release(self, digest: str):
+        """Drops the blob once the last script using it is gone."""
+        remaining = self._refs.get(digest, 0) - 1
+        if remaining > 0:
+            self._refs[digest] = remaining
+            return
+        self._refs.pop(digest, None)
+        try:
+            os.remove(self.blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _blobs(self):
+        for prefix in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            if prefix == 'ids':
+                continue
+            for name in os.listdir(os.path.join(self.root, prefix)):
+                path = os.path.join(self.root, prefix, name)
+                yield path, os.stat(path)
+
+    def gc(self) -> Tuple[int, int]:
+        """Removes unreferenced blobs and stale file-id links (startup). Returns (blobs removed, bytes freed)."""
+        removed = freed = 0
+        for path, st in list(self._blobs()):
+            if os.path.basename(path) not in self._refs:
+                os.remove(path)
+                removed += 1
+                freed += st.st_size
+        ids_dir = os.path.join(self.root, 'ids')
+        for name in os.listdir(ids_dir) if os.path.isdir(ids_dir) else []:
+            id_path = os.path.join(ids_dir, name)
+            if not os.path.exists(id_path):
+                os.remove(id_path)
+        return removed, freed
+
+    def usage(self) -> Tuple[int, int, int]:
+        """(blobs, bytes on disk, scripts using them)."""
+        blobs = stored = 0
+        for _, st in self._blobs():
+            blobs += 1
+            stored += st.st_size
+        return blobs, stored, sum(self._refs.values())
+
+blob_store = BlobStore()
+
+def absorb_existing_scripts():
+    """
+    Startup: moves single-file scripts hosted before the blob store into it, gives files that are
+    still hard links into the store (as earlier versions hosted them) a private copy, then counts
+    references and collects unused blobs.
+    """
+    if any(st.st_nlink > 1 for _, st in blob_store._blobs()):
+        detach_linked_files()
+    for user_id_str, user_data in db_manager.data.items():
+        for uid, script in user_data.get("hosted_scripts", {}).items():
+            path = get_file_path(int(user_id_str), script['file_name'])
+            if script.get('content_hash') or '/' in script['file_name'] or not os.path.isfile(path):
+                continue
+            digest = blob_store.store(path, path)
+            db_manager.update_script_data(int(user_id_str), uid, "content_hash", digest)
+    blob_store.count_references(
+        script['content_hash'] for user_data in db_manager.data.values()
+        for script in user_data.get("hosted_scripts", {}).values() if script.get('content_hash')
+    )
+    blob_store.gc()
+
+def detach_linked_files():
+    """Replaces hosted files that share an inode with others (single files and project .py files) by private copies."""
+    detached = 0
+    for user_id_str, user_data in db_manager.data.items():
+        for script in user_data.get("hosted_scripts", {}).values():
+            path = get_file_path(int(user_id_str), script['file_name'].split('/')[0])
+            if os.path.isdir(path):
+                paths = [os.path.join(dirpath, name) for dirpath, _, names in os.walk(path) for name in names]
+            else:
+                paths = [path]
+            for path in paths:
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                    clone_file(path, path)
+                    detached += 1
+    logger.warning(f"Gave {detached} hosted files a private copy instead of a link into the blob store.")
+
+
+# --- File/Document Handler ---
 def is_project_related_document(message: types.Message):
-    """Checks if message is a .py file."""
+    """Checks if message is a .py file or a zip/tar project archive."""
     if message.content_type != 'document':
         return False
     
-    file_name = message.document.file_name
-    return file_name.endswith('.py')
+    file_name = (message.document.file_name or '').lower()
+    return file_name.endswith(('.py',) + ARCHIVE_SUFFIXES)
+
+class UploadError(Exception):
+    """An upload was rejected: too large, not a usable archive, or unsafe archive contents."""
+
+def derive_file_url(api_url: str) -> str:
+    """
+    File download URL template for a Bot API base URL: '<base>bot{0}/{1}' -> '<base>file/bot{0}/{1}',
+    the layout of api.telegram.org and of a local Bot API server (so TELEGRAM_API_URL covers downloads too).
+    """
+    base, sep, rest = (api_url or "").rpartition("bot{0}/{1}")
+    if not sep or rest:
+        return "https://api.telegram.org/file/bot{0}/{1}"
+    return f"{base}file/bot{{0}}/{{1}}"
+
+async def download_document(file_id: str, dest_path: str, max_bytes: int = UPLOAD_MAX_BYTES, hasher=None) -> int:
+    """Streams a Telegram file to dest_path in chunks (disk writes off the loop), failing past max_bytes. Returns its size."""
+    file_info = await bot.get_file(file_id)
+    if file_info.file_size and file_info.file_size > max_bytes:
+        raise UploadError(f"file is {file_info.file_size / (1024 * 1024):.1f} MB, the limit is {max_bytes // (1024 * 1024)} MB")
+    url = (asyncio_helper.FILE_URL or derive_file_url(asyncio_helper.API_URL)).format(BOT_TOKEN, file_info.file_path)
+    session = await asyncio_helper.session_manager.get_session()
+    size = 0
+    with open(dest_path, 'wb') as f:
+        async with session.get(url, timeout=ClientTimeout(total=UPLOAD_TIMEOUT), proxy=asyncio_helper.proxy) as response:
+            if response.status != 200:
+                raise UploadError(f"download failed with HTTP {response.status}")
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadError(f"file exceeds the {max_bytes // (1024 * 1024)} MB limit")
+                if hasher is not None:
+                    hasher.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+        await asyncio.to_thread(f.flush)
+    return size
+
+def _archive_member_path(root: str, name: str) -> str | None:
+    """Safe destination for an archive member under root, or None for members to skip. Rejects path traversal."""
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or parts[0] == '__MACOSX':
+        return None
+    if name.startswith(('/', '\\')) or '..' in parts or ':' in parts[0]:
+        raise UploadError(f"unsafe path in archive: {name}")
+    return os.path.join(root, *parts)
+
+def _iter_archive_members(archive_path: str):
+    """Yields (name, is_dir, open_callable) for regular files and directories, reading the archive in one pass."""
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                yield info.filename, info.is_dir(), lambda info=info: archive.open(info)
+        return
+    try:
+        # Stream mode ('r|*'): sequential read, no member index kept in memory; links and devices are skipped
+        with tarfile.open(archive_path, mode='r|*') as archive:
+            for member in archive:
+                if member.isdir() or member.isfile():
+                    yield member.name, member.isdir(), lambda member=member: archive.extractfile(member)
+    except tarfile.TarError as e:
+        raise UploadError(f"not a valid zip/tar archive ({e})")
+
+def find_project_entry_point(root: str) -> str | None:
+    """Entry script of an extracted project, relative to root (descending into a single top-level folder)."""
+    base = root
+    entries = [e for e in os.listdir(base) if e != '__MACOSX']
+    if len(entries) == 1 and os.path.isdir(os.path.join(base, entries[0])):
+        base = os.path.join(base, entries[0])
+        entries = os.listdir(base)
+    candidates = [name for name in PROJECT_ENTRY_POINTS if name in entries]
+    if not candidates:
+        scripts = [name for name in entries if name.endswith('.py')]
+        candidates = scripts if len(scripts) == 1 else []
+    if not candidates:
+        return None
+    return os.path.relpath(os.path.join(base, candidates[0]), root).replace(os.sep, '/')
+
+def extract_project_archive(archive_path: str, dest_dir: str) -> Tuple[str, int]:
+    """
+    Extracts a zip/tar project into dest_dir member by member in fixed-size chunks, enforcing
+    ARCHIVE_MAX_MEMBERS and ARCHIVE_MAX_EXTRACTED_BYTES as it goes. Blocking: run it in a thread.
+    Returns (entry point relative to dest_dir, file count).
+    """
+    tmp_dir = f"{dest_dir}.extract.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    members = total_bytes = files = 0
+    try:
+        for name, is_dir, open_member in _iter_archive_members(archive_path):
+            members += 1
+            if members > ARCHIVE_MAX_MEMBERS:
+                raise UploadError(f"archive has more than {ARCHIVE_MAX_MEMBERS} entries")
+            target = _archive_member_path(tmp_dir, name)
+            if target is None:
+                continue
+            if is_dir:
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open_member() as source, open(target, 'wb') as out:
+                for chunk in iter(lambda: source.read(64 * 1024), b''):
+                    total_bytes += len(chunk)
+                    if total_bytes > ARCHIVE_MAX_EXTRACTED_BYTES:
+                        raise UploadError(f"archive extracts to more than {ARCHIVE_MAX_EXTRACTED_BYTES // (1024 * 1024)} MB")
+                    out.write(chunk)
+            files += 1
+        entry_point = find_project_entry_point(tmp_dir)
+        if entry_point is None:
+            raise UploadError(f"no entry point found: add one of {', '.join(PROJECT_ENTRY_POINTS)} to the archive root")
+        os.rename(tmp_dir, dest_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return entry_point, files
 
 # --- Command Handlers (REPLACED/MODIFIED) ---
 
 # REPLACEMENT: Unified start/menu handler for both authorized and unauthorized users.
 @bot.message_handler(commands=['start', 'menu'])
+@track_handler
 async def start_command_combined(message: types.Message):
     """Unified start/menu handler for both authorized and unauthorized users."""
     user_id = message.from_user.id
@@ -499,6 +3278,7 @@ async def start_command_combined(message: types.Message):
     
 # Handler 3: Owner Admin Panel (Only Owner gets a response)
 @bot.message_handler(commands=['adminpanel'], is_authorized=True) 
+@track_handler
 async def admin_panel_command(message: types.Message):
     user_id_requester = message.from_user.id
     if not is_owner(user_id_requester):
@@ -506,19 +3286,123 @@ async def admin_panel_command(message: types.Message):
         return
 
     reset_user_state(user_id_requester)
-    db_manager.update_user_state(user_id_requester, "current_process", "ADMIN_PANEL_IDLE")
+    conversations.update(user_id_requester, current_process="ADMIN_PANEL_IDLE")
     
+    blobs, stored_bytes, blob_scripts = blob_store.usage()
+    log_segments, log_stored, log_raw = log_archive.usage()
     admin_instructions = (
-        "👑 **Here's ya Admin Panel**"
+        "👑 **Here's ya Admin Panel**\n\n"
+        f"💾 **Script Storage:** {blobs} unique files for {blob_scripts} scripts, {stored_bytes / (1024 * 1024):.2f} MB in the store "
+        f"({blob_store.dedup_hits} duplicate uploads)\n"
+        f"🗄️ **Log Archive:** {log_segments} sealed segments, {log_stored / (1024 * 1024):.2f} MB on disk "
+        f"({log_raw / (1024 * 1024):.2f} MB of output) | search with `/logsearch <UID> [since=<1h>] <text or /regex/>`"
     )
     await bot.send_message(message.chat.id, admin_instructions, parse_mode="Markdown", reply_markup=build_admin_keyboard())
 
+# Handler: Owner log search
+@bot.message_handler(commands=['logsearch'], is_authorized=True)
+@track_handler
+async def log_search_command(message: types.Message):
+    """/logsearch <UID> [since=<duration>] <text or /regex/>: searches a script's archived output."""
+    if not is_owner(message.from_user.id):
+        return
+    usage = "Usage: `/logsearch <UID> [since=<1h|2d|...>] <text or /regex/>`"
+    args = (message.text or "").split(maxsplit=2)
+    if len(args) < 3:
+        await bot.send_message(message.chat.id, usage, parse_mode="Markdown")
+        return
+    uid, query = args[1].upper(), args[2]
+
+    since = None
+    if query.startswith("since="):
+        since_arg, _, query = query.partition(" ")
+        duration = parse_time_duration(since_arg[len("since="):])
+        if duration is None or not query:
+            await bot.send_message(message.chat.id, usage, parse_mode="Markdown")
+            return
+        since = time.time() - duration.total_seconds()
+    regex = len(query) > 2 and query.startswith('/') and query.endswith('/')
+    pattern = query[1:-1] if regex else query
+
+    uid_entry = db_manager.find_script(uid)
+    if uid_entry is None:
+        await bot.send_message(message.chat.id, f"❌ UID `{uid}` was not found.", parse_mode="Markdown")
+        return
+    try:
+        matches, total, scanned = await asyncio.to_thread(log_archive.search, int(uid_entry[0]), uid, pattern, regex, since)
+    except re.error as e:
+        await bot.send_message(message.chat.id, f"❌ **Invalid regex:** {e}", parse_mode="Markdown")
+        return
+
+    summary = f"🔎 **Log search** `{uid}`: **{total}** matching lines out of {scanned} scanned"
+    if total > len(matches):
+        summary += f" (showing the last {len(matches)})"
+    if matches:
+        # Stay well under Telegram's 4096-character message limit
+        summary += "\n```\n" + "\n".join(matches)[-3300:].replace("`", "'") + "\n```"
+    await bot.send_message(message.chat.id, summary, parse_mode="Markdown")
+
+# Handler: Owner runtime stats
+@bot.message_handler(commands=['stats'], is_authorized=True)
+async def stats_command(message: types.Message):
+    if not is_owner(message.from_user.id):
+        return
+    await bot.send_message(message.chat.id, build_stats_text(), parse_mode="Markdown")
+
+def get_rss_mb(pid: int) -> float:
+    """Resident set size of a process in MB, read from /proc (0.0 if unavailable)."""
+    try:
+        with open(f"/proc/{pid}/statm", 'r') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0.0
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def build_stats_text() -> str:
+    """Builds the owner's runtime statistics report."""
+    lines = [
+        "📊 **Runtime Stats**\n",
+        f"**Script DB:** {db_manager.mutation_count} mutations → {db_manager.write_count} writes",
+        f"**Host:** {len(running_processes)} scripts | {threading.active_count()} threads | RSS {get_rss_mb(os.getpid()):.1f} MB",
+        f"**Metrics:** {len(metrics_sampler.metrics)} series | last sweep {metrics_sampler.last_sweep_seconds * 1000:.1f} ms ({metrics_sampler.overhead_percent():.3f}% of interval)",
+        f"**Supervisor:** {supervisor.restarts} auto-restarts | {supervisor.crash_loops} crash loops stopped",
+        f"**Dispatcher:** {update_dispatcher.dispatched} handled | {update_dispatcher.pending} queued over {len(update_dispatcher.depths())} users | {update_dispatcher.backpressure_waits} backpressure waits | p99 queue wait {percentile(update_dispatcher.queue_waits, 0.99) * 1000:.1f} ms",
+        f"**Listings:** {listings.hits} cached | {listings.rebuilds} rebuilt",
+        f"**Log archive:** {log_archive.sealed} segments sealed | {log_archive.searches} searches",
+        f"**Log follow:** {log_follower.active()} live | {log_follower.edits} edits | {log_follower.skipped} unchanged refreshes skipped",
+        f"**Outbox:** {outbox.delivered} delivered | {outbox.deferred} deferred (429) | {outbox.coalesced} coalesced | {outbox.failed} failed | {outbox.pending()} queued",
+        f"**Updates:** {UPDATE_MODE} | webhook {webhook_server.received} received, {webhook_server.rejected} rejected, {webhook_server.in_flight} in flight, p50 {percentile(webhook_server.latencies, 0.5) * 1000:.1f} ms to handled",
+        f"**Pip:** {pip_installer.pending()} pending | {pip_installer.completed} done | {pip_installer.served_from_cache} from wheel cache",
+        f"**Envs:** {env_stats['created']} cloned (last {env_stats['last_create_seconds'] * 1000:.0f} ms) | {env_stats['deduped_bytes'] / (1024 * 1024):.1f} MB deduplicated",
+    ]
+    busiest = sorted(update_dispatcher.peak_depth.items(), key=lambda item: item[1], reverse=True)[:3]
+    if busiest:
+        depths = update_dispatcher.depths()
+        lines.append("**Queue depth (now/peak):** " + ", ".join(f"`{user}` {depths.get(user, 0)}/{peak}" for user, peak in busiest))
+    env_dirs = glob.glob(os.path.join(HOSTING_DIR, '*', '.venv'))
+    if env_dirs:
+        unique_mb = sum(get_env_unique_bytes(d) for d in env_dirs) / (1024 * 1024)
+        lines.append(f"**Env disk:** {unique_mb / len(env_dirs):.2f} MB unshared per tenant ({len(env_dirs)} envs)")
+    for name, stats in handler_stats.items():
+        if not stats["calls"]:
+            continue
+        calls = stats["calls"]
+        lines.append(
+            f"`{name}`: {calls} calls | "
+            f"{stats['db_mutations'] / calls:.2f} mutations/call | "
+            f"{stats['db_writes'] / calls:.2f} writes/call | "
+            f"p99 {percentile(stats['latencies'], 0.99) * 1000:.1f} ms"
+        )
+    return "\n".join(lines)
+
 # --- Main Message Handler (FIXED HOST FLOW & MARKDOWN) ---
 @bot.message_handler(content_types=['text', 'document'], is_authorized=True)
+@track_handler
 async def main_message_handler(message: types.Message):
     user_id = message.from_user.id
-    user_data = db_manager.get_user_data(user_id)
-    state = user_data["current_process"]
+    conversation = conversations.get(user_id)
+    state = conversation.current_process
+    user_scripts = db_manager.get_user_scripts(user_id)
     text = message.text
     chat_id = message.chat.id
 
@@ -527,7 +3411,7 @@ async def main_message_handler(message: types.Message):
     # 0. Button Handler (Prioritized)
     
     # --- Main Bot Buttons ---
-    if text in ["⚙️ Host", "🔪 Terminate", "⏸️ Pause", "🔄 Restart", "📃 Saved", "✏️ Update Name", "🪝 Pip", "❌ Cancel"]:
+    if text in ["⚙️ Host", "🔪 Terminate", "⏸️ Pause", "🔄 Restart", "📃 Saved", "✏️ Update Name", "🪝 Pip", "📜 Logs", "🛡️ Auto-Restart", "❌ Cancel"]:
         
         if text != "❌ Cancel" and state != "IDLE":
              reset_user_state(user_id)
@@ -536,73 +3420,55 @@ async def main_message_handler(message: types.Message):
         if text == "⚙️ Host":
              # 1. Resource Limit Check (NEW CHECK)
             if not is_owner(user_id) and user_id in approved_users:
-                user_script_count = len(user_data.get("hosted_scripts", {}))
+                user_script_count = len(user_scripts)
                 max_scripts = approved_users[user_id].get('max_scripts', 1)
                 
                 if user_script_count >= max_scripts:
                     await bot.send_message(chat_id, f"❌ **Hosting Limit Reached!**\nYou are currently hosting **{user_script_count}** scripts (Limit: **{max_scripts}**). You can **Terminate** an existing script before hosting a new one.", parse_mode="Markdown", reply_markup=build_main_keyboard())
                     return # Block hosting
             
-            db_manager.update_user_state(user_id, "current_process", "WAITING_FOR_NAME")
+            conversations.update(user_id, current_process="WAITING_FOR_NAME")
             await bot.send_message(chat_id, "Now provide the **name** you want to save/host the script with:", parse_mode="Markdown", reply_markup=build_main_keyboard())
         
         # ... (Terminate, Pause, Restart, Saved, Update Name, Pip, Cancel logic remains the same) ...
         
         elif text == "🔪 Terminate":
-            db_manager.update_user_state(user_id, "current_process", "WAITING_FOR_TERMINATE_UID")
+            conversations.update(user_id, current_process="WAITING_FOR_TERMINATE_UID")
             await bot.send_message(chat_id, "Now provide the **UID** of the script you want to **Terminate** (permanently delete from host).", parse_mode="Markdown", reply_markup=build_main_keyboard())
 
         elif text == "⏸️ Pause":
-            db_manager.update_user_state(user_id, "current_process", "WAITING_FOR_PAUSE_UID")
+            conversations.update(user_id, current_process="WAITING_FOR_PAUSE_UID")
             await bot.send_message(chat_id, "Now provide the **UID** of the script you want to **Pause** (stop execution temporarily).", parse_mode="Markdown", reply_markup=build_main_keyboard())
 
         elif text == "🔄 Restart":
-            db_manager.update_user_state(user_id, "current_process", "WAITING_FOR_RESTART_UID")
+            conversations.update(user_id, current_process="WAITING_FOR_RESTART_UID")
             await bot.send_message(chat_id, "Now provide the **UID** of the script you want to **Restart** or **Play**.", parse_mode="Markdown", reply_markup=build_main_keyboard())
         
         elif text == "📃 Saved":
-            scripts = user_data["hosted_scripts"]
-            
-            if not scripts:
-                text_msg = "📑 **Your Saved Scripts**:\n\nNo files are currently saved or hosted."
-            else:
-                text_msg = "📑 **Your Saved Scripts**:\n\n"
-                for uid, script in scripts.items():
-                    current_status = script['status']
-                    
-                    if uid in running_processes:
-                        process, _ = running_processes[uid]
-                        if process.poll() is None:
-                            status_icon = "🟢" 
-                        else:
-                            safe_terminate_process(uid) 
-                            db_manager.update_script_data(user_id, uid, "status", "Stopped")
-                            status_icon = "⚪"
-                    elif current_status == 'Running':
-                        status_icon = "🟢" 
-                    elif current_status == 'Paused':
-                        status_icon = "⏸️"
-                    else:
-                        status_icon = "⚪"
-                        
-                    # FIXED: Use single backtick for UID
-                    text_msg += f"{status_icon} `{uid}` | **{script['display_name']}**\n"
-                    
-            await bot.send_message(chat_id, text_msg, parse_mode="Markdown", reply_markup=build_main_keyboard())
+            text_msg, markup = await render_script_listing('saved', user_id)
+            await bot.send_message(chat_id, text_msg, parse_mode="Markdown", reply_markup=markup or build_main_keyboard())
         
         elif text == "✏️ Update Name":
-            db_manager.update_user_state(user_id, "current_process", "WAITING_FOR_UPDATE_UID")
+            conversations.update(user_id, current_process="WAITING_FOR_UPDATE_UID")
             await bot.send_message(chat_id, "Now provide the script's **UID** to change its display name.", parse_mode="Markdown", reply_markup=build_main_keyboard())
             
         elif text == "🪝 Pip": 
-            db_manager.update_user_state(user_id, "current_process", "WAITING_FOR_PIP_PACKAGES")
+            conversations.update(user_id, current_process="WAITING_FOR_PIP_PACKAGES")
             await bot.send_message(
                 chat_id, 
-                "**Install Packages:** Must list the Python packages you need, separated by commas (e.g., ``requests, telebot, pytz``). I will use ``pip install --user`` to install them on the host.",
+                "**Install Packages:** Must list the Python packages you need, separated by commas (e.g., ``requests, telebot, pytz``). I will install them into the Python environment your scripts run with.",
                 parse_mode="Markdown", 
                 reply_markup=build_main_keyboard()
             )
         
+        elif text == "🛡️ Auto-Restart":
+            conversations.update(user_id, current_process="WAITING_FOR_POLICY_UID")
+            await bot.send_message(chat_id, "Now provide the **UID** of the script whose **Auto-Restart** policy you want to change.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        
+        elif text == "📜 Logs":
+            conversations.update(user_id, current_process="WAITING_FOR_LOGS_UID")
+            await bot.send_message(chat_id, "Now provide the **UID** of the script whose recent **Logs** you want to see.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        
         elif text == "❌ Cancel":
             if state != "IDLE":
                 await bot.send_message(chat_id, "🚫 **Operation Canceled.** Returning to main menu.", parse_mode="Markdown", reply_markup=build_main_keyboard())
@@ -627,75 +3493,60 @@ async def main_message_handler(message: types.Message):
 
             if text == "🔙 Back to Admin":
                  # Reset state to ADMIN_PANEL_IDLE
-                db_manager.update_user_state(user_id, "current_process", "ADMIN_PANEL_IDLE")
+                conversations.update(user_id, current_process="ADMIN_PANEL_IDLE")
                 await bot.send_message(chat_id, "⬅️ **Returning to Admin Panel.**", parse_mode="Markdown", reply_markup=build_admin_keyboard())
                 return
             
-            db_manager.update_user_state(user_id, "current_process", "ADMIN_PANEL_IDLE") # Ensure base state is IDLE for the panel
+            conversations.update(user_id, current_process="ADMIN_PANEL_IDLE") # Ensure base state is IDLE for the panel
                 
             if text == "✅ Approve":
-                db_manager.update_user_state(user_id, "current_process", "A_WAITING_ID")
+                conversations.update(user_id, current_process="A_WAITING_ID")
                 # FIXED: Use single backtick for User ID
                 await bot.send_message(chat_id, "Now send the **User ID** (e.g., `123456789`) of the person you want to **Approve**.", parse_mode="Markdown", reply_markup=build_admin_keyboard())
                 return
             
             if text == "🚫 Unapprove":
-                db_manager.update_user_state(user_id, "current_process", "U_WAITING_ID")
+                conversations.update(user_id, current_process="U_WAITING_ID")
                 # FIXED: Use single backtick for User ID
                 await bot.send_message(chat_id, "Now send the **User ID** (e.g., `123456789`) of the person you want to **Unapprove** and **Terminate All Scripts**.", parse_mode="Markdown", reply_markup=build_admin_keyboard())
                 return
 
             if text == "👥 Approved":
-                if not approved_users:
-                    response = "ℹ️ **No users** are currently approved."
-                else:
-                    response = "📑 **Approved Users:**\n\n"
-                    # Sort by expiration time
-                    sorted_users = sorted(approved_users.items(), key=lambda item: item[1]['expiry'])
-                    
-                    for i, (user_id_item, data) in enumerate(sorted_users, 1):
-                        expiry_dt = datetime.fromtimestamp(data['expiry'], tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
-                        name = data.get('name', 'Unknown User')
-                        max_scripts = data.get('max_scripts', 1)
-                        
-                        # Check for expiration during display
-                        if datetime.fromtimestamp(data['expiry'], tz=timezone.utc) <= datetime.now(timezone.utc):
-                            status = "🔴 Expired"
-                        else:
-                            status = f"✅ Expires: **{expiry_dt}**"
-
-                        # FIXED: Use single backtick for User ID for copyability
-                        response += f"{i}. **{name}** (`{user_id_item}`)\n   *Scripts Limit: {max_scripts} | {status}*\n"
-                        
-                await bot.send_message(chat_id, response, parse_mode="Markdown", reply_markup=build_admin_keyboard())
+                response, markup = render_approved_listing()
+                await bot.send_message(chat_id, response, parse_mode="Markdown", reply_markup=markup or build_admin_keyboard())
                 return
 
             if text == "♻️ Renew":
-                db_manager.update_user_state(user_id, "current_process", "R_WAITING_ACCESS_TYPE")
+                conversations.update(user_id, current_process="R_WAITING_ACCESS_TYPE")
                 await bot.send_message(chat_id, "Which type of access do you want to renew?", parse_mode="Markdown", reply_markup=build_renew_keyboard())
                 return
 
             if text == "📝 List User Scripts":
-                db_manager.update_user_state(user_id, "current_process", "L_WAITING_ID")
+                conversations.update(user_id, current_process="L_WAITING_ID")
                 # FIXED: Use single backtick for User ID
-                await bot.send_message(chat_id, "Now send the **User ID** (e.g., `123456789`) whose hosted scripts you want to **List**.", parse_mode="Markdown", reply_markup=build_admin_keyboard())
+                await bot.send_message(chat_id, "Now send the **User ID** (e.g., `123456789`) or any script **UID** whose owner's hosted scripts you want to **List**.", parse_mode="Markdown", reply_markup=build_admin_keyboard())
                 return
 
         # Admin Panel Level 2 Buttons (Renew)
         if state == "R_WAITING_ACCESS_TYPE":
              if text == "⏱️ Renew Time Access":
-                db_manager.update_user_state(user_id, "current_process", "R_TIME_WAITING_ID")
+                conversations.update(user_id, current_process="R_TIME_WAITING_ID")
                  # FIXED: Use single backtick for User ID
                 await bot.send_message(chat_id, "Now send the **User ID** (e.g., `123456789`) for whom you want to **Renew Time Access**.", parse_mode="Markdown", reply_markup=build_renew_keyboard())
                 return
                 
              if text == "💻 Renew Script Access":
-                db_manager.update_user_state(user_id, "current_process", "R_SCRIPT_WAITING_ID")
+                conversations.update(user_id, current_process="R_SCRIPT_WAITING_ID")
                  # FIXED: Use single backtick for User ID
                 await bot.send_message(chat_id, "Now send the **User ID** (e.g., `123456789`) for whom you want to **Renew Script Access (Max Scripts)**.", parse_mode="Markdown", reply_markup=build_renew_keyboard())
                 return
                 
-             if text not in ["⏱️ Renew Time Access", "💻 Renew Script Access", "🔙 Back to Admin"]:
+             if text == "🧮 Renew Resource Limits":
+                conversations.update(user_id, current_process="R_LIMITS_WAITING_ID")
+                await bot.send_message(chat_id, "Now send the **User ID** (e.g., `123456789`) whose **Resource Limits** (CPU, memory, processes) you want to change.", parse_mode="Markdown", reply_markup=build_renew_keyboard())
+                return
+                
+             if text not in ["⏱️ Renew Time Access", "💻 Renew Script Access", "🧮 Renew Resource Limits", "🔙 Back to Admin"]:
                  # Ignore other text in this specific state
                  pass
 
@@ -711,8 +3562,7 @@ async def main_message_handler(message: types.Message):
                  reset_user_state(user_id)
                  return
                  
-            db_manager.update_user_state(user_id, "admin_target_id", target_id)
-            db_manager.update_user_state(user_id, "current_process", "A_WAITING_DURATION")
+            conversations.update(user_id, admin_target_id=target_id, current_process="A_WAITING_DURATION")
             # FIXED: Use single backtick for User ID
             await bot.send_message(chat_id, f"User ID `{target_id}` set. Now, must send the **duration** (e.g., ``7h``, ``3d``, ``1w``).", parse_mode="Markdown", reply_markup=build_admin_keyboard())
         except ValueError:
@@ -732,8 +3582,7 @@ async def main_message_handler(message: types.Message):
         expiration_time = datetime.now(timezone.utc) + duration
         expiration_timestamp = expiration_time.timestamp()
         
-        db_manager.update_user_state(user_id, "admin_target_step", expiration_timestamp) # Store duration
-        db_manager.update_user_state(user_id, "current_process", "A_WAITING_MAX_SCRIPTS")
+        conversations.update(user_id, admin_target_step=expiration_timestamp, current_process="A_WAITING_MAX_SCRIPTS")
         await bot.send_message(chat_id, "Time set. Now, now send the **maximum number of scripts** this user can host (e.g., **2, 5, 10**).", parse_mode="Markdown", reply_markup=build_admin_keyboard())
         return
 
@@ -745,8 +3594,8 @@ async def main_message_handler(message: types.Message):
                  await bot.send_message(chat_id, "Max scripts must be a **positive number**.", parse_mode="Markdown", reply_markup=build_admin_keyboard())
                  return
                  
-            target_id = user_data["admin_target_id"]
-            expiration_timestamp = user_data["admin_target_step"]
+            target_id = conversation.admin_target_id
+            expiration_timestamp = conversation.admin_target_step
             expiration_time = datetime.fromtimestamp(expiration_timestamp, tz=timezone.utc)
 
             # Fetch user info (async call)
@@ -761,7 +3610,8 @@ async def main_message_handler(message: types.Message):
                 'name': first_name, 
                 'max_scripts': max_scripts
             }
-            save_approved_users()
+            authorization.refresh(target_id)
+            save_approved_users(target_id)
 
             await bot.send_message(
                 chat_id,
@@ -798,11 +3648,12 @@ async def main_message_handler(message: types.Message):
                 
                 # --- Termination Logic ---
                 user_db_data = db_manager.get_user_data(target_id)
-                terminated_count = terminate_all_user_scripts(target_id, user_db_data)
+                terminated_count = await terminate_all_user_scripts(target_id, user_db_data)
                 
                 # --- Remove Approval ---
                 del approved_users[target_id]
-                save_approved_users()
+                authorization.refresh(target_id)
+                save_approved_users(target_id)
                 
                 await bot.send_message(
                     chat_id, 
@@ -828,39 +3679,18 @@ async def main_message_handler(message: types.Message):
     # L1. List User Scripts - WAITING_ID (Owner sees another user's scripts)
     elif state == "L_WAITING_ID" and message.content_type == 'text' and not is_command and is_owner(user_id):
         try:
-            target_id = int(text.strip())
-            target_data = db_manager.get_user_data(target_id)
-            scripts = target_data["hosted_scripts"]
-            
+            # A script UID resolves to its owner through the global UID index
+            uid_entry = db_manager.find_script(text.strip().upper())
+            target_id = int(uid_entry[0]) if uid_entry else int(text.strip())
             try:
-                # FIXED: Use single backtick for User ID fallback
                 user_info = await bot.get_chat(target_id)
-                target_name = user_info.first_name or f'User ID `{target_id}`' 
+                if user_info.first_name:
+                    listings.names[target_id] = user_info.first_name
             except Exception:
-                # FIXED: Use single backtick for User ID fallback
-                target_name = f'User ID `{target_id}`' 
+                pass # Falls back to the User ID in the title
             
-            if not scripts:
-                text_msg = f"📑 **{target_name}'s Saved Scripts**:\n\nNo files are currently saved or hosted."
-            else:
-                text_msg = f"📑 **{target_name}'s Saved Scripts**:\n\n"
-                for uid, script in scripts.items():
-                    current_status = script['status']
-                    
-                    # Owner's view includes checking live processes
-                    if uid in running_processes:
-                        status_icon = "🟢" 
-                    elif current_status == 'Running':
-                        status_icon = "🟢" 
-                    elif current_status == 'Paused':
-                        status_icon = "⏸️"
-                    else:
-                        status_icon = "⚪"
-                        
-                    # FIXED: Use single backtick for UID
-                    text_msg += f"{status_icon} `{uid}` | **{script['display_name']}**\n"
-                    
-            await bot.send_message(chat_id, text_msg, parse_mode="Markdown", reply_markup=build_admin_keyboard())
+            text_msg, markup = await render_script_listing('user', target_id)
+            await bot.send_message(chat_id, text_msg, parse_mode="Markdown", reply_markup=markup or build_admin_keyboard())
 
         except ValueError:
             await bot.send_message(chat_id, "Invalid **User ID** format.", parse_mode="Markdown", reply_markup=build_admin_keyboard())
@@ -881,8 +3711,7 @@ async def main_message_handler(message: types.Message):
                 reset_user_state(user_id)
                 return
             
-            db_manager.update_user_state(user_id, "admin_target_id", target_id)
-            db_manager.update_user_state(user_id, "current_process", "R_TIME_WAITING_DURATION")
+            conversations.update(user_id, admin_target_id=target_id, current_process="R_TIME_WAITING_DURATION")
              # FIXED: Use single backtick for User ID
             await bot.send_message(chat_id, f"User ID `{target_id}` set. Send the **additional duration** to renew (e.g., ``5d``, ``2w``).", parse_mode="Markdown", reply_markup=build_renew_keyboard())
 
@@ -900,7 +3729,7 @@ async def main_message_handler(message: types.Message):
             await bot.send_message(chat_id, "Invalid duration format. Use 'm', 'h', 'd', 'w'.", parse_mode="Markdown", reply_markup=build_renew_keyboard())
             return
 
-        target_id = user_data["admin_target_id"]
+        target_id = conversation.admin_target_id
         current_data = approved_users[target_id]
         
         # Calculate new expiry time: If already expired, start from now. If not expired, renew from current expiry.
@@ -909,8 +3738,8 @@ async def main_message_handler(message: types.Message):
         new_expiry_time = start_time + duration
         
         current_data['expiry'] = new_expiry_time.timestamp()
-        
-        save_approved_users()
+        authorization.refresh(target_id)
+        save_approved_users(target_id)
         
         await bot.send_message(
             chat_id, 
@@ -933,8 +3762,7 @@ async def main_message_handler(message: types.Message):
                 reset_user_state(user_id)
                 return
             
-            db_manager.update_user_state(user_id, "admin_target_id", target_id)
-            db_manager.update_user_state(user_id, "current_process", "R_SCRIPT_WAITING_MAX")
+            conversations.update(user_id, admin_target_id=target_id, current_process="R_SCRIPT_WAITING_MAX")
             current_max = approved_users[target_id].get('max_scripts', 1)
              # FIXED: Use single backtick for User ID
             await bot.send_message(chat_id, f"User ID `{target_id}` set (Current Max: **{current_max}**).\nSend the **NEW total Max Scripts** limit.", parse_mode="Markdown", reply_markup=build_renew_keyboard())
@@ -952,10 +3780,10 @@ async def main_message_handler(message: types.Message):
                  await bot.send_message(chat_id, "Max scripts must be a **positive number**.", parse_mode="Markdown", reply_markup=build_renew_keyboard())
                  return
                  
-            target_id = user_data["admin_target_id"]
+            target_id = conversation.admin_target_id
             current_data = approved_users[target_id]
             
-            hosted_count = len(db_manager.get_user_data(target_id).get("hosted_scripts", {}))
+            hosted_count = len(db_manager.get_user_scripts(target_id))
             
             if new_max_scripts < hosted_count:
                  # FIX: Removed LaTeX and used standard English
@@ -970,7 +3798,7 @@ async def main_message_handler(message: types.Message):
                  
             current_data['max_scripts'] = new_max_scripts
             
-            save_approved_users()
+            save_approved_users(target_id)
 
             await bot.send_message(
                 chat_id, 
@@ -988,6 +3816,49 @@ async def main_message_handler(message: types.Message):
         reset_user_state(user_id)
         return
 
+    # R5. Renew Resource Limits - WAITING_ID
+    elif state == "R_LIMITS_WAITING_ID" and message.content_type == 'text' and not is_command and is_owner(user_id):
+        try:
+            target_id = int(text.strip())
+            if target_id not in approved_users:
+                await bot.send_message(chat_id, f"❌ User ID `{target_id}` is **not currently approved**.", parse_mode="Markdown", reply_markup=build_renew_keyboard())
+                reset_user_state(user_id)
+                return
+            
+            conversations.update(user_id, admin_target_id=target_id, current_process="R_LIMITS_WAITING_VALUES")
+            current_limits = get_script_limits(target_id, {})
+            await bot.send_message(
+                chat_id,
+                f"User ID `{target_id}` set.\nCurrent: ``{format_limits(current_limits)}``\n\n"
+                f"Send the **new limits**, e.g. ``cpu=50 mem=512 procs=32 cputime=0 nice=10`` (0 = unlimited; omitted keys stay unchanged). "
+                f"They apply from each script's next start.",
+                parse_mode="Markdown", reply_markup=build_renew_keyboard()
+            )
+
+        except ValueError:
+            await bot.send_message(chat_id, "Invalid **User ID** format. Can try again.", parse_mode="Markdown", reply_markup=build_renew_keyboard())
+            reset_user_state(user_id)
+        return
+
+    # R6. Renew Resource Limits - WAITING_VALUES (Final step)
+    elif state == "R_LIMITS_WAITING_VALUES" and message.content_type == 'text' and not is_command and is_owner(user_id):
+        new_limits = parse_limits(text.strip())
+        if not new_limits:
+            await bot.send_message(chat_id, "Invalid limits. Use ``key=value`` pairs with keys ``cpu``, ``mem``, ``procs``, ``cputime``, ``nice``.", parse_mode="Markdown", reply_markup=build_renew_keyboard())
+            return
+
+        target_id = conversation.admin_target_id
+        current_data = approved_users[target_id]
+        current_data['limits'] = {**(current_data.get('limits') or {}), **new_limits}
+        save_approved_users(target_id)
+
+        await bot.send_message(
+            chat_id,
+            f"✅ **Resource Limits Updated!**\n\nLimits for **{current_data['name']}** (`{target_id}`):\n``{format_limits(get_script_limits(target_id, {}))}``",
+            parse_mode="Markdown", reply_markup=build_admin_keyboard()
+        )
+        reset_user_state(user_id)
+        return
 
     # 1. Host - WAITING_FOR_NAME (File Name Input)
     elif state == "WAITING_FOR_NAME" and message.content_type == 'text' and not is_command: 
@@ -996,12 +3867,15 @@ async def main_message_handler(message: types.Message):
             await bot.send_message(chat_id, "File name cannot be empty. Must provide a name.", parse_mode="Markdown", reply_markup=build_main_keyboard())
             return
 
-        db_manager.update_user_state(user_id, "pending_file_name", display_name)
+        conversations.update(user_id, pending_file_name=display_name)
         # FIX: Correctly setting next state to WAITING_FOR_FILE
-        db_manager.update_user_state(user_id, "current_process", "WAITING_FOR_FILE") 
+        conversations.update(user_id, current_process="WAITING_FOR_FILE") 
         
         # Fixed Markdown
-        await bot.send_message(chat_id, f"Thank you! Now, now send the **Python script (.py file)** that you wish to host as **'{display_name}'**.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        await bot.send_message(chat_id, f"Thank you! Now, now send the **Python script (.py file)** that you wish to host as **'{display_name}'**, "
+            f"or a **.zip/.tar project** with a `main.py` (or `bot.py`, `app.py`) at its root.\n\n"
+            "Tip: a `# ready-marker: <text>` header line ends the startup check as soon as that text is printed, "
+            "and `# capture-window: <seconds>` changes how long it waits for output.", parse_mode="Markdown", reply_markup=build_main_keyboard())
         return
 
     # 2. Host - WAITING_FOR_FILE (Document handler)
@@ -1009,7 +3883,7 @@ async def main_message_handler(message: types.Message):
         
         # --- Check Resource Limit Again (Safety Check) ---
         if not is_owner(user_id) and user_id in approved_users:
-             user_script_count = len(user_data.get("hosted_scripts", {}))
+             user_script_count = len(user_scripts)
              max_scripts = approved_users[user_id].get('max_scripts', 1)
              
              if user_script_count >= max_scripts:
@@ -1018,25 +3892,46 @@ async def main_message_handler(message: types.Message):
                  reset_user_state(user_id)
                  return
                  
-        display_name = user_data["pending_file_name"]
+        display_name = conversation.pending_file_name
         
         new_uid = db_manager.generate_uid()
         safe_file_name = f"{new_uid}.py" 
         local_path = get_file_path(user_id, safe_file_name)
+        tmp_path = get_file_path(user_id, f"{new_uid}.upload.tmp")
+        is_archive = message.document.file_name.lower().endswith(ARCHIVE_SUFFIXES)
+        content_hash = None
         
         try:
-            file_info = await bot.get_file(message.document.file_id)
-            downloaded_file = await bot.download_file(file_info.file_path)
-            with open(local_path, 'wb') as new_file:
-                new_file.write(downloaded_file)
+            known_hash = None if is_archive else blob_store.lookup(message.document.file_unique_id)
+            if known_hash:
+                # Same content uploaded before: copy it out of the store, no download
+                blob_store.copy_out(known_hash, local_path)
+                blob_store.dedup_hits += 1
+                content_hash = known_hash
+            elif is_archive:
+                await download_document(message.document.file_id, tmp_path)
+                project_dir = get_file_path(user_id, new_uid)
+                entry_point, file_count = await asyncio.to_thread(extract_project_archive, tmp_path, project_dir)
+                safe_file_name = f"{new_uid}/{entry_point}"
+                await bot.send_message(chat_id, f"📦 **Project extracted:** {file_count} files, entry point ``{entry_point}``.", parse_mode="Markdown")
+            else:
+                hasher = hashlib.sha256()
+                await download_document(message.document.file_id, tmp_path, hasher=hasher)
+                # Atomic: <UID>.py is never seen half-written; identical content is stored once
+                content_hash = blob_store.store(tmp_path, local_path, hasher.hexdigest())
+                blob_store.remember(message.document.file_unique_id, content_hash)
         except Exception as e:
             logger.error(f"Error saving file from user {user_id}: {e}")
             await bot.send_message(chat_id, f"❌ Sorry, an error occurred while saving the file: ``{e}``", parse_mode="Markdown", reply_markup=build_main_keyboard())
             reset_user_state(user_id)
             return
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
             
         # 2.2 Add to DB and Start Script (Use safe_file_name)
-        db_manager.add_new_script(user_id, new_uid, display_name, safe_file_name)
+        db_manager.add_new_script(user_id, new_uid, display_name, safe_file_name, content_hash)
+        db_manager.flush()
         script_data = db_manager.get_script_by_uid(user_id, new_uid)
 
         await start_script(user_id, new_uid, script_data, chat_id, silent_start=False)
@@ -1053,8 +3948,9 @@ async def main_message_handler(message: types.Message):
              # FIXED: Use single backtick for UID
             await bot.send_message(chat_id, f"❌ UID `{uid}` was not found in your saved scripts.", parse_mode="Markdown", reply_markup=build_main_keyboard())
         else:
-            safe_terminate_process(uid)
+            await terminate_process_async(uid)
             if db_manager.delete_script(user_id, uid):
+                 db_manager.flush()
                  # FIXED: Use single backtick for UID
                  await bot.send_message(chat_id, f"🗑️ **Successfully Terminated!**\n\nScript **{script['display_name']}** (`{uid}`) has been stopped, and the file has been **permanently deleted** from the host.", parse_mode="Markdown", reply_markup=build_main_keyboard())
             else:
@@ -1072,11 +3968,11 @@ async def main_message_handler(message: types.Message):
         if not script:
              # FIXED: Use single backtick for UID
             await bot.send_message(chat_id, f"❌ UID `{uid}` was not found in your saved scripts.", parse_mode="Markdown", reply_markup=build_main_keyboard())
-        elif script['status'] == 'Paused' or script['status'] == 'Stopped' or script['status'].startswith('Error'):
+        elif script['status'] == 'Paused' or script['status'] == 'Stopped' or script['status'].startswith(('Error', 'Killed')):
              # FIXED: Use single backtick for UID
-            await bot.send_message(chat_id, f"ℹ️ Script **{script['display_name']}** (`{uid}`) is already **Paused**, **Stopped** or in an **Error** state.", parse_mode="Markdown", reply_markup=build_main_keyboard())
-        elif script['status'] == 'Running':
-            if safe_terminate_process(uid):
+            await bot.send_message(chat_id, f"ℹ️ Script **{script['display_name']}** (`{uid}`) is already **Paused**, **Stopped**, **Killed** or in an **Error** state.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        elif script['status'] in ('Running', 'Restarting'):
+            if await terminate_process_async(uid):
                 db_manager.update_script_data(user_id, uid, "status", "Paused")
                 db_manager.update_script_data(user_id, uid, "process_id", 0)
                  # FIXED: Use single backtick for UID
@@ -1106,7 +4002,7 @@ async def main_message_handler(message: types.Message):
          # FIXED: Use single backtick for UID
         if is_currently_running:
             await bot.send_message(chat_id, f"🔄 Restarting Running script: **{script['display_name']}** (`{uid}`)...", parse_mode="Markdown")
-            safe_terminate_process(uid) 
+            await terminate_process_async(uid) 
             await start_script(user_id, uid, script, chat_id, silent_start=False)
             
         elif current_db_status == 'Running':
@@ -1114,7 +4010,7 @@ async def main_message_handler(message: types.Message):
             await bot.send_message(chat_id, f"▶️ Restarting previously running script: **{script['display_name']}** (`{uid}`)...", parse_mode="Markdown")
             await start_script(user_id, uid, script, chat_id, silent_start=False)
             
-        elif current_db_status == 'Paused' or current_db_status == 'Stopped' or current_db_status.startswith('Error'): 
+        elif current_db_status in ('Paused', 'Stopped', 'Restarting') or current_db_status.startswith(('Error', 'Killed')): 
             if current_db_status.startswith('Error'):
                  db_manager.update_script_data(user_id, uid, "status", "Stopped") 
             
@@ -1135,8 +4031,7 @@ async def main_message_handler(message: types.Message):
         script = db_manager.get_script_by_uid(user_id, uid)
         
         if script:
-            db_manager.update_user_state(user_id, "pending_update_uid", uid)
-            db_manager.update_user_state(user_id, "current_process", "WAITING_FOR_NEW_NAME")
+            conversations.update(user_id, pending_update_uid=uid, current_process="WAITING_FOR_NEW_NAME")
              # FIXED: Use single backtick for UID
             await bot.send_message(chat_id, f"Must provide the **new name** for UID `{uid}`. (Current: **{script['display_name']}**)", parse_mode="Markdown", reply_markup=build_main_keyboard())
         else:
@@ -1147,7 +4042,7 @@ async def main_message_handler(message: types.Message):
 
     # 7. Update Name - WAITING_FOR_NEW_NAME 
     elif state == "WAITING_FOR_NEW_NAME" and message.content_type == 'text' and not is_command:
-        uid = user_data.get("pending_update_uid")
+        uid = conversation.pending_update_uid
         new_name = text.strip()
         
         if db_manager.update_script_data(user_id, uid, "display_name", new_name):
@@ -1169,43 +4064,80 @@ async def main_message_handler(message: types.Message):
              await bot.send_message(chat_id, "❌ Invalid input. Must list packages separated by commas.", parse_mode="Markdown", reply_markup=build_main_keyboard())
              return
              
-        install_command = ['pip', 'install', '--user'] + packages_list 
-        
-        await bot.send_message(chat_id, f"🔄 Installing {len(packages_list)} package(s) on the host using ``pip install --user``. Must wait...", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        env_dir = None
+        if VENV_ISOLATION:
+            try:
+                await ensure_user_env(user_id)
+                env_dir = get_user_env_dir(user_id)
+            except Exception as e:
+                logger.error(f"Error preparing virtualenv for user {user_id}: {e}")
+                await bot.send_message(chat_id, f"❌ Could not prepare your Python environment: ``{e}``", parse_mode="Markdown", reply_markup=build_main_keyboard())
+                reset_user_state(user_id)
+                return
 
-        try:
-            result = subprocess.run(
-                install_command, 
-                capture_output=True, 
-                text=True, 
-                check=True,
-                timeout=300
-            )
-            
-            response_msg = (
-                f"✅ **Success!** The following packages are now available to all your scripts on the host:\n"
-                f"``{packages_str}``\n\n"
-                f"You can now host your script."
-            )
-            logger.debug(f"Packages installed successfully: {packages_str}")
-            await bot.send_message(chat_id, response_msg, parse_mode="Markdown", reply_markup=build_main_keyboard())
-            
-        except subprocess.CalledProcessError as e:
-            error_msg = (
-                f"❌ **Installation Failed!**\n\n"
-                f"Could not install packages: ``{packages_list}``.\n"
-                f"**Error Details:**\n"
-                f"``{e.stderr[:500]}``"
+        job, is_new = pip_installer.submit(packages_list, env_dir)
+        target_label = "your private environment" if env_dir else "the host using ``pip install --user``"
+        if is_new:
+            await bot.send_message(chat_id, f"🔄 Queued install of {len(packages_list)} package(s) into {target_label} ({pip_installer.pending()} job(s) in queue). I'll notify you when it finishes.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        else:
+            await bot.send_message(chat_id, "🔄 These packages are **already being installed**. I'll notify you when it finishes.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        run_in_background(notify_pip_result(chat_id, packages_str, packages_list, job))
+
+        reset_user_state(user_id)
+        return
+
+    # 10. Auto-Restart - WAITING_FOR_POLICY_UID
+    elif state == "WAITING_FOR_POLICY_UID" and message.content_type == 'text' and not is_command:
+        uid = text.strip().upper()
+        script = db_manager.get_script_by_uid(user_id, uid)
+        
+        if script:
+            conversations.update(user_id, pending_update_uid=uid, current_process="WAITING_FOR_POLICY_VALUE")
+            current_policy = script.get('restart_policy', DEFAULT_RESTART_POLICY)
+            await bot.send_message(
+                chat_id,
+                f"Current policy for `{uid}`: **{current_policy}**.\nSend the new policy: ``never``, ``on-failure`` (restart after a crash) or ``always`` (also after a clean exit).",
+                parse_mode="Markdown", reply_markup=build_main_keyboard()
             )
-            logger.error(f"Package installation failed: {e.stderr}")
-            await bot.send_message(chat_id, error_msg, parse_mode="Markdown", reply_markup=build_main_keyboard())
+        else:
+            await bot.send_message(chat_id, f"❌ UID `{uid}` was not found in your saved scripts.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+            reset_user_state(user_id)
+        return
 
-        except subprocess.TimeoutExpired:
-            await bot.send_message(chat_id, "❌ **Installation Timeout.** The installation took too long (over 5 minutes) and was canceled.", parse_mode="Markdown", reply_markup=build_main_keyboard())
-        except Exception as e:
-            logger.error(f"Unexpected error during pip install: {e}")
-            await bot.send_message(chat_id, f"❌ An unexpected error occurred: ``{e}``", parse_mode="Markdown", reply_markup=build_main_keyboard())
+    # 11. Auto-Restart - WAITING_FOR_POLICY_VALUE
+    elif state == "WAITING_FOR_POLICY_VALUE" and message.content_type == 'text' and not is_command:
+        uid = conversation.pending_update_uid
+        policy = text.strip().lower()
+        
+        if policy not in RESTART_POLICIES:
+            await bot.send_message(chat_id, "Invalid policy. Must be ``never``, ``on-failure`` or ``always``.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+            return
+        
+        if db_manager.update_script_data(user_id, uid, "restart_policy", policy):
+            await bot.send_message(chat_id, f"✅ **Success!** Auto-Restart policy for `{uid}` is now **{policy}**.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        else:
+            await bot.send_message(chat_id, f"❌ Error changing policy. UID `{uid}` might not exist.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        
+        reset_user_state(user_id)
+        return
 
+    # 9. Logs - WAITING_FOR_LOGS_UID
+    elif state == "WAITING_FOR_LOGS_UID" and message.content_type == 'text' and not is_command:
+        uid = text.strip().upper()
+        script = db_manager.get_script_by_uid(user_id, uid)
+        
+        if not script:
+            await bot.send_message(chat_id, f"❌ UID `{uid}` was not found in your saved scripts.", parse_mode="Markdown", reply_markup=build_main_keyboard())
+        else:
+            log_lines = get_script_log_tail(user_id, uid, LOG_TAIL_LINES)
+            # Stay well under Telegram's 4096-character message limit
+            log_text = "".join(log_lines).strip()[-3500:].replace("`", "'") or "No output captured yet."
+            await bot.send_message(
+                chat_id,
+                f"📜 **Logs for {script['display_name']}** (`{uid}`), last {LOG_TAIL_LINES} lines:\n```\n{log_text}\n```",
+                parse_mode="Markdown", reply_markup=build_follow_markup(uid, following=False)
+            )
+        
         reset_user_state(user_id)
         return
 
@@ -1221,10 +4153,17 @@ async def unauthorized_ignore_handler(message: types.Message):
     # Do nothing, bot will not respond to these messages if not authorized.
     pass
 
-# --- Callback Query Handler (Unchanged) ---
+# --- Callback Query Handler ---
 @bot.callback_query_handler(func=lambda call: True, is_authorized=True)
+@track_handler
 async def general_callback_handler(call: types.CallbackQuery):
-    """Handles any residual inline button presses and directs the user to the Reply Keyboard."""
+    """Pages listings and runs log follow buttons; directs any other inline press to the Reply Keyboard."""
+    if call.data and call.data.startswith("ls:"):
+        await handle_listing_callback(call)
+        return
+    if call.data and call.data.startswith("lf:"):
+        await handle_follow_callback(call)
+        return
     await bot.answer_callback_query(call.id)
     try:
         await bot.edit_message_text("Must use the **Reply Keyboard** buttons.", call.message.chat.id, call.message.message_id, parse_mode="Markdown", reply_markup=None)
@@ -1232,9 +4171,237 @@ async def general_callback_handler(call: types.CallbackQuery):
         await bot.send_message(call.message.chat.id, "Must use the **Reply Keyboard** buttons.", parse_mode="Markdown", reply_markup=build_main_keyboard())
 
 
+# --- Reattach After Bot Restart ---
+class AdoptedProcess:
+    """
+    Popen-like handle for a hosted process that outlived the previous bot instance. It is not our
+    child, so liveness comes from /proc and the exit status can't be observed: it is reported as 1.
+    """
+    def __init__(self, pid: int, start_time: int):
+        self.pid = pid
+        self.start_time = start_time
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and read_proc_start_time(self.pid) != self.start_time:
+            self.returncode = 1
+        return self.returncode
+
+    def send_signal(self, sig: int):
+        if self.poll() is None:
+            signal_process_group(self, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+def adopt_process(script: dict) -> AdoptedProcess | None:
+    """Returns a handle to the script's recorded process if that exact process (PID + start time) is still alive."""
+    pid, start_time = script.get('process_id'), script.get('process_start')
+    if not pid or start_time is None or read_proc_start_time(pid) != start_time:
+        return None
+    return AdoptedProcess(pid, start_time)
+
+def reattach_scripts(items: list) -> Tuple[int, list]:
+    """Re-tracks boot items whose process survived; returns (reattached count, items that must be respawned)."""
+    reattached, dead = 0, []
+    for item in items:
+        user_id, uid, script = item['user_id'], item['uid'], item['script']
+        process = adopt_process(script)
+        if process is None:
+            dead.append(item)
+            continue
+        log_path = get_file_path(user_id, f"{uid}.log")
+        log_buffer = ScriptLogBuffer(LOG_BUFFER_MAX_BYTES)
+        log_offset = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        for line in read_log_file_tail(log_path, LOG_TAIL_LINES):
+            log_buffer.append(line)
+        if not os.path.exists(log_path):
+            open(log_path, 'ab').close()
+        output_pump.watch(log_path, log_offset, process, log_buffer)
+        running_processes[uid] = (process, log_buffer)
+        supervisor.watch(uid, process)
+        if script['status'] != 'Running':
+            db_manager.update_script_data(user_id, uid, "status", "Running")
+        reattached += 1
+    return reattached, dead
+
+
+# --- Boot Auto-Restart Scheduler ---
+def interleave_by_user(items: list) -> list:
+    """Round-robins restart items across users so one large tenant can't delay everyone else."""
+    per_user: Dict[int, deque] = {}
+    for item in items:
+        per_user.setdefault(item['user_id'], deque()).append(item)
+    ordered = []
+    queues = deque(per_user.values())
+    while queues:
+        user_queue = queues.popleft()
+        ordered.append(user_queue.popleft())
+        if user_queue:
+            queues.append(user_queue)
+    return ordered
+
+async def restart_scripts(items: list, parallelism: int = RESTART_PARALLELISM, spawn_rate: float = RESTART_SPAWN_RATE) -> dict:
+    """Restarts scripts concurrently with a parallelism cap, per-user fairness and a spawn-rate limit."""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max(1, parallelism))
+    spawn_interval = 1.0 / spawn_rate if spawn_rate > 0 else 0.0
+    next_spawn_at = loop.time()
+    summary = {"total": len(items), "running": 0, "exited": 0, "failed": 0, "seconds": 0.0}
+    start_time = loop.time()
+
+    async def restart_one(item):
+        nonlocal next_spawn_at
+        async with semaphore:
+            # Reserve the next spawn slot, then wait for it
+            slot = max(loop.time(), next_spawn_at)
+            next_spawn_at = slot + spawn_interval
+            await asyncio.sleep(slot - loop.time())
+
+            user_id, uid = item['user_id'], item['uid']
+            try:
+                await start_script(user_id, uid, item['script'], user_id, silent_start=True)
+            except Exception as e:
+                logger.error(f"Auto-restart of UID {uid} failed: {e}")
+            script = db_manager.get_script_by_uid(user_id, uid) or {}
+            if uid in running_processes:
+                summary["running"] += 1
+            elif str(script.get('status', '')).startswith(('Error', 'Restarting')):
+                summary["failed"] += 1
+            else:
+                summary["exited"] += 1
+            logger.debug(f"Auto-restarted script UID {uid}.")
+
+    # Semaphore waiters are served FIFO, so tasks start in the interleaved order
+    await asyncio.gather(*(restart_one(item) for item in interleave_by_user(items)))
+    summary["seconds"] = loop.time() - start_time
+    return summary
+
+async def pause_unapproved_scripts(items: list):
+    """
+    Boot: stops surviving processes of scripts whose owner is no longer in approved_users (removed
+    without a revocation, e.g. by the old on-message expiry) and marks the scripts Paused.
+    """
+    survivors = [(item['uid'], adopt_process(item['script'])) for item in items]
+    await asyncio.gather(*(stop_process(uid, process) for uid, process in survivors if process is not None))
+    for item in items:
+        db_manager.update_script_data(item['user_id'], item['uid'], "status", "Paused")
+        db_manager.update_script_data(item['user_id'], item['uid'], "process_id", 0)
+    logger.warning(f"Paused {len(items)} script(s) of users no longer approved.")
+
+async def run_boot_restarts(items: list):
+    """Boot auto-restart: reattaches surviving processes, respawns the rest, and reports to the owner."""
+    reattached, items = reattach_scripts(items)
+    logger.warning(f"Reattached {reattached} surviving script(s); {len(items)} need a respawn.")
+    await asyncio.sleep(5 if items else 0)
+    try:
+        await bot.send_message(OWNER_ID, f"♻️ **Auto-Restart:** reattached **{reattached}** surviving script(s), starting **{len(items)}** (parallelism {RESTART_PARALLELISM}, {RESTART_SPAWN_RATE:g}/s)...", parse_mode="Markdown", priority=PRIORITY_NOTIFICATION)
+    except Exception as e:
+        logger.error(f"Could not notify owner about auto-restart: {e}")
+
+    summary = await restart_scripts(items)
+    logger.debug(f"All {summary['total']} scripts were processed for silent auto-restart in {summary['seconds']:.2f} seconds.")
+    try:
+        await bot.send_message(
+            OWNER_ID,
+            f"✅ **Auto-Restart Complete** in ``{summary['seconds']:.1f}s``\n\n"
+            f"🔗 Reattached: **{reattached}**\n"
+            f"🟢 Running: **{summary['running']}**\n"
+            f"⚪ Exited: **{summary['exited']}**\n"
+            f"❌ Failed: **{summary['failed']}**\n"
+            f"Total: **{summary['total']}**",
+            parse_mode="Markdown",
+            priority=PRIORITY_NOTIFICATION
+        )
+    except Exception as e:
+        logger.error(f"Could not send auto-restart summary: {e}")
+
+
+# --- Webhook Mode ---
+class WebhookServer:
+    """
+    aiohttp endpoint for Telegram webhooks: verifies the secret token and hands updates to the dispatcher.
+    A slot is held from acceptance until the dispatcher has finished handling the update, so in_flight,
+    latencies and WEBHOOK_MAX_CONCURRENCY cover queueing plus handling, not just the hand-off.
+    """
+    def __init__(self, max_concurrency: int = WEBHOOK_MAX_CONCURRENCY):
+        self.secret = None
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self.received = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.latencies = deque(maxlen=1000)
+
+    def build_app(self, secret: str) -> web.Application:
+        self.secret = secret
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token, self.secret):
+            self.rejected += 1
+            return web.Response(status=403)
+        try:
+            update = types.Update.de_json(await request.json())
+        except (ValueError, KeyError, TypeError):
+            self.rejected += 1
+            return web.Response(status=400)
+
+        # Backpressure: Telegram's connections wait here while all slots are busy
+        await self._slots.acquire()
+        self.received += 1
+        self.in_flight += 1
+        run_in_background(self._process(update))
+        return web.Response()
+
+    async def _process(self, update: types.Update):
+        start = time.perf_counter()
+        try:
+            for handled in await update_dispatcher.submit([update]):
+                await handled
+        except Exception as e:
+            logger.error(f"Error processing webhook update {update.update_id}: {e}")
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+            self.in_flight -= 1
+            self._slots.release()
+
+webhook_server = WebhookServer()
+
+async def run_webhook() -> None:
+    """Serves the webhook endpoint and registers it with Telegram until cancelled."""
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    runner = web.AppRunner(webhook_server.build_app(secret))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=secret,
+        max_connections=WEBHOOK_MAX_CONCURRENCY,
+        allowed_updates=["message", "callback_query"]
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 # --- Main Application Setup (FINAL FIXES: Auto-Restart for Running Scripts) ---
 async def start_bot() -> None:
-    """Start the bot using async polling."""
+    """Start the bot using a webhook (UPDATE_MODE = "webhook") or async polling."""
+    if UPDATE_MODE == "webhook":
+        await run_webhook()
+        return
+    # A webhook left registered by an earlier webhook-mode run makes every getUpdates fail with 409
+    try:
+        await bot.delete_webhook()
+    except Exception as e:
+        logger.error(f"Could not remove the webhook before polling: {e}")
     # Removed logging here as it's handled by main() below
     await bot.polling(non_stop=True, interval=1)
 
@@ -1246,18 +4413,31 @@ def main() -> None:
         safe_terminate_process(uid)
     
     load_approved_users() 
+    conversations.load_snapshot()
+    absorb_existing_scripts()
+    upgrade_existing_envs()
+    log_archive.enforce_retention_all()
 
     scripts_to_restart = []
+    scripts_to_pause = []
     
     for user_id_str, user_data in db_manager.data.items():
         user_id = int(user_id_str)
+        if not is_authorized(user_id):
+            if user_id not in approved_users:
+                # No revocation will come for these: stop survivors and pause them here
+                scripts_to_pause.extend(
+                    {'user_id': user_id, 'uid': uid, 'script': script}
+                    for uid, script in user_data.get("hosted_scripts", {}).items() if script['status'] in ('Running', 'Restarting')
+                )
+            continue # Expired while the bot was down: AuthorizationCache.run stops (adopting survivors) and pauses these
         for uid, script in user_data.get("hosted_scripts", {}).items():
              
              if script['status'] == 'Stopped (Process Lost)':
                 db_manager.update_script_data(user_id, uid, "status", "Stopped")
                 logger.debug(f"Cleaned up old 'Process Lost' status for {uid}.")
              
-             if script['status'] == 'Running':
+             if script['status'] in ('Running', 'Restarting'):
                  scripts_to_restart.append({'user_id': user_id, 'uid': uid, 'script': script})
 
 
@@ -1267,27 +4447,15 @@ def main() -> None:
         
         loop = asyncio.get_event_loop()
         bot_task = loop.create_task(start_bot())
+        loop.create_task(conversations.run_sweeper())
+        loop.create_task(authorization.run())
+        loop.create_task(metrics_sampler.run())
+        if scripts_to_pause:
+            loop.create_task(pause_unapproved_scripts(scripts_to_pause))
 
         if scripts_to_restart:
             logger.debug(f"Starting auto-restart for {len(scripts_to_restart)} scripts.")
-            
-            async def run_restarts():
-                await asyncio.sleep(5) 
-                
-                start_time = time.monotonic()
-
-                for item in scripts_to_restart:
-                    user_id = item['user_id']
-                    uid = item['uid']
-                    script = item['script']
-                    
-                    await start_script(user_id, uid, script, user_id, silent_start=True) 
-                    logger.debug(f"Auto-restarted script UID {uid}.")
-                
-                end_time = time.monotonic()
-                logger.debug(f"All {len(scripts_to_restart)} scripts were processed for silent auto-restart in {end_time - start_time:.2f} seconds.")
-                
-            loop.create_task(run_restarts())
+            loop.create_task(run_boot_restarts(scripts_to_restart))
 
         loop.run_until_complete(bot_task)
 
@@ -1296,7 +4464,9 @@ def main() -> None:
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
     finally:
-        save_approved_users()
+        db_manager.flush()
+        conversations.save_snapshot()
+        authorization.flush()
 
 
 if __name__ == '__main__':